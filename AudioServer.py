@@ -16,6 +16,11 @@
     moved to the audio_store folder. When the server is running, you can test it
     is working simply by copying any WAV file into the audio queue folder. It
     should be played and moved to the audio store folder.
+
+    The server sleeps until a file arrives in the queue folder, using inotify
+    to be told when a file has been written or moved into the folder. Run the
+    server with the --poll option to scan the folder for files instead (on
+    systems without inotify this happens automatically).
     
     To generate speech from text, import the SpeechGenerator class into your
     python program, and create an instance:
@@ -30,6 +35,26 @@
     This will generate a new WAV file for this text and queue it up for the
     playback service to play. If you send the same text again, it will reuse
     the wav file already generated (from the audio store folder).
+
+    Generating speech takes a noticeable time, so robot control programs
+    should not wait for it. submitSpeech returns a Future straight away and
+    generates the speech on a background worker, and queueSpeechAsync is a
+    coroutine for asyncio programs:
+
+        speechGen.submitSpeech("Hello Footleg")
+        await speechGen.queueSpeechAsync("Hello Footleg")
+
+    Requests for a phrase which is already being generated share the one
+    generation. Short phrases are generated first, and only one phrase is
+    generated at a time (at a lower CPU priority) by default, so speech
+    generation does not starve the robot control program of CPU time.
+
+    Generated speech files are named from a hash of the voice, boost, text
+    and speech engine version, and listed in an index file in the audio store
+    folder (tts_index.json) with their sizes and when they were last used.
+    Once the speech files take up more than the cache size limit (set with
+    the maxCacheBytes argument of SpeechGenerator) the least recently used
+    files are deleted.
     
     Installation dependencies:
     The speech generation features uses flite to generate the audio and
@@ -39,7 +64,28 @@
         sudo apt-get install flite normalize-audio
         
     The playback service uses the aplay command line player. This is already
-    installed on Raspberry Pi OS.
+    installed on Raspberry Pi OS. The server keeps one aplay process running
+    and sends it the decoded audio from each WAV file, so sounds start
+    playing without waiting for a new player to start up for every file.
+
+    Played clips are kept decoded in memory (up to the --cache-size limit), so
+    sounds which are played repeatedly are not read from the SD card again.
+    Clips listed in the hot set file (one file name per line in the file
+    audio_store/hotset.txt) are loaded into memory when the server starts.
+
+    Robot programs can also send requests straight to the server over a local
+    socket using the AudioClient class in audioclient.py, to play clips, speak
+    text, interrupt the clip playing or clear the queue. This avoids waiting
+    for files to be moved through the queue folder, which still works too.
+
+    Normally clips play one at a time. Start the server with the --mix option
+    to mix clips together instead, so sound effects can play over each other
+    and over speech (see audiomixer.py). In this mode speech, and the files
+    put in the queue folder, play one at a time on the speech channel, and
+    other sounds are turned down while speech is playing. Each channel has
+    its own priority queue, and requests wait there until the channel has a
+    free voice, so a higher priority request still cuts in ahead of (or stops)
+    lower priority ones, and requests which wait past their ttl are dropped.
     
     Flite comes with different voices. You can list these in a terminal with
     the command:
@@ -58,66 +104,673 @@
     If the speech sounds distorted, you have probably boosted it too much for
     your speakers. With the tiny 1.5W speaker I use on my small robots, a
     boost in the range 6-8 works best for most voices.
+
+    If you know the phrases the robot will say in advance, list them in a
+    phrasebook file and generate them all before the event, so even the first
+    time each phrase is said there is no wait for the speech to be generated.
+    A phrasebook has one phrase per line. Lines starting with # are comments,
+    and a line with a voice and boost in square brackets sets the voice and
+    boost for the phrases after it (the default is kal with a boost of 7):
+
+        [awb 6]
+        Hello, I am a robot
+        Would you like to drive me?
+
+    Generate the speech for a phrasebook using all the CPU cores with:
+
+        python3 AudioServer.py --prerender phrasebook.txt
+
+    Phrases already generated are checked and skipped, so running it again
+    after editing the phrasebook only generates the new or changed phrases.
 """
 
-from os import listdir, system
-from os.path import isfile, join, getmtime
-from time import sleep
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import queue
+import re
+import selectors
+import socket
+import subprocess
+import threading
+import time
+import wave
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from os import remove, rename, replace, cpu_count
+from os.path import isfile, getsize, basename
+from audioqueue import QueueWatcher, QueueStats, PlayRequest, PlaybackQueue
+from audioplayback import PlaybackEngine, ClipCache
+from audiomixer import MixingEngine
+from audioclient import (SOCKET_ADDRESS, MAX_MESSAGE, PLAY, PLAY_CACHED, SPEAK, INTERRUPT,
+                         FLUSH, STATUS, decodeRequest, checkRequest)
 
 audio_queue = "/home/pi/universal-robot/audio_queue"
 audio_store = "/home/pi/universal-robot/audio_store"
+hot_set_file = f"{audio_store}/hotset.txt"
+tts_index_file = f"{audio_store}/tts_index.json"
+
+# Change this when the speech generation changes, so cached speech is generated again
+TTS_ENGINE_VERSION = "flite+normalize-1"
+
+# Most voice and boost combinations the server will generate speech for
+MAX_SPEECH_VOICES = 8
+VOICE_NAME = re.compile(r"[A-Za-z0-9_]+")
+
+def validClipName(name:str) -> bool:
+    ''' Clip names in requests must be a file in the store, not a path or a hidden file '''
+    return bool(name) and basename(name) == name and not name.startswith(".")
+
+class TTSCache():
+    '''
+        Index of generated speech files, keyed by a hash of everything which
+        affects the audio generated. The index is kept in memory and saved to
+        a JSON file, so looking up a phrase does not touch the filesystem.
+    '''
+    def __init__(self,indexPath:str=tts_index_file,maxBytes:int=64*1024*1024,saveInterval:float=60):
+        self.lock = threading.RLock()
+        self.indexPath = indexPath
+        self.maxBytes = maxBytes
+        self.saveInterval = saveInterval
+        self.entries = {}
+        self.totalBytes = 0
+        self.dirty = False
+        self.lastSave = time.monotonic()
+        self.load()
+
+    @staticmethod
+    def key(voice:str,boost:int,text:str) -> str:
+        ''' Returns the cache key for a phrase spoken with a voice and boost '''
+        identity = "\0".join((TTS_ENGINE_VERSION, voice, str(boost), text))
+        return hashlib.sha1(identity.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def filename(key:str) -> str:
+        return f"tts_{key}.wav"
+
+    def load(self):
+        if not isfile(self.indexPath):
+            return
+        try:
+            with open(self.indexPath) as f:
+                self.entries = json.load(f).get("entries", {})
+        except (OSError, ValueError) as err:
+            print(f"Unable to read speech index {self.indexPath}: {err}")
+            self.entries = {}
+        self.totalBytes = sum(e["size"] for e in self.entries.values())
+
+    def save(self):
+        ''' Write the index to a temporary file and swap it in, so it is never left half written '''
+        with self.lock:
+            tmpPath = self.indexPath + ".tmp"
+            with open(tmpPath, "w") as f:
+                json.dump({"engine": TTS_ENGINE_VERSION, "entries": self.entries}, f)
+            replace(tmpPath, self.indexPath)
+            self.dirty = False
+            self.lastSave = time.monotonic()
+
+    def saveIfDue(self):
+        if self.dirty and time.monotonic() - self.lastSave >= self.saveInterval:
+            self.save()
+
+    def lookup(self,key:str) -> str:
+        ''' Returns the file name for a key, or None if it is not cached '''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            entry["lastUsed"] = time.time()
+            self.dirty = True
+            self.saveIfDue()
+            return entry["file"]
+
+    def add(self,key:str,filename:str,size:int,text:str=""):
+        ''' Add a generated file, deleting the least recently used files if over the size limit '''
+        with self.lock:
+            self.remove(key)
+            self.entries[key] = {"file": filename, "size": size, "lastUsed": time.time(), "text": text}
+            self.totalBytes += size
+            self.evict(keep=key)
+            self.save()
+
+    def remove(self,key:str):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.totalBytes -= entry["size"]
+                self.dirty = True
+            return entry
+
+    def evict(self,keep:str=None):
+        if self.totalBytes <= self.maxBytes:
+            return
+        for key in sorted(self.entries, key=lambda k: self.entries[k]["lastUsed"]):
+            if self.totalBytes <= self.maxBytes:
+                break
+            if key == keep:
+                continue
+            # Keep files waiting in the queue, as they are moved back into the store once played
+            if isfile(f"{audio_queue}/{self.entries[key]['file']}"):
+                continue
+            entry = self.remove(key)
+            try:
+                remove(f"{audio_store}/{entry['file']}")
+            except FileNotFoundError:
+                pass
+
+def synthesiseSpeech(voice:str,boost:int,text:str,path:str,niceness:int=0):
+    ''' Generate a speech wav file, returning its size '''
+    nice = ["nice", "-n", str(niceness)] if niceness else []
+    subprocess.run(nice + ["flite", "-voice", voice, "-t", text, path], check=True)
+    subprocess.run(nice + ["normalize-audio", f"--gain={boost}db", path], check=True)
+    return getsize(path)
+
+class SynthesisPool():
+    '''
+        Worker threads which run speech generation jobs, lowest priority
+        number first (jobs with equal priority run in the order submitted)
+    '''
+    def __init__(self,maxWorkers:int=1):
+        self.maxWorkers = maxWorkers
+        self.jobs = queue.PriorityQueue()
+        self.order = itertools.count()
+        self.workers = []
+        self.lock = threading.Lock()
+
+    def submit(self,priority:int,fn,*args):
+        with self.lock:
+            if len(self.workers) < self.maxWorkers:
+                worker = threading.Thread(target=self.run, name="SpeechWorker", daemon=True)
+                worker.start()
+                self.workers.append(worker)
+        self.jobs.put((priority, next(self.order), fn, args))
+
+    def run(self):
+        while True:
+            priority, order, fn, args = self.jobs.get()
+            if fn is None:
+                return
+            fn(*args)
+
+    def shutdown(self):
+        ''' Stop the workers once the jobs already submitted have run '''
+        with self.lock:
+            for worker in self.workers:
+                self.jobs.put((float("inf"), next(self.order), None, ()))
+            for worker in self.workers:
+                worker.join()
+            self.workers = []
 
 class SpeechGenerator():
-    def __init__(self,voice:str="kal",boost:int=7):
+    def __init__(self,voice:str="kal",boost:int=7,maxCacheBytes:int=64*1024*1024,
+                 maxWorkers:int=1,niceness:int=10,cache:TTSCache=None):
+        '''
+            Generators for different voices must share one TTSCache (passed in
+            as cache), as each cache saves the whole index file.
+        '''
         self.voice = voice
         self.boost = boost
+        self.niceness = niceness
+        self.cache = cache if cache is not None else TTSCache(maxBytes=maxCacheBytes)
+        self.pool = SynthesisPool(maxWorkers)
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def synthesise(self,text:str,filename:str):
+        ''' Generate a speech wav file in the store, at a lower CPU priority '''
+        return synthesiseSpeech(self.voice, self.boost, text, f"{audio_store}/{filename}", self.niceness)
 
     def queueSpeech(self,text:str):
-        ''' Create an audio wav file to speak '''
-        
-        # Generate filename for this text
-        filename = f"{self.voice}_{self.boost}_" + \
-            text.replace(" ", "_").replace("?", "-").replace("\'", ".") + ".wav"
-            
-        # Check if the file is already generated
-        fileInStore = isfile(f"{audio_store}/{filename}")
-        if not isfile(f"{audio_queue}/{filename}") and not fileInStore:
-            # Generate new file in store
-            system(f"flite -voice {self.voice} -t \"{text}\" {audio_store}/{filename}")
-            system(f"normalize-audio --gain={self.boost}db {audio_store}/{filename}")
-            fileInStore = True
-            
-        if fileInStore:
-            self.playAudio(filename)
-            
-
-    def playAudio(self,filename:str):
-        if isfile(f"{audio_queue}/{filename}"):
-            # File already in queue, so do nothing (prevents file overwrite
-            # while being played if same file is requested again before it
-            # is processed from the queue
-            pass
-        elif isfile(f"{audio_store}/{filename}"):
+        '''
+            Create an audio wav file to speak, waiting until it is queued.
+            Returns the file name, or None if the speech could not be generated.
+        '''
+        return self.submitSpeech(text).result()
+
+    async def queueSpeechAsync(self,text:str):
+        ''' Coroutine to create an audio wav file to speak, without blocking the event loop '''
+        return await asyncio.wrap_future(self.submitSpeech(text))
+
+    def submitSpeech(self,text:str,queue:bool=True) -> Future:
+        '''
+            Queue text to speak, generating the audio on a background worker
+            if needed. Returns a Future which completes with the file name
+            once the audio is queued for playback, or with None if the speech
+            could not be generated. If queue is False the audio is only
+            generated in the store, not queued.
+        '''
+        # Look up the file for this text, voice and boost
+        key = TTSCache.key(self.voice, self.boost, text)
+        with self.lock:
+            filename = self.cache.lookup(key)
+            if filename is not None:
+                ready = self.playAudio(filename) if queue else isfile(f"{audio_store}/{filename}")
+                if ready:
+                    future = Future()
+                    future.set_result(filename)
+                    return future
+
+            # Share the generation if this phrase is already being generated
+            future = self.pending.get(key)
+            if future is None:
+                future = Future()
+                self.pending[key] = future
+                # Short phrases are quickest to generate, so do them first
+                self.pool.submit(len(text), self.generate, key, text, queue, future)
+            return future
+
+    def generate(self,key:str,text:str,queue:bool,future:Future):
+        ''' Generate new file in store and queue it (runs on a worker) '''
+        filename = TTSCache.filename(key)
+        try:
+            size = self.synthesise(text, filename)
+            self.cache.add(key, filename, size, text)
+            if queue:
+                self.playAudio(filename)
+        except (OSError, subprocess.CalledProcessError) as err:
+            # flite or normalize-audio is missing or failed, so there is nothing to say
+            print(f"Unable to generate speech for '{text}': {err}")
+            try:
+                remove(f"{audio_store}/{filename}")
+            except FileNotFoundError:
+                pass
+            future.set_result(None)
+        except Exception as err:
+            future.set_exception(err)
+        else:
+            future.set_result(filename)
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+
+    def playAudio(self,filename:str) -> bool:
+        ''' Move a file from the store into the queue. Returns False if the file does not exist. '''
+        try:
             # Move existing file into queue
-            system(f"mv {audio_store}/{filename} {audio_queue}/{filename}")
+            rename(f"{audio_store}/{filename}", f"{audio_queue}/{filename}")
+        except FileNotFoundError:
+            # If the file is already in the queue do nothing (prevents file
+            # overwrite while being played if same file is requested again
+            # before it is processed from the queue)
+            return isfile(f"{audio_queue}/{filename}")
+        return True
+
+def readPhrasebook(path:str,voice:str="kal",boost:int=7):
+    ''' Returns a list of (voice, boost, text) for the phrases in a phrasebook file '''
+    phrases = []
+    with open(path, encoding="utf-8") as f:
+        for lineNo, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("[") and line.endswith("]"):
+                settings = line[1:-1].split()
+                try:
+                    voice = settings[0]
+                    boost = int(settings[1]) if len(settings) > 1 else 7
+                except (IndexError, ValueError):
+                    raise ValueError(f"{path} line {lineNo}: expected [voice boost], got {line}")
+                continue
+            phrases.append((voice, boost, line))
+    return phrases
+
+
+def isRendered(cache:TTSCache,key:str) -> bool:
+    ''' Check a phrase is in the index, and its file exists with the size indexed '''
+    entry = cache.entries.get(key)
+    if entry is None:
+        return False
+    for folder in (audio_store, audio_queue):
+        path = f"{folder}/{entry['file']}"
+        if isfile(path):
+            return getsize(path) == entry["size"]
+    return False
+
+
+def prerenderPhrasebook(path:str,workers:int=None):
+    ''' Generate speech for all the phrases in a phrasebook which are not already generated '''
+    start = time.monotonic()
+    cache = TTSCache()
+    phrases = readPhrasebook(path)
+    todo = {}
+    for voice, boost, text in phrases:
+        key = TTSCache.key(voice, boost, text)
+        if not isRendered(cache, key):
+            todo[key] = (voice, boost, text)
+    keys = set(TTSCache.key(*p) for p in phrases)
+    verified = len(keys) - len(todo)
+    # Size of the speech for the whole phrasebook, starting with the phrases already generated
+    phrasebookBytes = sum(cache.entries[key]["size"] for key in keys if key not in todo)
+
+    def render(key, voice, boost, text):
+        renderStart = time.monotonic()
+        size = synthesiseSpeech(voice, boost, text, f"{audio_store}/{TTSCache.filename(key)}")
+        return size, time.monotonic() - renderStart
+
+    # flite runs in its own process, so worker threads spread the work over all the cores
+    failed = 0
+    renderTime = 0.0
+    with ThreadPoolExecutor(max_workers=workers or cpu_count()) as executor:
+        futures = {executor.submit(render, key, *phrase): key for key, phrase in todo.items()}
+        for future in as_completed(futures):
+            key = futures[future]
+            voice, boost, text = todo[key]
+            try:
+                size, seconds = future.result()
+            except (OSError, subprocess.CalledProcessError) as err:
+                failed += 1
+                print(f"Failed to generate '{text}' ({voice} {boost}): {err}")
+                continue
+            renderTime += seconds
+            phrasebookBytes += size
+            cache.add(key, TTSCache.filename(key), size, text)
+            print(f"Generated '{text}' ({voice} {boost}) in {seconds:.2f}s")
+
+    elapsed = time.monotonic() - start
+    print(f"{len(phrases)} phrases: {verified} already generated, "
+          f"{len(todo) - failed} generated, {failed} failed")
+    print(f"Took {elapsed:.2f}s ({renderTime:.2f}s of generation time)")
+    if phrasebookBytes > cache.maxBytes:
+        missing = sum(1 for key in keys if key not in cache.entries)
+        print(f"Warning: the phrasebook needs {phrasebookBytes/1024/1024:.1f}MB of speech, more than the "
+              f"{cache.maxBytes/1024/1024:.1f}MB speech cache, so {missing} of its phrases were deleted "
+              f"to make space")
+
+
+def readHotSet(path:str=hot_set_file):
+    """ Returns the clip names listed in the hot set file """
+    if not isfile(path):
+        return []
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+
+class PlaybackServer():
+    '''
+        Plays clips queued in the audio queue folder or requested over the
+        audio server socket. Requests are received on the main thread, and
+        clips are played on a playback thread so requests (such as interrupt)
+        are handled while a clip is playing.
+    '''
+    def __init__(self,usePolling:bool=False,cacheBytes:int=16*1024*1024,address:str=SOCKET_ADDRESS,
+                 mix:bool=False):
+        # Keep recently played clips in memory, starting with the hot set
+        self.cache = ClipCache(audio_store, cacheBytes)
+        self.cache.preload(readHotSet())
+
+        # Watch folder for audio files to play
+        self.watcher = QueueWatcher(audio_queue, usePolling, onWritten=self.cache.invalidate)
+        self.engine = PlaybackEngine()
+        # When mixing, clips are handed to the mixer instead of played one at a time
+        self.mixer = MixingEngine(self.engine) if mix else None
+        if self.mixer is None:
+            self.requests = PlaybackQueue()
+            self.queues = {None: self.requests}
+        else:
+            # Each mixer channel has its own queue, and a request only leaves it when a voice on
+            # the channel is free, so priorities, ttls and coalescing still apply while it waits
+            self.requests = None
+            self.queues = {name: PlaybackQueue(slots=channel.maxVoices)
+                           for name, channel in self.mixer.mixer.mixChannels.items()}
+            self.mixer.mixer.onFinished = self.mixFinished
+            self.mixWake = threading.Event()
+        self.stats = QueueStats()
+        self.ttsCache = TTSCache()
+        self.speechGenerators = {}
+        self.running = False
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(address)
+        self.sock.setblocking(False)
+
+    def queueFiles(self):
+        ''' Read the files found in the queue folder and queue them to play '''
+        while True:
+            item = self.watcher.get(0)
+            if item is None:
+                return
+            file, queuedTime = item
+            try:
+                clip = self.cache.load(file, f"{audio_queue}/{file}")
+            except FileNotFoundError:
+                # Removed from queue before it was played
+                continue
+            except (EOFError, wave.Error) as err:
+                print(f"Unable to play {file}: {err}")
+                clip = None
+
+            # Move out of queue as soon as it is read, as it plays from memory
+            try:
+                rename(f"{audio_queue}/{file}", f"{audio_store}/{file}")
+            except FileNotFoundError:
+                pass
+            if clip is not None:
+                self.queueRequest(PlayRequest(file, clip, 0, queuedTime, channel="speech"))
+
+    def queueClip(self,name:str,priority:int=0,cachedOnly:bool=False,queuedTime:float=None,ttl:float=None,
+                  channel:str="effects",loop:bool=False):
+        '''
+            Queue a clip from the store (or only from memory if cachedOnly).
+            Stops the clip playing if this one has a higher priority.
+        '''
+        if not validClipName(name):
+            print(f"Invalid clip name {name!r}")
+            return
+        if cachedOnly:
+            clip = self.cache.get(name)
+            if clip is None:
+                print(f"Clip {name} not in memory")
+                return
+        else:
+            try:
+                clip = self.cache.load(name)
+            except (OSError, EOFError, wave.Error) as err:
+                print(f"Unable to play {name}: {err}")
+                return
+        self.queueRequest(PlayRequest(name, clip, priority, queuedTime, ttl, channel, loop))
+
+    def queueRequest(self,request:PlayRequest):
+        if self.mixer is None:
+            preempted = self.requests.put(request)
+            if preempted is not None:
+                self.engine.stop(preempted)
+            return
+        queue = self.queues.get(request.channel)
+        if queue is None:
+            print(f"Unable to play {request.name}: no mixer channel {request.channel}")
+            return
+        preempted = queue.put(request)
+        if preempted is not None:
+            self.mixer.stop(request.channel, preempted)
+        self.mixWake.set()
+
+    def mixFinished(self,channel:str,request:PlayRequest):
+        ''' Called by the mixer when a request's clip finishes or is stopped, freeing its voice '''
+        self.queues[channel].done(request)
+        self.mixWake.set()
+
+    def speak(self,text:str,voice:str,boost:int,priority:int=0,ttl:float=None):
+        ''' Generate speech if needed, then queue it '''
+        speechGen = self.speechGenerators.get((voice, boost))
+        if speechGen is None:
+            if not isinstance(voice, str) or not VOICE_NAME.fullmatch(voice) or not isinstance(boost, int):
+                print(f"Invalid speech voice {voice!r} boost {boost!r}")
+                return
+            if len(self.speechGenerators) >= MAX_SPEECH_VOICES:
+                print(f"Too many speech voices, not generating speech for {voice} {boost}")
+                return
+            speechGen = SpeechGenerator(voice, boost, cache=self.ttsCache)
+            self.speechGenerators[(voice, boost)] = speechGen
+        queuedTime = time.monotonic()
+
+        def generated(future):
+            if future.exception() is not None:
+                print(f"Unable to generate speech for '{text}': {future.exception()}")
+            elif future.result() is not None:
+                self.queueClip(future.result(), priority, queuedTime=queuedTime, ttl=ttl, channel="speech")
+
+        speechGen.submitSpeech(text, queue=False).add_done_callback(generated)
+
+    def queueSummary(self) -> str:
+        return " ".join(queue.summary() if name is None else f"{name} {queue.summary()}"
+                        for name, queue in self.queues.items())
+
+    def status(self) -> dict:
+        queues = self.queues.values()
+        playing = [r.name for queue in queues for r in queue.active]
+        return {"cmd": STATUS, "queueDepth": sum(len(queue) for queue in queues),
+                "queueDepthMax": max(queue.depthMax for queue in queues),
+                "playing": ", ".join(playing) if playing else None,
+                "waitMean": self.stats.latencyTotal / self.stats.played if self.stats.played else 0.0,
+                "waitMax": self.stats.latencyMax,
+                "coalesced": sum(queue.coalesced for queue in queues),
+                "expired": sum(queue.expired for queue in queues),
+                "preempted": sum(queue.preempted for queue in queues),
+                "queue": f"{self.stats.summary()} {self.queueSummary()}",
+                "playback": self.engine.stats.summary(), "cache": self.cache.summary()}
+
+    def receive(self):
+        ''' Handle all the requests waiting on the socket '''
+        while True:
+            try:
+                data, sender = self.sock.recvfrom(MAX_MESSAGE)
+            except BlockingIOError:
+                return
+            request = decodeRequest(data)
+            if request is None:
+                continue
+            if checkRequest(request) is None:
+                print(f"Ignoring request with invalid fields: {data[:200]!r}")
+                continue
+            # A request which still fails is dropped, so one bad request cannot stop the server
+            try:
+                self.handleRequest(request, sender)
+            except Exception as err:
+                print(f"Unable to handle request {data[:200]!r}: {err!r}")
+
+    def handleRequest(self,request:dict,sender):
+        ''' Carry out a request from a client, which has been checked by checkRequest '''
+        cmd = request["cmd"]
+        priority = request.get("priority") or 0
+        ttl = request.get("ttl")
+        channel = request.get("channel") or "effects"
+        loop = bool(request.get("loop"))
+        if cmd == PLAY:
+            self.queueClip(request.get("name") or "", priority, ttl=ttl, channel=channel, loop=loop)
+        elif cmd == PLAY_CACHED:
+            self.queueClip(request.get("name") or "", priority, cachedOnly=True, ttl=ttl,
+                           channel=channel, loop=loop)
+        elif cmd == SPEAK:
+            boost = request.get("boost")
+            self.speak(request.get("text") or "", request.get("voice") or "kal",
+                       7 if boost is None else boost, priority, ttl)
+        elif cmd == INTERRUPT:
+            if self.mixer is not None:
+                self.mixer.stop(request.get("channel"))
+            else:
+                playing = self.requests.playing
+                if playing is not None:
+                    self.engine.stop(playing)
+        elif cmd == FLUSH:
+            for queue in self.queues.values():
+                queue.clear()
+        elif cmd == STATUS and sender:
+            try:
+                self.sock.sendto(json.dumps(self.status()).encode("utf-8"), sender)
+            except OSError:
+                pass
+
+    def mixLoop(self):
+        ''' Start queued requests on the mixer as voices on their channels become free '''
+        while self.running:
+            self.mixWake.wait(0.5)
+            self.mixWake.clear()
+            started = False
+            for name, queue in self.queues.items():
+                while queue.free:
+                    request = queue.get(0)
+                    if request is None:
+                        break
+                    self.stats.record(time.monotonic() - request.queuedTime)
+                    try:
+                        self.mixer.play(request.clip, name, request.loop, request)
+                        started = True
+                    except ValueError as err:
+                        print(f"Unable to mix {request.name}: {err}")
+                        queue.done(request)
+            if started:
+                print(f"{self.stats.summary()} {self.queueSummary()} {self.mixer.summary()}")
+
+    def playbackLoop(self):
+        if self.mixer is not None:
+            self.mixLoop()
+            return
+        while self.running:
+            request = self.requests.get(0.5)
+            if request is None:
+                continue
+            self.stats.record(time.monotonic() - request.queuedTime)
+            self.engine.play(request.clip, request.queuedTime, request)
+            self.requests.done()
+            print(f"{self.stats.summary()} {self.requests.summary()} {self.engine.stats.summary()} "
+                  f"{self.cache.summary()}")
+
+    def run(self):
+        self.running = True
+        if self.mixer is not None:
+            self.mixer.start()
+        player = threading.Thread(target=self.playbackLoop, name="Playback", daemon=True)
+        player.start()
 
-def runPlaybackServer():
-    while True:
-        # Watch folder for text files to speak
-        files = [f for f in listdir(audio_queue) if isfile(join(audio_queue, f))]
+        selector = selectors.DefaultSelector()
+        selector.register(self.sock, selectors.EVENT_READ, self.receive)
+        if self.watcher.usingInotify:
+            selector.register(self.watcher.fileno(), selectors.EVENT_READ,
+                              lambda: self.watcher.wait(0))
+            timeout = None
+        else:
+            timeout = self.watcher.pollPeriod
+        try:
+            self.queueFiles()
+            while self.running:
+                for key, events in selector.select(timeout):
+                    key.data()
+                if not self.watcher.usingInotify:
+                    self.watcher.scan()
+                self.queueFiles()
+        finally:
+            self.running = False
+            self.engine.stop()
+            if self.mixer is not None:
+                self.mixWake.set()
+            player.join()
+            selector.close()
+            self.sock.close()
+            if self.mixer is not None:
+                self.mixer.close()
+            self.engine.close()
+            self.watcher.close()
 
-        # Sort files by created date
-        files.sort(key=lambda f: getmtime(join(audio_queue, f)))
 
-        for file in files:
-            # Play audio file
-            system(f"aplay {audio_queue}/{file}")
-            # Move out of queue
-            system(f"mv {audio_queue}/{file} {audio_store}/{file}")
-            sleep(0.2)
-            
-    sleep(0.2)
+def runPlaybackServer(usePolling:bool=False, cacheBytes:int=16*1024*1024, mix:bool=False):
+    PlaybackServer(usePolling, cacheBytes, mix=mix).run()
 
 
 if __name__ == '__main__':
-    runPlaybackServer()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Robot audio playback server")
+    parser.add_argument("--poll", action="store_true",
+                        help="scan the queue folder for files instead of using inotify")
+    parser.add_argument("--cache-size", type=float, default=16,
+                        help="memory (MB) used to keep decoded clips for replaying")
+    parser.add_argument("--prerender", metavar="PHRASEBOOK",
+                        help="generate the speech for a phrasebook file and exit")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="number of phrases to generate at once (default: CPU count)")
+    parser.add_argument("--mix", action="store_true",
+                        help="mix clips together so sounds can overlap")
+    args = parser.parse_args()
+    if args.prerender:
+        prerenderPhrasebook(args.prerender, args.jobs)
+    else:
+        runPlaybackServer(args.poll, int(args.cache_size * 1024 * 1024), args.mix)
@@ -11,6 +11,14 @@ from inventorhatmini.plasma import Plasma
 class Robot(RobotInterface):
     _instance = None
 
+    # Robot dimensions used for odometry, measure these for your robot
+    GEAR_RATIO = 50                             # The gear ratio of the motors
+    ENCODER_CPR = 12                            # Encoder counts per revolution of the motor shaft
+    WHEEL_DIAMETER = 0.036                      # Diameter of the track drive sprockets (metres)
+    TRACK_WIDTH = 0.105                         # Distance between the centres of the tracks (metres)
+    MAX_WHEEL_SPEED = 10.0                      # Wheel revolutions per second at full power
+    SPEED_PID_GAINS = (5.0, 20.0, 0.0)          # Speed control kp, ki, kd (percent power per rev/s)
+
     """ Prevent multiple instances of robot class in same program """
     def __new__(cls, *args, **kwargs):
         if cls._instance is None:
@@ -23,11 +31,8 @@ class Robot(RobotInterface):
         the withSudo argument = True
     """
     def __init__(self, withSudo = False):
-        # Constants
-        GEAR_RATIO = 50                         # The gear ratio of the motors
-        
         # Create a new InventorHATMini (this will init the LEDs so needs sudo privileges)
-        self.board = InventorHATMini(motor_gear_ratio=GEAR_RATIO,init_leds=withSudo)
+        self.board = InventorHATMini(motor_gear_ratio=self.GEAR_RATIO,init_leds=withSudo)
 
         # Access the motors from Inventor and enable them
         self.m1 = self.board.motors[MOTOR_A]
@@ -77,6 +82,20 @@ class Robot(RobotInterface):
         #set the power for each motor
         self.m1.speed(-leftMotor/100)
         self.m2.speed(rightMotor/100)
+
+    def getMaxMotorChangeRate(self) -> float:
+        """
+            Returns the fastest the motor power should be changed, in percent
+            of full power per second.
+        """
+        return 2000.0
+
+    def getMinMotorPower(self) -> int:
+        """
+            Returns the lowest percentage of motor power needed to turn the
+            motors.
+        """
+        return 10
     
     def getEncoderCount(self, motorIndex: int) -> int:
         """
@@ -97,6 +116,40 @@ class Robot(RobotInterface):
             
         return capture
 
+    def getEncoderCounts(self) -> tuple:
+        """
+            Read the positions of the left and right encoders together,
+            reading just the count from each encoder.
+        """
+        return (self.enc1.count(), self.enc2.count())
+
+    def getEncoderDirections(self) -> tuple:
+        """
+            The left motor is mounted reversed (see setMotorsPower), so its
+            encoder counts down when driving forwards
+        """
+        return (-1, 1)
+
+    def getEncoderCountsPerRev(self) -> float:
+        """ Returns the encoder counts for one revolution of the wheels """
+        return self.ENCODER_CPR * self.GEAR_RATIO
+
+    def getWheelDiameter(self) -> float:
+        """ Returns the diameter of the track drive sprockets in metres """
+        return self.WHEEL_DIAMETER
+
+    def getTrackWidth(self) -> float:
+        """ Returns the distance between the centres of the tracks in metres """
+        return self.TRACK_WIDTH
+
+    def getMaxWheelSpeed(self) -> float:
+        """ Returns the wheel speed in revolutions per second at full motor power """
+        return self.MAX_WHEEL_SPEED
+
+    def getSpeedPIDGains(self) -> tuple:
+        """ Returns the (kp, ki, kd) gains for closed loop wheel speed control """
+        return self.SPEED_PID_GAINS
+
     def keepAlive(self):
         """ 
             Keep robot alive. This is a watchdog method to tell the robot
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""
+    Virtual implementation of the Universal Robot interface, for running and
+    testing robot programs without any robot hardware.
+
+    The robot is simulated in memory: a differential drive (tank steering)
+    robot with two motors which take time to reach the speed set by the
+    motor power, encoders on both wheels, a battery which runs down and
+    whose voltage sags under load (slowing the motors), and a strip of RGB
+    LEDs. Nothing is drawn on screen; the state of the robot is in the
+    attributes of the class (x, y, heading, wheel speeds, LED colours).
+
+    The simulation is advanced to the current time whenever the program
+    talks to the robot. By default it uses the real time, so a program runs
+    just as it would on a robot. Pass in a VirtualClock to run faster than
+    real time: the clock only moves forward when the program sleeps, so a
+    LoopScheduler using it runs as fast as the CPU allows, and the same
+    program always produces the same results.
+
+        clock = VirtualClock()
+        robot = Robot(clock=clock)
+        scheduler = LoopScheduler(100, clock=clock, sleep=clock.sleep)
+
+    When using a virtual clock, read the battery from a scheduled task
+    (BatteryMonitor.sample) rather than starting the monitor thread, which
+    waits in real time.
+"""
+import math
+import random
+import time
+from robotinterface import RobotInterface
+
+
+class VirtualClock:
+    """
+        Clock which only moves forward when sleep() or advance() is called.
+        Call the clock to get the current time in seconds, like time.monotonic.
+    """
+    def __init__(self, start: float = 0.0):
+        self.time = start
+
+    def __call__(self) -> float:
+        return self.time
+
+    def sleep(self, seconds: float):
+        if seconds > 0:
+            self.time += seconds
+
+    advance = sleep
+
+
+class Robot(RobotInterface):
+    # Robot dimensions and motor characteristics, similar to a small tracked robot
+    ENCODER_CPR = 12                            # Encoder counts per revolution of the motor shaft
+    GEAR_RATIO = 50                             # The gear ratio of the motors
+    WHEEL_DIAMETER = 0.036                      # Diameter of the wheels (metres)
+    TRACK_WIDTH = 0.105                         # Distance between the centres of the wheels (metres)
+    MAX_WHEEL_SPEED = 10.0                      # Wheel revolutions per second at full power on a full battery
+    MOTOR_TIME_CONSTANT = 0.1                   # Seconds for a motor to reach 63% of a change in speed
+    MIN_MOTOR_POWER = 10                        # Power below which the motors do not turn
+    LED_COUNT = 8
+
+    # Battery (2 cell LiPo)
+    BATTERY_CAPACITY = 1.0                      # Amp hours
+    BATTERY_FULL_VOLTAGE = 8.2                  # Voltage when fully charged, with no load
+    BATTERY_EMPTY_VOLTAGE = 6.6                 # Voltage when flat, with no load
+    BATTERY_RESISTANCE = 0.25                   # Internal resistance (ohms), which makes the voltage sag under load
+    IDLE_CURRENT = 0.3                          # Amps drawn by the computer and electronics
+    MOTOR_CURRENT = 0.8                         # Amps drawn by each motor at full power
+
+    def __init__(self, clock=time.monotonic, charge: float = 1.0, maxStep: float = 0.01,
+                 busLatency: float = 0.0, sleep=None, watchdogTimeout: float = None,
+                 voltageNoise: float = 0.0, seed: int = 0):
+        """
+            clock is the time source (time.monotonic or a VirtualClock).
+            charge is the starting battery charge (0 to 1). The motion is
+            simulated in steps of at most maxStep seconds. busLatency is the
+            time taken by each call to the robot hardware, which is slept
+            with sleep (the VirtualClock sleep if clock is a VirtualClock).
+            If watchdogTimeout is set, the motors stop when keepAlive() has
+            not been called for that many seconds. voltageNoise is the
+            standard deviation of noise added to battery readings.
+        """
+        self.clock = clock
+        if sleep is None:
+            sleep = clock.sleep if isinstance(clock, VirtualClock) else time.sleep
+        self.sleep = sleep
+        self.maxStep = maxStep
+        self.busLatency = busLatency
+        self.watchdogTimeout = watchdogTimeout
+        self.voltageNoise = voltageNoise
+        self.random = random.Random(seed)
+
+        self.simTime = clock()
+        self.lastKeepAlive = self.simTime
+        self.charge = charge
+
+        # Motor powers set by the program, and the powers the motors are running at
+        self.powers = [0, 0]
+        self.watchdogTripped = False
+
+        # Wheel speeds (revolutions per second) and positions (revolutions)
+        self.wheelSpeeds = [0.0, 0.0]
+        self.wheelPositions = [0.0, 0.0]
+
+        # Position of the robot (metres) and heading (radians, anticlockwise)
+        self.x = 0.0
+        self.y = 0.0
+        self.heading = 0.0
+        self.distance = 0.0
+
+        self.ledColours = [(0, 0, 0)] * self.LED_COUNT # Colours set, shown on the next showLEDs
+        self.ledsShown = [(0, 0, 0)] * self.LED_COUNT
+        self.ledShows = 0
+
+        # Count of calls which would use the bus to the hardware on a real robot
+        self.busCalls = 0
+
+    def busCall(self):
+        """ Count a call to the robot hardware, and bring the simulation up to date """
+        self.busCalls += 1
+        if self.busLatency > 0:
+            self.sleep(self.busLatency)
+        self.update()
+
+    # Simulation
+
+    def current(self) -> float:
+        """ Current drawn from the battery in amps """
+        load = sum(abs(p) for p in self.activePowers()) / 100
+        return self.IDLE_CURRENT + self.MOTOR_CURRENT * load
+
+    def openCircuitVoltage(self) -> float:
+        return self.BATTERY_EMPTY_VOLTAGE + (self.BATTERY_FULL_VOLTAGE - self.BATTERY_EMPTY_VOLTAGE) * self.charge
+
+    def batteryVoltage(self) -> float:
+        """ Battery voltage under the present load """
+        return max(self.openCircuitVoltage() - self.current() * self.BATTERY_RESISTANCE, 0.0)
+
+    def activePowers(self):
+        if self.watchdogTripped:
+            return (0, 0)
+        return self.powers
+
+    def targetSpeed(self, power: float, voltage: float) -> float:
+        """ Wheel speed a motor power settles at, at a battery voltage """
+        if abs(power) < self.MIN_MOTOR_POWER:
+            return 0.0
+        return power / 100 * self.MAX_WHEEL_SPEED * voltage / self.BATTERY_FULL_VOLTAGE
+
+    def update(self):
+        """ Advance the simulation to the current time """
+        now = self.clock()
+        while self.simTime < now:
+            dt = min(self.maxStep, now - self.simTime)
+            self.step(dt)
+            self.simTime += dt
+
+    def step(self, dt: float):
+        if self.watchdogTimeout is not None and self.simTime - self.lastKeepAlive > self.watchdogTimeout:
+            self.watchdogTripped = True
+
+        voltage = self.batteryVoltage()
+        current = self.current()
+        tau = self.MOTOR_TIME_CONSTANT
+        decay = math.exp(-dt / tau)
+        moved = [0.0, 0.0]
+        for i, power in enumerate(self.activePowers()):
+            # First order lag towards the speed for the motor power
+            target = self.targetSpeed(power, voltage)
+            start = self.wheelSpeeds[i]
+            self.wheelSpeeds[i] = target + (start - target) * decay
+            moved[i] = target * dt + (start - target) * tau * (1 - decay)
+            self.wheelPositions[i] += moved[i]
+
+        # Move along the average heading over the step
+        metresPerRev = math.pi * self.WHEEL_DIAMETER
+        distLeft = moved[0] * metresPerRev
+        distRight = moved[1] * metresPerRev
+        dist = (distLeft + distRight) / 2
+        dHeading = (distRight - distLeft) / self.TRACK_WIDTH
+        midHeading = self.heading + dHeading / 2
+        self.x += dist * math.cos(midHeading)
+        self.y += dist * math.sin(midHeading)
+        self.heading = (self.heading + dHeading + math.pi) % (2 * math.pi) - math.pi
+        self.distance += abs(dist)
+
+        self.charge = max(self.charge - current * dt / 3600 / self.BATTERY_CAPACITY, 0.0)
+
+    def pose(self) -> tuple:
+        """ Returns the true position of the robot (x, y, heading) """
+        self.update()
+        return (self.x, self.y, self.heading)
+
+    # Robot interface
+
+    def shutdownHardware(self):
+        self.powers = [0, 0]
+        self.setLEDsAllOff()
+        self.showLEDs()
+
+    def getRobotName(self) -> str:
+        return "Virtual Robot"
+
+    def setMotorPower(self, motorIndex: int, power: int):
+        self.busCall()
+        if motorIndex in (0, 1):
+            self.powers[motorIndex] = min(max(power, -100), 100)
+
+    def setMotorsPower(self, leftMotor: int, rightMotor: int):
+        self.busCall()
+        self.powers = [min(max(leftMotor, -100), 100), min(max(rightMotor, -100), 100)]
+
+    def getMinMotorPower(self) -> int:
+        return self.MIN_MOTOR_POWER
+
+    def getEncoderCount(self, motorIndex: int) -> int:
+        self.busCall()
+        return math.floor(self.wheelPositions[motorIndex] * self.getEncoderCountsPerRev())
+
+    def getEncoderCounts(self) -> tuple:
+        self.busCall()
+        countsPerRev = self.getEncoderCountsPerRev()
+        return (math.floor(self.wheelPositions[0] * countsPerRev),
+                math.floor(self.wheelPositions[1] * countsPerRev))
+
+    def getEncoderCountsPerRev(self) -> float:
+        return self.ENCODER_CPR * self.GEAR_RATIO
+
+    def getWheelDiameter(self) -> float:
+        return self.WHEEL_DIAMETER
+
+    def getTrackWidth(self) -> float:
+        return self.TRACK_WIDTH
+
+    def getMaxWheelSpeed(self) -> float:
+        return self.MAX_WHEEL_SPEED
+
+    def keepAlive(self):
+        self.busCall()
+        self.feedWatchdog()
+
+    def feedWatchdog(self):
+        """
+            Restart the watchdog timeout. After a trip the motors come back
+            at zero power, so they only move again once new powers are set.
+        """
+        self.lastKeepAlive = self.simTime
+        if self.watchdogTripped:
+            self.watchdogTripped = False
+            self.powers = [0, 0]
+
+    def getBatteryVoltage(self) -> float:
+        self.busCall()
+        voltage = self.batteryVoltage()
+        if self.voltageNoise:
+            voltage += self.random.gauss(0, self.voltageNoise)
+        return voltage
+
+    def getLEDCount(self) -> int:
+        return self.LED_COUNT
+
+    def setLEDColor(self, ledIdx: int, red: int, green: int, blue: int):
+        self.busCall()
+        self.ledColours[ledIdx] = (red, green, blue)
+
+    def showLEDs(self):
+        self.busCall()
+        self.ledsShown = list(self.ledColours)
+        self.ledShows += 1
+
+    def setAllLEDsColor(self, red: int, green: int, blue: int):
+        self.busCall()
+        self.ledColours = [(red, green, blue)] * self.LED_COUNT
+        self.showLEDs()
+
+    def setLEDsAllOff(self):
+        self.busCall()
+        self.ledColours = [(0, 0, 0)] * self.LED_COUNT
+
+    def commitFrame(self, frame):
+        """
+            Apply all the commands in a frame, counting the frame as a single
+            bus transfer as a hardware class combining them would
+        """
+        self.busCall()
+        # The keep alive is applied first, so motor powers in the same frame are kept after a trip
+        if frame.keepAlive:
+            self.feedWatchdog()
+        if 0 in frame.motors:
+            self.powers[0] = min(max(frame.motors[0], -100), 100)
+        if 1 in frame.motors:
+            self.powers[1] = min(max(frame.motors[1], -100), 100)
+        if frame.ledFill is not None:
+            self.ledColours = [frame.ledFill] * self.LED_COUNT
+        for ledIdx, colour in frame.leds.items():
+            self.ledColours[ledIdx] = colour
+        if frame.show:
+            self.ledsShown = list(self.ledColours)
+            self.ledShows += 1
+
+        countsPerRev = self.getEncoderCountsPerRev()
+        for motorIndex in frame.encoderReads:
+            frame.encoderCounts[motorIndex] = math.floor(self.wheelPositions[motorIndex] * countsPerRev)
+        if frame.batteryRead:
+            frame.batteryVoltage = self.batteryVoltage()
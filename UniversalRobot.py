@@ -7,135 +7,175 @@
     in the main program loop. Stick mixing is done using an trig based algorithm designed
     by Footleg. The hardware interface is used to import a Robot class for the hardware of
     your actual robot. This is assumed to have a pair of motors, and a set of RGB LEDs.
+    UniversalRobotAsync.py is a version of this program which runs each job as a
+    separate asyncio task.
 """
 import pygame #random
-import math
-from time import sleep
-from os import system
+from time import sleep, monotonic
+from os import system, environ
+from os.path import join, dirname, abspath
 from pygamecontroller import RobotController
-#from RobotHardware_Virtual import Robot
-from RobotHardware_InventorHATmini import Robot
+from scheduler import LoopScheduler
+from motorcontrol import MotorPipeline
+from robotstatus import RobotStatus
+from ledframebuffer import LEDFrameBuffer
+from ledanimation import LEDAnimator, ScannerEffect, BlinkEffect, batteryColour
+from batterymonitor import BatteryMonitor
+from odometry import Odometry
+from speedcontrol import WheelSpeedController
+from telemetry import TelemetryRecorder
+from instrumentation import InstrumentedRobot
+from hardwareio import ThreadedRobot
+# Set ROBOT_HARDWARE=virtual in the environment to run on the simulated robot
+if environ.get("ROBOT_HARDWARE") == "virtual":
+    from RobotHardware_Virtual import Robot
+else:
+    from RobotHardware_InventorHATmini import Robot
 
 #Initialise global variables
-maxMChangeRate = 20.0
+controlRate = 100 # Frequency (Hz) the controller is read and motor powers updated
+ledUpdatePeriod = 0.05 # Seconds between LED animation frames
+battReadPeriod = 0.2 # Seconds between battery voltage readings when motors are off
+battDisplayPeriod = 2.0 # Seconds between updates of the battery level colour
+displayPeriod = 0.2 # Seconds between updates of the status message shown by the controller
+odometryPeriod = 0.02 # Seconds between encoder readings used to track the robot position
+closedLoopSpeed = False # Use the encoders to control the wheel speeds (on robots with encoders)
+telemetryFile = join(dirname(abspath(__file__)), "telemetry.bin") # Recording of the last few minutes of driving
+telemetryFlushPeriod = 0.5 # Seconds between writes of the telemetry records to the file
+instrumentDumpPeriod = 10.0 # Seconds between summaries of the hardware call times (when ROBOT_INSTRUMENT=1)
 
 power = 0
 turn = 0
-minMovingSpeed = 10 #Set to the lowest percentage of motor power needed to turn the motors
-message = ""
+status = RobotStatus() # Latest state of the control loop, only formatted as text when displayed
 battPowerColour = (0,255,255) # This will get updated to colour indicating battery level
-ledPos = 0 #Position of LED scanning cursor used for animation
-ledDir = 1 #Direction LED scanning cursor is moving
+battShownPercent = None # Battery charge the colour is showing
+battColourStep = 5 # Change in battery charge (percent) needed to change the colour
 shutdownFlag1 = False
 shutdownFlag2 = False
 shutdownFlag3 = False
 
-# Globals used to track the actual applied motor speeds, so changes can be dampened to protect them
-realLM = 0.0
-realRM = 0.0
-
 # Sets amount speed is divided by to make turns less twitchy
 defaultSpeedDampening = 1.3 #1=full batt. voltage, 2=half max speed
 slowModeSpeedDampening = 3 #2=half speed, 3=third max speed
 speedDampening = defaultSpeedDampening
 
-# Create robot hardware instance
-robot = Robot()
+# The robot hardware, and the modules driving it, are created by initRobot()
+robot = None
+instrumented = None
+frame = leds = animator = scanner = battery = odometry = speedControl = motors = telemetry = None
+
+
+def initRobot(clock=monotonic):
+    """Create the robot hardware and the modules which drive it. clock is the time source for
+       all of them, so a program can run the simulated robot on a VirtualClock (from
+       RobotHardware_Virtual) faster than real time. The I/O thread waits in real time, so it is
+       only used with the real clock."""
+    global robot, instrumented, frame, leds, animator, scanner, battery, odometry, speedControl, motors, telemetry
+
+    # Create robot hardware instance (only the simulated robot runs on another clock)
+    robot = Robot() if clock is monotonic else Robot(clock=clock)
+    # Set ROBOT_INSTRUMENT=1 in the environment to time every call to the robot hardware
+    instrumented = InstrumentedRobot(robot) if environ.get("ROBOT_INSTRUMENT") else None
+    if instrumented is not None:
+        robot = instrumented
+    # All the hardware transfers are made on a separate thread, so slow LED updates, encoder reads and
+    # battery reads do not hold up the control loop, which only reads the latest values. Set
+    # ROBOT_IO_THREAD=0 in the environment to make the transfers from the control loop instead.
+    if environ.get("ROBOT_IO_THREAD", "1") != "0" and clock is monotonic:
+        robot = ThreadedRobot(robot, encoderPeriod=odometryPeriod, batteryPeriod=battReadPeriod)
+
+    # Commands for the robot are collected in a frame and sent to the hardware together once per tick
+    frame = robot.beginFrame()
+
+    # LED colours are drawn here, and only LEDs which change are sent to the robot
+    leds = LEDFrameBuffer(robot, output=frame, clock=clock)
+
+    # LED animations are rendered to frames in advance, and played by a scheduled task
+    animator = LEDAnimator(leds)
+    scanner = ScannerEffect(leds.count, battPowerColour, ledUpdatePeriod) # 3 LED long Larson scanner bar
+
+    # Battery readings are taken by a scheduled task, only when motors are off (as the voltage drops under
+    # load). With the I/O thread this takes its latest reading, so the control loop never waits for the ADC.
+    battery = BatteryMonitor(robot, battReadPeriod, minVoltage=6.5, maxVoltage=8.0,
+                             sampleWhen=lambda: power == 0 and turn == 0, clock=clock)
+
+    # Tracks wheel speeds and robot position from the encoders (if the robot has them)
+    odometry = Odometry(robot, clock=clock)
+
+    # Mixes the power and turn demands into motor powers, and dampens changes to protect the motors.
+    # With closed loop speed control, the motor powers are wheel speeds (percent of full speed)
+    # which the speed controller holds using the encoders.
+    if closedLoopSpeed and odometry.available:
+        speedControl = WheelSpeedController(robot, odometry, 1/odometryPeriod, output=frame)
+        motors = MotorPipeline(robot, minMovingSpeed=0, output=speedControl)
+    else:
+        speedControl = None
+        motors = MotorPipeline(robot, output=frame)
 
-def showBatteryStatus(v=0):
-    global battPowerColour
+    # Records the control loop state every tick (kept in memory until main() opens the file)
+    telemetry = TelemetryRecorder()
 
-    #Show battery level when using default speed
-    # Display charge level
-    BATT_MIN = 6.5
-    BATT_MAX = 8.0
-    battery_voltage = v
-    r = 120
-    g = 60
-    if v == 0 :
-        battery_voltage = robot.getBatteryVoltage()
-        
-    if battery_voltage > 0:
-        batt_percent = 100 * (battery_voltage - BATT_MIN) / (BATT_MAX - BATT_MIN)
-        if batt_percent > 100:
-            batt_percent = 100
-        elif batt_percent < 0:
-            batt_percent = 0
-        r = int(120 - 1.2 * batt_percent)
-        g = int(batt_percent)
-    battPowerColour = (r, g, 0)
-    print(f"Motor supply voltage: {battery_voltage:.2f} Colour: {battPowerColour}")
-
-def motorSpeed():
-    global power, turn, realLM, realRM, message
 
-    # To reduce stress on the motors we take the power and turn inputs from the driver
-    ### New trig based motor power mixing ###
-    
-    # Power and Steer values create vector. Calculate angle of the vector
-    vAngle = math.atan2(turn,power)
-    
-    # Calculate scale factor to keep vector within bounds of circle
-    if abs(power) > abs(turn):
-        scaleFactor = math.cos(vAngle)
-    else:
-        scaleFactor = math.sin(vAngle)
-        
-    scaleFactor = scaleFactor * scaleFactor * 100
-    
-    adjPower = power * scaleFactor 
-    adjturn = turn * scaleFactor
-    lm = adjPower + adjturn
-    rm = adjPower - adjturn
-    
-    # Control speed of change of motor powers to prevent stressing gearboxes with sudden changes
-    if abs(realLM - lm) > maxMChangeRate:
-        if realLM > lm:
-            realLM = realLM - maxMChangeRate
-        else:
-            realLM = realLM + maxMChangeRate
-    else:
-        realLM = lm
+def showBatteryStatus():
+    global battPowerColour, battShownPercent
 
-    if abs(realRM - rm) > maxMChangeRate:
-        if realRM > rm:
-            realRM = realRM - maxMChangeRate
-        else:
-            realRM = realRM + maxMChangeRate
+    #Show battery level when using default speed
+    # Display charge level from the latest battery readings. The colour only follows the charge once
+    # it has moved by battColourStep, so noise in the readings does not make it flicker.
+    if battery.available:
+        if battShownPercent is None or abs(battery.percent - battShownPercent) >= battColourStep:
+            battShownPercent = battery.percent
+        colour = batteryColour(battShownPercent)
     else:
-        realRM = rm
+        battShownPercent = None
+        colour = (120, 60, 0)
+    status.batteryVoltage = battery.voltage
+    if colour != battPowerColour:
+        battPowerColour = colour
+        print(f"Motor supply voltage: {battery.voltage:.2f} Colour: {battPowerColour}")
+
+def motorSpeed(dt):
+    # To reduce stress on the motors we take the power and turn inputs from the driver
+    # and limit how fast the motor powers can change over time
+    motors.update(power, turn, dt)
+
+    status.setMotors(motors.lm, motors.rm, motors.realLM, motors.realRM)
+
+
+def playAnimation(effect):
+    """Play an LED effect which does not loop until it finishes, when nothing else is running"""
+    player = LoopScheduler(controlRate)
 
-    #set the real power for each motor
-    robot.setMotorsPower(int(realLM),int(realRM))
+    def animate(dt):
+        animator.tick(dt)
+        frame.flush()
+        if animator.finished:
+            player.stop()
 
-    message = f"P:{power:.2f},T:{turn:.2f},A:{vAngle*180/math.pi:.2f},SF:{scaleFactor:.2f},lm:{lm:.2f}/{realLM:.2f},rm:{rm:.2f}/{realRM:.2f}"
+    animator.play(effect, restart=True)
+    player.addTask(animate)
+    player.run()
 
 
 def initStatus(status):
     """Callback function which displays status during initialisation"""
     if status == 0 :
         print("Supported controller connected")
-        robot.setAllLEDsColor(0,0,255)
+        leds.fill(0,0,255)
+        leds.show()
     elif status < 0 :
         print("No supported controller detected")
-        for i in range(1,7):
-            robot.setAllLEDsColor(255,0,0)
-            sleep(0.25)
-            robot.setLEDsAllOff()
-            robot.showLEDs()
-            sleep(0.25)
+        playAnimation(BlinkEffect(leds.count, (255,0,0), 0.25, 0.25, repeats=6))
     else :
         print(f"Waiting for controller {status}")
-        if status < 9 :
-            robot.setLEDColor(status-1,96,0,96)
-        elif status < 17 :
-            robot.setLEDColor(status-9,96,96,0)
-        elif status < 25 :
-            robot.setLEDColor(status-17,160,80,0)
-        elif status < 33 :
-            robot.setLEDColor(status-25,164,2,2)
-
-        robot.showLEDs()
+        # Light up the LEDs one at a time, in a new colour each time along the LEDs
+        waitColours = ((96,0,96), (96,96,0), (160,80,0), (164,2,2))
+        if leds.count > 0 :
+            lap = (status-1) // leds.count
+            if lap < len(waitColours) :
+                leds.setPixel((status-1) % leds.count, *waitColours[lap])
+        leds.show()
+    frame.flush()
 
 
 def leftTrigChangeHandler(val):
@@ -212,16 +252,91 @@ def selectButtonHandler(btnState):
         shutdownFlag3 = False
 
 
+def updateLEDs(dt):
+    """Scheduled task to update the LED animation"""
+    if speedDampening == defaultSpeedDampening:
+        ledColour = battPowerColour
+    elif speedDampening == slowModeSpeedDampening:
+        ledColour = (0, 0, 100) # Show blue for slow (fine control) mode
+    else:
+        ledColour = (100, 0, 0) # Show red for full power (turbo) mode
+    scanner.setColour(ledColour)
+    animator.play(scanner)
+    animator.tick(dt)
+
+
+def updateBatteryStatus(dt):
+    """Scheduled task to update the battery level colour from the latest battery readings"""
+    showBatteryStatus()
+
+
+def addRobotTasks(scheduler, cnt):
+    """Add the robot control tasks to a scheduler. cnt is the controller, which calls the
+       handler functions when its controllerStatus() method is called each tick"""
+
+    def controlLoop(dt):
+        """Scheduled task run every tick to read the controller and drive the motors"""
+        # Trigger stick events and check for quit
+        keepRunning = cnt.controllerStatus()
+
+        # Send pulse to watchdog to keep motors alive
+        frame.sendKeepAlive()
+
+        status.setDemand(power, turn)
+        status.setShutdownFlags(shutdownFlag1, shutdownFlag2, shutdownFlag3)
+
+        motorSpeed(dt)
+
+        # Trigger exit if shutdown condition met
+        if shutdownFlag1 and shutdownFlag2 and shutdownFlag3:
+            keepRunning = False
+
+        if not keepRunning:
+            scheduler.stop()
+
+    def flushFrame(dt):
+        """Scheduled task run at the end of every tick to send the commands to the robot"""
+        frame.flush()
+
+    def updateDisplay(dt):
+        """Scheduled task to format the status message shown by the controller"""
+        cnt.message = str(status)
+
+    def recordTelemetry(dt):
+        """Scheduled task to record the state of the control loop"""
+        telemetry.record(scheduler.clock(), power, turn, motors.lm, motors.rm,
+                         motors.realLM, motors.realRM, odometry.lastLeft or 0, odometry.lastRight or 0,
+                         battery.voltage, scheduler.stats.lastWork)
+
+    scheduler.addTask(controlLoop)
+    scheduler.addTask(updateDisplay, displayPeriod)
+    scheduler.addTask(updateLEDs, ledUpdatePeriod)
+    scheduler.addTask(battery.sample, battReadPeriod)
+    scheduler.addTask(updateBatteryStatus, battDisplayPeriod)
+    if speedControl is not None:
+        scheduler.addTask(speedControl.update, odometryPeriod)
+    elif odometry.available:
+        scheduler.addTask(odometry.update, odometryPeriod)
+    scheduler.addTask(recordTelemetry)
+    scheduler.addTask(telemetry.flush, telemetryFlushPeriod)
+    scheduler.addTask(flushFrame)
+    if instrumented is not None:
+        scheduler.addTask(instrumented.dump, instrumentDumpPeriod)
+
+
 def main():
-    global message, ledPos, ledDir
     ## Check that required hardware is connected ##
 
     #Initialise the controller board
-
+    initRobot()
 
     #Run in try..finally structure so that program exits gracefully on hitting any
     #errors in the callback functions
+    scheduler = LoopScheduler(controlRate)
     try:
+        telemetry.openFile(telemetryFile, motors.maxChangeRate, motors.minMovingSpeed)
+        if isinstance(robot, ThreadedRobot):
+            robot.start()
         cnt = RobotController(robot.getRobotName(), initStatus,
                               leftTriggerChanged = leftTrigChangeHandler,
                               rightTriggerChanged = rightTrigChangeHandler,
@@ -233,85 +348,33 @@ def main():
                               squareBtnChanged = squareButtonHandler,
                               selectBtnChanged = selectButtonHandler)
 
+        addRobotTasks(scheduler, cnt)
+
         if cnt.initialised :
-            keepRunning = True
             #Indicate success here, we are ready to run
-            robot.setAllLEDsColor(0,255,0)
+            leds.fill(0,255,0)
+            leds.show()
+            frame.flush()
             sleep(1)
             showBatteryStatus()
-        else :
-            keepRunning = False
-
-        battReadInterval = 0
-        battReadCounter = 0
-        battV = 0
-        led1 = 2 #Brightness multiple for LED 1
-        led2 = 1 #Brightness multiple for LED 2
-        led3 = 0.5 #Brightness multiple for LED 3
-        ledUpdateInterval = 0
-        ledColour = battPowerColour
 
-        # -------- Main Program Loop -----------
-        while keepRunning == True :
-            cnt.message = message
-
-            # Trigger stick events and check for quit
-            keepRunning = cnt.controllerStatus()
-
-            # Send pulse to watchdog to keep motors alive
-            robot.keepAlive()
-
-            message = "Power={0:.2f}, Turn={1:.2f}".format(power,turn)
-            message = f"Power={power:.2f}, Turn={turn:.2f}, Shutdown({shutdownFlag1},{shutdownFlag2},{shutdownFlag3})"
-            
-            motorSpeed()
-
-            #Update LED animation
-            ledUpdateInterval += 1
-            if ledUpdateInterval > 1:
-                if speedDampening == defaultSpeedDampening:
-                    ledColour = battPowerColour
-                elif speedDampening == slowModeSpeedDampening:
-                    ledColour = (0, 0, 100) # Show blue for slow (fine control) mode
-                else:
-                    ledColour = (100, 0, 0) # Show red for full power (turbo) mode
-                ledUpdateInterval = 0
-                robot.setLEDsAllOff()
-                robot.setLEDColor(ledPos,  int(ledColour[0]*led1), int(ledColour[1]*led1), int(ledColour[2]*led1) )
-                ledPos2 = ledPos-ledDir
-                if -1 < ledPos2 < 8:
-                    robot.setLEDColor(ledPos2, int(ledColour[0]*led2), int(ledColour[1]*led2), int(ledColour[2]*led2) )
-                ledPos3 = ledPos2-ledDir
-                if -1 < ledPos3 < 8:
-                    robot.setLEDColor(ledPos3, int(ledColour[0]*led3), int(ledColour[1]*led3), int(ledColour[2]*led3) )
-                robot.showLEDs()
-                ledPos += ledDir
-                if ledPos > 7:
-                    ledDir = -1
-                    ledPos = 7
-                elif ledPos < 0:
-                    ledDir = 1
-                    ledPos = 0
-
-            # Read battery voltage no more often than 20 cycles and only when motors are off
-            battReadInterval += 1
-            if (battReadInterval > 20) and (power == 0) and (turn == 0):
-                # Add battery voltage to variable to average after 10 readings
-                battV = battV + robot.getBatteryVoltage()
-                battReadInterval = 0 # Reset so another read will happen in 20 cycles
-                battReadCounter = battReadCounter + 1
-                # Update voltage indicator with average voltage reading every 10 reads
-                if battReadCounter > 10:
-                    showBatteryStatus(battV/battReadCounter)
-                    battV = 0
-                    battReadCounter = 0
-
-            # Trigger exit if shutdown condition met
-            if shutdownFlag1 and shutdownFlag2 and shutdownFlag3:
-                keepRunning = False
+            # -------- Main Program Loop -----------
+            scheduler.run()
+            print(scheduler.summary())
+            print(leds.summary())
+            print(battery.summary())
+            print(odometry.summary())
+            if speedControl is not None:
+                print(speedControl.summary())
+            print(telemetry.summary())
+            if isinstance(robot, ThreadedRobot):
+                print(robot.summary())
+            if instrumented is not None:
+                print(instrumented.summary())
 
     finally:
         #Clean up and turn off Blinkt LEDs
+        telemetry.close()
         robot.shutdownHardware()
         pygame.quit()
 
@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+""" Asyncio version of the tank steering robot program in UniversalRobot.py.
+    The robot is driven the same way, but each job runs as a separate asyncio task
+    at its own rate: reading the controller, driving the motors, rendering the LEDs,
+    reading the battery, updating the status display and sending audio cues to the
+    audio server. Everything the tasks share is held in one RobotState object instead
+    of module globals, and the controller handlers are methods of that object.
+    The robot is wrapped in a ThreadedRobot (see hardwareio.py), so every bus transfer
+    (motor powers, LED updates, encoder and battery readings) is made on its one I/O
+    thread. The tasks only post values to it and read its latest snapshots, so they
+    never wait for the bus, and never use it at the same time as each other. The
+    state of the control loop is recorded to telemetry.bin as UniversalRobot.py does.
+    Timing statistics for every task are printed when the program exits.
+    Run it in place of UniversalRobot.py with: python3 UniversalRobotAsync.py
+"""
+import asyncio
+import pygame
+from collections import deque
+from os import system, environ
+from os.path import join, dirname, abspath
+from time import sleep, monotonic
+from pygamecontroller import RobotController
+from scheduler import LoopScheduler, LoopStats
+from motorcontrol import MotorPipeline
+from robotstatus import RobotStatus
+from ledframebuffer import LEDFrameBuffer
+from ledanimation import LEDAnimator, ScannerEffect, BlinkEffect, batteryColour
+from batterymonitor import BatteryMonitor
+from odometry import Odometry
+from speedcontrol import WheelSpeedController
+from audioclient import AudioClient
+from telemetry import TelemetryRecorder
+from hardwareio import ThreadedRobot
+# Set ROBOT_HARDWARE=virtual in the environment to run on the simulated robot
+if environ.get("ROBOT_HARDWARE") == "virtual":
+    from RobotHardware_Virtual import Robot
+else:
+    from RobotHardware_InventorHATmini import Robot
+
+# Task periods (seconds)
+inputPeriod = 0.01 # Controller events read
+motorPeriod = 0.01 # Motor powers updated and sent to the robot
+ledUpdatePeriod = 0.05 # LED animation frames
+battReadPeriod = 0.2 # Battery voltage readings when motors are off
+displayPeriod = 0.2 # Status message shown by the controller
+odometryPeriod = 0.02 # Encoder readings used to track the robot position
+cuePeriod = 0.1 # Audio cues sent to the audio server
+telemetryFlushPeriod = 0.5 # Telemetry records written to the file
+telemetryFile = join(dirname(abspath(__file__)), "telemetry.bin") # Recording of the last few minutes of driving
+closedLoopSpeed = False # Use the encoders to control the wheel speeds (on robots with encoders)
+lowBatteryPercent = 15 # Battery level the low battery warning is given at
+
+# Sets amount speed is divided by to make turns less twitchy
+defaultSpeedDampening = 1.3 #1=full batt. voltage, 2=half max speed
+slowModeSpeedDampening = 3 #2=half speed, 3=third max speed
+
+
+class RobotState:
+    """All the state shared between the robot tasks. The controller handlers update it."""
+    def __init__(self):
+        self.running = True
+        self.power = 0
+        self.turn = 0
+        self.speedDampening = defaultSpeedDampening
+        self.shutdownFlag1 = False
+        self.shutdownFlag2 = False
+        self.shutdownFlag3 = False
+        self.battPowerColour = (0,255,255) # Updated to a colour indicating battery level
+        self.batteryLowWarned = False
+        self.status = RobotStatus() # Latest state of the control loop
+        self.cues = deque() # Phrases waiting to be sent to the audio server
+
+    @property
+    def shutdownRequested(self):
+        return self.shutdownFlag1 and self.shutdownFlag2 and self.shutdownFlag3
+
+    def cue(self, text):
+        self.cues.append(text)
+
+    def leftTrigChangeHandler(self, val):
+        """Handler function for left analogue trigger"""
+        #Spin left at full speed
+        self.power = 0
+        self.turn = -(val+1)/2
+
+    def rightTrigChangeHandler(self, val):
+        """Handler function for right analogue trigger"""
+        #Spin right at full speed
+        self.power = 0
+        self.turn = (val+1)/2
+
+    def leftStickChangeHandler(self, valLR, valUD):
+        """Handler function for left analogue stick"""
+        self.power = -valUD/self.speedDampening
+
+    def rightStickChangeHandler(self, valLR, valUD):
+        """Handler function for right analogue stick"""
+        self.turn = valLR/self.speedDampening
+
+    def leftFrontBtn1Handler(self, val):
+        if val == 1 :
+            self.speedDampening = slowModeSpeedDampening # Slow mode
+            self.cue("Slow mode")
+        else :
+            self.speedDampening = defaultSpeedDampening
+
+    def rightFrontBtn1Handler(self, val):
+        if val == 1 :
+            self.speedDampening = 1 # Fast mode (full speed)
+            self.cue("Turbo")
+        else :
+            self.speedDampening = defaultSpeedDampening
+
+    def hatHandler(self, valLR, valUD):
+        """Handler function for hat 4 way controller"""
+        self.shutdownFlag1 = valUD == -1
+
+    def squareButtonHandler(self, btnState):
+        """Handler function for square button"""
+        self.shutdownFlag2 = btnState == 1
+
+    def selectButtonHandler(self, btnState):
+        """Handler function for select button"""
+        self.shutdownFlag3 = btnState == 1
+
+
+class PeriodicTask:
+    """Runs a callback every period seconds on the asyncio loop, recording its timing"""
+    def __init__(self, name, period, callback):
+        self.name = name
+        self.period = period
+        self.callback = callback
+        self.stats = LoopStats()
+
+    async def run(self, state):
+        loop = asyncio.get_running_loop()
+        nextRun = loop.time()
+        lastRun = nextRun
+        while state.running:
+            start = loop.time()
+            dt = start - lastRun
+            lastRun = start
+            # Callbacks which await slow I/O are coroutines
+            result = self.callback(dt)
+            if asyncio.iscoroutine(result):
+                await result
+            work = loop.time() - start
+            self.stats.record(max(start - nextRun, 0.0), work, work > self.period)
+
+            # Sleep until the next deadline, skipping any missed completely
+            nextRun += self.period
+            now = loop.time()
+            if nextRun < now:
+                nextRun = now
+            await asyncio.sleep(nextRun - now)
+
+    def summary(self):
+        return f"{self.name}: {self.stats.summary()}"
+
+
+class RobotRuntime:
+    """The robot hardware, and the tasks which drive it from the shared state"""
+    def __init__(self, state, robot):
+        self.state = state
+        self.robot = robot
+
+        # Motor and LED commands are collected in separate frames, so each task sends
+        # only its own commands
+        self.motorFrame = robot.beginFrame()
+        self.ledFrame = robot.beginFrame()
+        self.leds = LEDFrameBuffer(robot, output=self.ledFrame)
+        self.animator = LEDAnimator(self.leds)
+        self.scanner = ScannerEffect(self.leds.count, state.battPowerColour, ledUpdatePeriod)
+        self.battery = BatteryMonitor(robot, battReadPeriod, minVoltage=6.5, maxVoltage=8.0,
+                                      sampleWhen=lambda: state.power == 0 and state.turn == 0)
+        self.odometry = Odometry(robot)
+        if closedLoopSpeed and self.odometry.available:
+            self.speedControl = WheelSpeedController(robot, self.odometry, 1/odometryPeriod,
+                                                     output=self.motorFrame)
+            self.motors = MotorPipeline(robot, minMovingSpeed=0, output=self.speedControl)
+        else:
+            self.speedControl = None
+            self.motors = MotorPipeline(robot, output=self.motorFrame)
+        self.audio = AudioClient()
+        self.telemetry = TelemetryRecorder()
+        self.cnt = None
+        self.tasks = []
+
+    def playAnimation(self, effect):
+        """Play an LED effect which does not loop until it finishes (before the tasks start)"""
+        player = LoopScheduler(1/motorPeriod)
+
+        def animate(dt):
+            self.animator.tick(dt)
+            self.ledFrame.flush()
+            if self.animator.finished:
+                player.stop()
+
+        self.animator.play(effect, restart=True)
+        player.addTask(animate)
+        player.run()
+
+    def initStatus(self, status):
+        """Callback function which displays status during initialisation"""
+        leds = self.leds
+        if status == 0 :
+            print("Supported controller connected")
+            leds.fill(0,0,255)
+            leds.show()
+        elif status < 0 :
+            print("No supported controller detected")
+            self.playAnimation(BlinkEffect(leds.count, (255,0,0), 0.25, 0.25, repeats=6))
+        else :
+            print(f"Waiting for controller {status}")
+            # Light up the LEDs one at a time, in a new colour each time along the LEDs
+            waitColours = ((96,0,96), (96,96,0), (160,80,0), (164,2,2))
+            if leds.count > 0 :
+                lap = (status-1) // leds.count
+                if lap < len(waitColours) :
+                    leds.setPixel((status-1) % leds.count, *waitColours[lap])
+            leds.show()
+        self.ledFrame.flush()
+
+    def connectController(self):
+        state = self.state
+        self.cnt = RobotController(self.robot.getRobotName(), self.initStatus,
+                                   leftTriggerChanged = state.leftTrigChangeHandler,
+                                   rightTriggerChanged = state.rightTrigChangeHandler,
+                                   leftStickChanged = state.leftStickChangeHandler,
+                                   rightStickChanged = state.rightStickChangeHandler,
+                                   leftBtn1Changed = state.leftFrontBtn1Handler,
+                                   rightBtn1Changed = state.rightFrontBtn1Handler,
+                                   hatChanged = state.hatHandler,
+                                   squareBtnChanged = state.squareButtonHandler,
+                                   selectBtnChanged = state.selectButtonHandler)
+        return self.cnt.initialised
+
+    def readInput(self, dt):
+        """Task to read the controller, which calls the state handlers"""
+        state = self.state
+        keepRunning = self.cnt.controllerStatus()
+        state.status.setDemand(state.power, state.turn)
+        state.status.setShutdownFlags(state.shutdownFlag1, state.shutdownFlag2, state.shutdownFlag3)
+        if not keepRunning or state.shutdownRequested:
+            state.running = False
+
+    def controlMotors(self, dt):
+        """Task to update the motor powers and send them to the robot"""
+        state = self.state
+        self.motorFrame.sendKeepAlive()
+        self.motors.update(state.power, state.turn, dt)
+        state.status.setMotors(self.motors.lm, self.motors.rm, self.motors.realLM, self.motors.realRM)
+        self.motorFrame.flush()
+
+    def updateOdometry(self, dt):
+        """Task to read the encoders, and hold the wheel speeds with closed loop control"""
+        if self.speedControl is not None:
+            self.speedControl.update(dt)
+        else:
+            self.odometry.update(dt)
+
+    def renderLEDs(self, dt):
+        """Task to draw the next LED animation frame, and post it to the I/O thread"""
+        state = self.state
+        if state.speedDampening == defaultSpeedDampening:
+            ledColour = state.battPowerColour
+        elif state.speedDampening == slowModeSpeedDampening:
+            ledColour = (0, 0, 100) # Show blue for slow (fine control) mode
+        else:
+            ledColour = (100, 0, 0) # Show red for full power (turbo) mode
+        self.scanner.setColour(ledColour)
+        self.animator.play(self.scanner)
+        self.animator.tick(dt)
+        self.ledFrame.flush()
+
+    def sampleBattery(self, dt):
+        """Task to take the latest battery reading and update the battery level colour"""
+        self.battery.sample()
+        self.showBatteryStatus()
+
+    def showBatteryStatus(self):
+        state = self.state
+        battery = self.battery
+        # Display charge level from the latest battery readings
+        if battery.available:
+            colour = batteryColour(battery.percent)
+            if battery.percent < lowBatteryPercent and not state.batteryLowWarned:
+                state.batteryLowWarned = True
+                state.cue("Battery low")
+        else:
+            colour = (120, 60, 0)
+        state.status.batteryVoltage = battery.voltage
+        if colour != state.battPowerColour:
+            state.battPowerColour = colour
+            print(f"Motor supply voltage: {battery.voltage:.2f} Colour: {state.battPowerColour}")
+
+    def recordTelemetry(self, dt):
+        """Task to record the state of the control loop"""
+        state = self.state
+        motors = self.motors
+        self.telemetry.record(monotonic(), state.power, state.turn, motors.lm, motors.rm,
+                              motors.realLM, motors.realRM, self.odometry.lastLeft or 0,
+                              self.odometry.lastRight or 0, self.battery.voltage,
+                              self.motorTask.stats.lastWork)
+
+    def updateDisplay(self, dt):
+        """Task to format the status message shown by the controller"""
+        self.cnt.message = str(self.state.status)
+
+    def sendCues(self, dt):
+        """Task to send waiting audio cues to the audio server (without waiting for it)"""
+        cues = self.state.cues
+        while cues:
+            self.audio.speak(cues.popleft(), priority=1, ttl=3)
+
+    async def run(self):
+        self.motorTask = PeriodicTask("motors", motorPeriod, self.controlMotors)
+        self.tasks = [
+            PeriodicTask("input", inputPeriod, self.readInput),
+            self.motorTask,
+            PeriodicTask("leds", ledUpdatePeriod, self.renderLEDs),
+            PeriodicTask("battery", battReadPeriod, self.sampleBattery),
+            PeriodicTask("display", displayPeriod, self.updateDisplay),
+            PeriodicTask("audio", cuePeriod, self.sendCues),
+            PeriodicTask("telemetry", motorPeriod, self.recordTelemetry),
+            PeriodicTask("telemetry file", telemetryFlushPeriod, self.telemetry.flush),
+        ]
+        if self.speedControl is not None or self.odometry.available:
+            self.tasks.append(PeriodicTask("odometry", odometryPeriod, self.updateOdometry))
+        await asyncio.gather(*(task.run(self.state) for task in self.tasks))
+
+    def summary(self):
+        lines = [task.summary() for task in self.tasks]
+        lines += [self.leds.summary(), self.battery.summary(), self.odometry.summary()]
+        if self.speedControl is not None:
+            lines.append(self.speedControl.summary())
+        lines += [self.telemetry.summary(), self.robot.summary()]
+        return "\n".join(lines)
+
+    def close(self):
+        self.telemetry.close()
+        self.audio.close()
+
+
+def main():
+    state = RobotState()
+    # All the bus transfers are made on the I/O thread, reading the encoders at the odometry rate
+    robot = ThreadedRobot(Robot(), encoderPeriod=odometryPeriod, batteryPeriod=battReadPeriod)
+    runtime = RobotRuntime(state, robot)
+
+    #Run in try..finally structure so that program exits gracefully on hitting any
+    #errors in the tasks
+    try:
+        runtime.telemetry.openFile(telemetryFile, runtime.motors.maxChangeRate,
+                                   runtime.motors.minMovingSpeed)
+        robot.start()
+        if runtime.connectController():
+            #Indicate success here, we are ready to run
+            runtime.leds.fill(0,255,0)
+            runtime.leds.show()
+            runtime.ledFrame.flush()
+            state.cue("Ready")
+            sleep(1)
+
+            # -------- Run the robot tasks until shutdown -----------
+            asyncio.run(runtime.run())
+            print(runtime.summary())
+
+    finally:
+        #Clean up and turn off LEDs
+        runtime.close()
+        robot.shutdownHardware()
+        pygame.quit()
+
+        # Trigger shutdown if condition met
+        if state.shutdownRequested:
+            # Only works if running as sudo
+            system("shutdown now")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+    Audio server client
+
+    Copyright (C) 2023 Paul 'Footleg' Fretwell
+    Released under the GNU GPL v3 license
+    Code repo: https://github.com/Footleg/universal-robot
+
+    Sends requests to the audio server over a local Unix domain socket, so a
+    robot program can trigger sounds without writing files into the audio
+    queue folder and waiting for them to be noticed. Each request is a single
+    JSON datagram, sent without waiting for the server, so triggering a sound
+    never holds up the robot control loop. If the server is not running the
+    request is dropped and the call returns False.
+
+        audio = AudioClient()
+        audio.play("beep.wav", priority=5)   # Clip in the audio store folder
+        audio.speak("Battery low", ttl=5)    # Dropped if not started within 5s
+        audio.playCached("horn.wav")         # Only if already in server memory
+        audio.speak("Hello Footleg")
+        audio.play("hum.wav", loop=True)     # Loops until interrupted, when mixing
+        audio.interrupt()                    # Stop the clip playing now
+        audio.flush()                        # Clear the queue
+        print(audio.status())                # Waits for the reply
+
+    Higher priority requests are played first, and stop the clip playing if
+    it has a lower priority. A request for a clip already waiting in the
+    queue is merged with it rather than played twice. Requests given a ttl
+    (seconds) are dropped if they have not started playing in that time, so
+    stale messages are not played late.
+
+    The socket is in the Linux abstract namespace, so it needs no file on
+    disk and works whichever users the robot program and server run as.
+"""
+import json
+import socket
+
+SOCKET_ADDRESS = "\0universal-robot-audio"
+MAX_MESSAGE = 64 * 1024
+
+# Request commands
+PLAY = "play"
+PLAY_CACHED = "playCached"
+SPEAK = "speak"
+INTERRUPT = "interrupt"
+FLUSH = "flush"
+STATUS = "status"
+
+
+def encodeRequest(cmd: str, **fields) -> bytes:
+    fields["cmd"] = cmd
+    return json.dumps(fields).encode("utf-8")
+
+
+def decodeRequest(data: bytes) -> dict:
+    """ Returns the request in a datagram, or None if it is not a valid request """
+    try:
+        request = json.loads(data.decode("utf-8"))
+    except ValueError:
+        return None
+    if not isinstance(request, dict) or "cmd" not in request:
+        return None
+    return request
+
+
+# Fields of a request which must be text, and the types other fields are converted to
+TEXT_FIELDS = ("name", "text", "voice", "channel")
+NUMBER_FIELDS = {"priority": int, "boost": int, "ttl": float}
+
+
+def checkRequest(request: dict) -> dict:
+    """
+        Returns a request from a client with its numeric fields converted to
+        numbers, or None if any field has the wrong type, so a bad request
+        can be dropped before it reaches the queue
+    """
+    for field in TEXT_FIELDS:
+        if request.get(field) is not None and not isinstance(request[field], str):
+            return None
+    for field, convert in NUMBER_FIELDS.items():
+        if request.get(field) is not None:
+            try:
+                request[field] = convert(request[field])
+            except (TypeError, ValueError, OverflowError):
+                return None
+    return request
+
+
+class AudioClient:
+    def __init__(self, address: str = SOCKET_ADDRESS):
+        self.address = address
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        # Bind to an automatic abstract address so the server can reply to status requests
+        self.sock.bind("")
+        self.sock.setblocking(False)
+        self.dropped = 0
+
+    def send(self, cmd: str, **fields) -> bool:
+        """ Send a request without waiting. Returns False if it could not be sent. """
+        try:
+            self.sock.sendto(encodeRequest(cmd, **fields), self.address)
+            return True
+        except (FileNotFoundError, ConnectionRefusedError, BlockingIOError):
+            self.dropped += 1
+            return False
+
+    def play(self, name: str, priority: int = 0, ttl: float = None, channel: str = None,
+             loop: bool = False) -> bool:
+        """
+            Play a clip from the audio store folder. channel and loop are
+            only used when the server is mixing.
+        """
+        return self.send(PLAY, name=name, priority=priority, ttl=ttl, channel=channel, loop=loop)
+
+    def playCached(self, name: str, priority: int = 0, ttl: float = None, channel: str = None,
+                   loop: bool = False) -> bool:
+        """ Play a clip only if the server has it in memory, so no file is read """
+        return self.send(PLAY_CACHED, name=name, priority=priority, ttl=ttl, channel=channel, loop=loop)
+
+    def speak(self, text: str, voice: str = "kal", boost: int = 7, priority: int = 0,
+              ttl: float = None) -> bool:
+        """ Speak text, generating the speech if it is not already cached """
+        return self.send(SPEAK, text=text, voice=voice, boost=boost, priority=priority, ttl=ttl)
+
+    def interrupt(self, channel: str = None) -> bool:
+        """ Stop the clip playing now (or when mixing, the clips on a channel, or all channels if None) """
+        return self.send(INTERRUPT, channel=channel)
+
+    def flush(self) -> bool:
+        """ Remove everything waiting in the queue """
+        return self.send(FLUSH)
+
+    def status(self, timeout: float = 0.5) -> dict:
+        """ Ask the server for its status, waiting up to timeout seconds. Returns None if no reply. """
+        # Discard any late replies to earlier status requests
+        try:
+            while True:
+                self.sock.recv(MAX_MESSAGE)
+        except BlockingIOError:
+            pass
+        if not self.send(STATUS):
+            return None
+        self.sock.settimeout(timeout)
+        try:
+            return decodeRequest(self.sock.recv(MAX_MESSAGE))
+        except socket.timeout:
+            return None
+        finally:
+            self.sock.setblocking(False)
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+"""
+    Software audio mixer
+
+    Copyright (C) 2023 Paul 'Footleg' Fretwell
+    Released under the GNU GPL v3 license
+    Code repo: https://github.com/Footleg/universal-robot
+
+    Mixes several clips playing at the same time into one stream of 16 bit
+    PCM audio, so an engine hum, beeps and speech can all be heard together
+    through the one audio output. Each clip plays on a named channel, which
+    has its own gain and a limit on how many clips it plays at once. Clips
+    started on a channel which is already playing its limit wait for a clip
+    to finish, so a speech channel with a limit of one speaks each phrase in
+    turn while sound effects play over the top.
+
+    While a clip is playing on a ducking channel (normally speech), every
+    other channel is turned down to duckGain, so effects do not drown out
+    speech. The level ramps down and back up over duckTime seconds rather
+    than jumping, which would click.
+
+    Clips are converted to the mixer sample rate and channel count when they
+    are started, and mixed a short buffer at a time (256 frames, about 12ms
+    at 22050Hz by default) so new clips start quickly. Samples are summed
+    with gain into a wider accumulator and clipped to the 16 bit range, so
+    loud overlapping clips distort rather than wrap around. NumPy is used for
+    the mixing when it is installed, otherwise the standard library array
+    module is used, which is much slower but fine for one or two clips.
+
+    A clip can be played for a source (such as a queued request), which is
+    passed to the onFinished callback when the clip finishes or is stopped,
+    and can be given to stop() to stop just that clip. The audio server uses
+    this to keep requests in its priority queue until their channel has a
+    free voice, rather than queueing them on the channel.
+
+    The MixingEngine sends the mixed audio to a PlaybackEngine on its own
+    thread, writing only slightly ahead of real time so the output latency
+    stays close to the aplay buffer length.
+"""
+import sys
+import threading
+import time
+from array import array
+from collections import deque
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+SAMPLE_MIN = -32768
+SAMPLE_MAX = 32767
+
+
+def convertSamples(clip, rate: int, channels: int, useNumpy: bool = True):
+    """
+        Returns the samples of a PCMClip as 16 bit integers at the given
+        sample rate and channel count (a NumPy int16 array if useNumpy and
+        NumPy is installed, otherwise an array('h')). The rate is converted
+        by picking the nearest sample, which is good enough for robot sound
+        effects.
+    """
+    if clip.channels not in (1, 2) or channels not in (1, 2):
+        raise ValueError(f"Unsupported channel count {clip.channels}")
+    if useNumpy and np is not None:
+        if clip.sampleWidth == 2:
+            samples = np.frombuffer(clip.data, dtype="<i2").astype(np.int16)
+        elif clip.sampleWidth == 1:
+            samples = ((np.frombuffer(clip.data, dtype=np.uint8).astype(np.int16) - 128) << 8)
+        else:
+            raise ValueError(f"Unsupported sample width {clip.sampleWidth} bytes")
+        frames = samples.reshape(-1, clip.channels)
+        if clip.channels == 2 and channels == 1:
+            frames = (frames.astype(np.int32).sum(axis=1) // 2).astype(np.int16).reshape(-1, 1)
+        elif clip.channels == 1 and channels == 2:
+            frames = np.repeat(frames, 2, axis=1)
+        if clip.rate != rate:
+            count = len(frames) * rate // clip.rate
+            frames = frames[np.arange(count) * clip.rate // rate]
+        return np.ascontiguousarray(frames).reshape(-1)
+
+    if clip.sampleWidth == 2:
+        samples = array('h', clip.data)
+        if sys.byteorder == "big":
+            samples.byteswap()
+    elif clip.sampleWidth == 1:
+        samples = array('h', ((b - 128) << 8 for b in clip.data))
+    else:
+        raise ValueError(f"Unsupported sample width {clip.sampleWidth} bytes")
+    if clip.channels == 2 and channels == 1:
+        samples = array('h', ((samples[i] + samples[i + 1]) // 2 for i in range(0, len(samples) - 1, 2)))
+    elif clip.channels == 1 and channels == 2:
+        stereo = array('h', bytes(4 * len(samples)))
+        stereo[0::2] = samples
+        stereo[1::2] = samples
+        samples = stereo
+    if clip.rate != rate:
+        frameCount = len(samples) // channels
+        count = frameCount * rate // clip.rate
+        resampled = array('h', bytes(2 * count * channels))
+        for c in range(channels):
+            resampled[c::channels] = array('h', (samples[(i * clip.rate // rate) * channels + c]
+                                                 for i in range(count)))
+        samples = resampled
+    return samples
+
+
+class Voice:
+    """ A clip playing on a mixer channel """
+    __slots__ = ("name", "samples", "position", "loop", "source")
+
+    def __init__(self, name: str, samples, loop: bool = False, source=None):
+        self.name = name
+        self.samples = samples
+        self.position = 0
+        self.loop = loop
+        self.source = source
+
+
+class MixerChannel:
+    def __init__(self, name: str, gain: float = 1.0, voices: int = 8, ducks: bool = False):
+        """
+            gain is the channel volume (1.0 for full volume). voices is the
+            number of clips the channel plays at once. If ducks is True, the
+            other channels are turned down while this channel is playing.
+        """
+        self.name = name
+        self.gain = gain
+        self.maxVoices = voices
+        self.ducks = ducks
+        self.voices = []
+        self.waiting = deque()
+
+    @property
+    def active(self) -> bool:
+        return bool(self.voices)
+
+
+class Mixer:
+    def __init__(self, rate: int = 22050, channels: int = 1, bufferFrames: int = 256,
+                 duckGain: float = 0.3, duckTime: float = 0.1, useNumpy: bool = True):
+        """
+            Mixes clips to 16 bit audio at rate Hz with the given number of
+            channels (1 or 2), bufferFrames frames at a time.
+        """
+        self.rate = rate
+        self.channels = channels
+        self.bufferFrames = bufferFrames
+        self.bufferSamples = bufferFrames * channels
+        self.bufferTime = bufferFrames / rate
+        self.duckGain = duckGain
+        # Change in duck level per buffer, so a full duck takes duckTime seconds
+        self.duckStep = (1.0 - duckGain) * self.bufferTime / duckTime if duckTime > 0 else 1.0
+        self.duckLevel = 1.0
+        self.masterGain = 1.0
+        self.useNumpy = useNumpy and np is not None
+        self.mixChannels = {}
+        self.lock = threading.Lock()
+        self.silence = bytes(2 * self.bufferSamples)
+        if self.useNumpy:
+            self.accumulator = np.zeros(self.bufferSamples, dtype=np.float32)
+        self.buffersMixed = 0
+        self.clipped = 0
+        # Called with (channel name, source) when a clip played for a source finishes or is stopped
+        self.onFinished = None
+
+        self.addChannel("effects", voices=8)
+        self.addChannel("speech", voices=1, ducks=True)
+
+    def addChannel(self, name: str, gain: float = 1.0, voices: int = 8, ducks: bool = False) -> MixerChannel:
+        channel = MixerChannel(name, gain, voices, ducks)
+        with self.lock:
+            self.mixChannels[name] = channel
+        return channel
+
+    def setGain(self, channel: str, gain: float):
+        self.mixChannels[channel].gain = gain
+
+    @property
+    def active(self) -> bool:
+        return any(c.voices for c in self.mixChannels.values())
+
+    def play(self, clip, channel: str = "effects", loop: bool = False, source=None):
+        """
+            Start playing a PCMClip on a channel, or queue it on the channel
+            if the channel is already playing its limit of clips. A looped
+            clip plays until the channel is stopped. source is what the clip
+            is played for, passed to onFinished.
+        """
+        voice = Voice(clip.name, convertSamples(clip, self.rate, self.channels, self.useNumpy), loop, source)
+        with self.lock:
+            mixChannel = self.mixChannels[channel]
+            if len(mixChannel.voices) < mixChannel.maxVoices:
+                mixChannel.voices.append(voice)
+            else:
+                mixChannel.waiting.append(voice)
+
+    def stop(self, channel: str = None, source=None):
+        """
+            Stop the clips playing and waiting on a channel (all channels if
+            None), or only the clip played for source if it is given
+        """
+        stopped = []
+        with self.lock:
+            for mixChannel in self.mixChannels.values():
+                if channel is None or mixChannel.name == channel:
+                    for voices in (mixChannel.voices, mixChannel.waiting):
+                        keep = [v for v in voices if source is not None and v.source is not source]
+                        stopped += [(mixChannel.name, v.source) for v in voices if v not in keep]
+                        voices.clear()
+                        voices.extend(keep)
+        self.finished(stopped)
+
+    def finished(self, voices: list):
+        """ Call onFinished for each (channel name, source) of voices which had a source """
+        if self.onFinished is not None:
+            for channel, source in voices:
+                if source is not None:
+                    self.onFinished(channel, source)
+
+    def mix(self) -> bytes:
+        """ Mix the next buffer of audio, returned as 16 bit little endian PCM """
+        finished = []
+        with self.lock:
+            ducking = any(c.ducks and c.voices for c in self.mixChannels.values())
+            target = self.duckGain if ducking else 1.0
+            if self.duckLevel < target:
+                self.duckLevel = min(self.duckLevel + self.duckStep, target)
+            elif self.duckLevel > target:
+                self.duckLevel = max(self.duckLevel - self.duckStep, target)
+
+            parts = []
+            for mixChannel in self.mixChannels.values():
+                if not mixChannel.voices:
+                    continue
+                gain = mixChannel.gain * self.masterGain
+                if not mixChannel.ducks:
+                    gain *= self.duckLevel
+                for voice in mixChannel.voices:
+                    self.takeSamples(voice, gain, parts)
+                # Start waiting clips in place of any which have finished
+                finished += [(mixChannel.name, v.source) for v in mixChannel.voices
+                             if v.position >= len(v.samples)]
+                mixChannel.voices = [v for v in mixChannel.voices if v.position < len(v.samples)]
+                while mixChannel.waiting and len(mixChannel.voices) < mixChannel.maxVoices:
+                    mixChannel.voices.append(mixChannel.waiting.popleft())
+            self.buffersMixed += 1
+        if finished:
+            self.finished(finished)
+
+        if not parts:
+            return self.silence
+        if self.useNumpy:
+            return self.sumNumpy(parts)
+        return self.sumArray(parts)
+
+    def takeSamples(self, voice: Voice, gain: float, parts: list):
+        """ Add (offset, samples, gain) parts of a voice making up the next buffer to parts """
+        offset = 0
+        while offset < self.bufferSamples:
+            count = min(self.bufferSamples - offset, len(voice.samples) - voice.position)
+            if count > 0:
+                parts.append((offset, voice.samples[voice.position:voice.position + count], gain))
+                voice.position += count
+                offset += count
+            if voice.position >= len(voice.samples):
+                if not voice.loop or not len(voice.samples):
+                    return
+                voice.position = 0
+
+    def sumNumpy(self, parts: list) -> bytes:
+        acc = self.accumulator
+        acc.fill(0.0)
+        for offset, samples, gain in parts:
+            end = offset + len(samples)
+            if gain == 1.0:
+                acc[offset:end] += samples
+            else:
+                acc[offset:end] += samples * np.float32(gain)
+        self.clipped += int(np.count_nonzero((acc > SAMPLE_MAX) | (acc < SAMPLE_MIN)))
+        np.clip(acc, SAMPLE_MIN, SAMPLE_MAX, out=acc)
+        return acc.astype("<i2").tobytes()
+
+    def sumArray(self, parts: list) -> bytes:
+        acc = [0.0] * self.bufferSamples
+        for offset, samples, gain in parts:
+            for i, s in enumerate(samples, offset):
+                acc[i] += s * gain
+        out = array('h', bytes(2 * self.bufferSamples))
+        clipped = 0
+        for i, s in enumerate(acc):
+            if s > SAMPLE_MAX:
+                s = SAMPLE_MAX
+                clipped += 1
+            elif s < SAMPLE_MIN:
+                s = SAMPLE_MIN
+                clipped += 1
+            out[i] = int(s)
+        self.clipped += clipped
+        if sys.byteorder == "big":
+            out.byteswap()
+        return out.tobytes()
+
+    def summary(self) -> str:
+        playing = " ".join(f"{c.name}:{len(c.voices)}+{len(c.waiting)}" for c in self.mixChannels.values())
+        return (f"mixer {playing} buffers:{self.buffersMixed} clipped samples:{self.clipped} "
+                f"({'NumPy' if self.useNumpy else 'array'})")
+
+
+class MixingEngine:
+    def __init__(self, engine, mixer: Mixer = None, ahead: float = 0.03, clock=time.monotonic):
+        """
+            Sends mixed audio from mixer to a PlaybackEngine (engine) on a
+            background thread while any clips are playing. Audio is written
+            at most ahead seconds in front of real time, so the pipe to aplay
+            does not fill up with audio, which would delay new clips.
+        """
+        self.engine = engine
+        self.mixer = mixer if mixer is not None else Mixer()
+        self.ahead = ahead
+        self.clock = clock
+        self.wake = threading.Event()
+        self.running = False
+        self.thread = None
+        self.mixTime = 0.0
+        self.mixTimeMax = 0.0
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="Mixer", daemon=True)
+        self.thread.start()
+
+    def play(self, clip, channel: str = "effects", loop: bool = False, source=None):
+        self.mixer.play(clip, channel, loop, source)
+        self.wake.set()
+
+    def stop(self, channel: str = None, source=None):
+        self.mixer.stop(channel, source)
+
+    def run(self):
+        mixer = self.mixer
+        written = None      # Time of the end of the audio written so far
+        while self.running:
+            if not mixer.active:
+                # Let the output run dry and start a fresh timeline when the next clip starts
+                written = None
+                self.wake.wait(0.5)
+                self.wake.clear()
+                continue
+            now = self.clock()
+            if written is None or written < now:
+                written = now
+            elif written - now > self.ahead:
+                time.sleep(written - now - self.ahead)
+                continue
+
+            start = self.clock()
+            data = mixer.mix()
+            elapsed = self.clock() - start
+            self.mixTime += elapsed
+            self.mixTimeMax = max(self.mixTimeMax, elapsed)
+
+            self.engine.open(mixer.rate, mixer.channels, 2)
+            self.engine.write(data)
+            written += mixer.bufferTime
+
+    def close(self):
+        self.running = False
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.engine.close()
+
+    def summary(self) -> str:
+        mean = self.mixTime / self.mixer.buffersMixed if self.mixer.buffersMixed else 0.0
+        return (f"{self.mixer.summary()} mix time mean/max:{mean*1e6:.0f}/{self.mixTimeMax*1e6:.0f}us "
+                f"per {self.mixer.bufferTime*1000:.1f}ms buffer")
@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""
+    Audio playback engine
+
+    Copyright (C) 2023 Paul 'Footleg' Fretwell
+    Released under the GNU GPL v3 license
+    Code repo: https://github.com/Footleg/universal-robot
+
+    Plays audio clips through one long running aplay process, which reads raw
+    PCM audio from a pipe. The audio device stays open between clips, so
+    there is no process start up or device open delay before each clip, and
+    clips queued one after the other play back to back without gaps. The
+    process is only restarted if a clip has a different sample format to the
+    one before.
+
+    WAV files are decoded into memory with the wave module from the python
+    standard library, so the file can be moved out of the queue as soon as it
+    has been read, and the same decoded clip can be played again without
+    reading the file.
+
+    The aplay buffer is kept short so sound effects start quickly, and clips
+    are written to aplay only slightly ahead of real time (the same way the
+    MixingEngine in audiomixer.py writes), so audio does not build up in the
+    pipe. A new clip, or a clip started after the one playing is stopped,
+    is heard within the ahead time plus the aplay buffer, rather than after
+    up to 64KB of older audio waiting in the pipe. The pipe is also shrunk
+    to one page where Linux allows it. The time from being asked to play a
+    clip to its first samples being due at the speaker is recorded for each
+    clip.
+
+    Robots play the same few sounds over and over, so decoded clips are kept
+    in a ClipCache. This holds the most recently used clips in memory up to a
+    size limit, so repeated sounds play without reading the SD card again. A
+    set of frequently used clips can be loaded into the cache at start up.
+"""
+import subprocess
+import sys
+import threading
+import time
+import wave
+from collections import OrderedDict
+from os.path import join
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# aplay sample format names for each sample width in bytes
+SAMPLE_FORMATS = {1: "U8", 2: "S16_LE", 3: "S24_3LE", 4: "S32_LE"}
+F_SETPIPE_SZ = 1031     # fcntl command to set the size of a pipe (Linux), not named by fcntl before Python 3.10
+PIPE_SIZE = 4096
+
+
+class PCMClip:
+    """ Decoded audio: raw PCM sample data and its format """
+    __slots__ = ("name", "data", "rate", "channels", "sampleWidth")
+
+    def __init__(self, name: str, data: bytes, rate: int, channels: int, sampleWidth: int):
+        self.name = name
+        self.data = data
+        self.rate = rate
+        self.channels = channels
+        self.sampleWidth = sampleWidth
+
+    @property
+    def format(self) -> tuple:
+        return (self.rate, self.channels, self.sampleWidth)
+
+    @property
+    def frameSize(self) -> int:
+        return self.channels * self.sampleWidth
+
+    @property
+    def duration(self) -> float:
+        """ Length of the clip in seconds """
+        return len(self.data) / (self.frameSize * self.rate)
+
+    @property
+    def size(self) -> int:
+        return len(self.data)
+
+
+def loadClip(path: str, name: str = None) -> PCMClip:
+    """ Read and decode a WAV file """
+    with wave.open(path, "rb") as wav:
+        data = wav.readframes(wav.getnframes())
+        return PCMClip(name or path, data, wav.getframerate(), wav.getnchannels(), wav.getsampwidth())
+
+
+class ClipCache:
+    """
+        Least recently used cache of decoded clips, keyed by clip name (the
+        file name in the folder the clips are loaded from). Holds clips up to
+        a total of maxBytes of PCM data.
+    """
+    def __init__(self, folder: str, maxBytes: int = 16 * 1024 * 1024):
+        self.folder = folder
+        self.maxBytes = maxBytes
+        self.clips = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.clips
+
+    def get(self, name: str) -> PCMClip:
+        """ Returns a cached clip, or None if it is not in the cache """
+        with self.lock:
+            clip = self.clips.get(name)
+            if clip is None:
+                self.misses += 1
+                return None
+            self.clips.move_to_end(name)
+            self.hits += 1
+            return clip
+
+    def put(self, clip: PCMClip):
+        """ Add a clip, removing the least recently used clips to make room """
+        if clip.size > self.maxBytes:
+            return
+        with self.lock:
+            old = self.clips.pop(clip.name, None)
+            if old is not None:
+                self.bytes -= old.size
+            self.clips[clip.name] = clip
+            self.bytes += clip.size
+            while self.bytes > self.maxBytes:
+                _, evicted = self.clips.popitem(last=False)
+                self.bytes -= evicted.size
+                self.evictions += 1
+
+    def load(self, name: str, path: str = None) -> PCMClip:
+        """ Returns a clip from the cache, reading it from path (or the folder) if not cached """
+        clip = self.get(name)
+        if clip is None:
+            clip = loadClip(path or join(self.folder, name), name)
+            self.put(clip)
+        return clip
+
+    def invalidate(self, name: str):
+        """ Remove a clip, e.g. because its file has been written again """
+        with self.lock:
+            clip = self.clips.pop(name, None)
+            if clip is not None:
+                self.bytes -= clip.size
+
+    def preload(self, names):
+        """ Load clips into the cache from the folder, skipping any which cannot be read """
+        for name in names:
+            if name in self.clips:
+                continue
+            try:
+                self.put(loadClip(join(self.folder, name), name))
+            except (OSError, EOFError, wave.Error) as err:
+                print(f"Unable to preload {name}: {err}")
+
+    def summary(self) -> str:
+        return (f"cache clips:{len(self.clips)} {self.bytes/1024:.0f}/{self.maxBytes/1024:.0f}KB "
+                f"hits:{self.hits} misses:{self.misses} evictions:{self.evictions}")
+
+
+class PlaybackStats:
+    """ Time from play being requested to the first samples being due at the audio output """
+    def __init__(self):
+        self.clips = 0
+        self.restarts = 0
+        self.firstSampleTotal = 0.0
+        self.firstSampleMax = 0.0
+
+    def record(self, firstSample: float):
+        self.clips += 1
+        self.firstSampleTotal += firstSample
+        if firstSample > self.firstSampleMax:
+            self.firstSampleMax = firstSample
+
+    def summary(self) -> str:
+        mean = self.firstSampleTotal / self.clips if self.clips else 0.0
+        return (f"clips:{self.clips} output restarts:{self.restarts} "
+                f"time to first sample mean/max:{mean*1000:.1f}/{self.firstSampleMax*1000:.1f}ms")
+
+
+class PlaybackEngine:
+    def __init__(self, device: str = None, bufferTime: int = 40000, chunkTime: float = 0.01,
+                 player: str = "aplay", closeTimeout: float = 2.0, ahead: float = 0.03,
+                 clock=time.monotonic):
+        """
+            device is the ALSA device to play to (the default device if None).
+            bufferTime is the audio output buffer length in microseconds.
+            Clips are written to the output in chunks of chunkTime seconds, so
+            playback can be stopped part way through a clip, and at most ahead
+            seconds in front of real time (measured by clock). When the output
+            is closed, the player is given closeTimeout seconds to finish
+            playing before it is killed.
+        """
+        self.device = device
+        self.bufferTime = bufferTime
+        self.chunkTime = chunkTime
+        self.player = player
+        self.closeTimeout = closeTimeout
+        self.ahead = ahead
+        self.clock = clock
+        self.process = None
+        self.format = None
+        self.written = None         # Time the audio written by play() so far ends
+        self.stopRequested = threading.Event()
+        self.playing = None         # What the clip playing was played for, checked by stop()
+        self.stopFor = None         # Source stopped before its clip started playing
+        self.lock = threading.Lock()
+        self.stats = PlaybackStats()
+
+    def open(self, rate: int, channels: int, sampleWidth: int):
+        """ Start the audio output for a sample format, unless already open for it """
+        fmt = (rate, channels, sampleWidth)
+        if self.process is not None and self.process.poll() is None and fmt == self.format:
+            return
+        if self.process is not None:
+            self.close()
+            self.stats.restarts += 1
+        if sampleWidth not in SAMPLE_FORMATS:
+            raise ValueError(f"Unsupported sample width {sampleWidth} bytes")
+        cmd = [self.player, "-q", "-t", "raw", "-f", SAMPLE_FORMATS[sampleWidth],
+               "-r", str(rate), "-c", str(channels), f"--buffer-time={self.bufferTime}"]
+        if self.device:
+            cmd += ["-D", self.device]
+        cmd.append("-")
+        # aplay reports underruns on stderr whenever it runs out of audio
+        # between clips, which is expected here
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self.format = fmt
+        self.written = None
+        if fcntl is not None and sys.platform.startswith("linux"):
+            try:
+                fcntl.fcntl(self.process.stdin, F_SETPIPE_SZ, PIPE_SIZE)
+            except OSError:
+                pass
+
+    def write(self, data) -> bool:
+        """ Send raw PCM data to the audio output. Returns False if the output has closed. """
+        try:
+            self.process.stdin.write(data)
+            self.process.stdin.flush()
+            return True
+        except (BrokenPipeError, ValueError):
+            self.close()
+            return False
+
+    def play(self, clip: PCMClip, requested: float = None, source=None) -> bool:
+        """
+            Play a clip, returning once all of it has been sent to the audio
+            output (or when stop() is called). requested is the time (on the
+            engine clock) the clip was asked for, used to measure the time to
+            first sample. source is what the clip is being played for (such as a
+            queued request, by default the clip), which stop() can be given
+            to stop only this clip. Returns True if the whole clip was played.
+        """
+        if requested is None:
+            requested = self.clock()
+        self.open(*clip.format)
+        source = clip if source is None else source
+        with self.lock:
+            self.playing = source
+            if self.stopFor is source:
+                self.stopRequested.set()
+
+        chunkSize = max(int(clip.rate * self.chunkTime), 1) * clip.frameSize
+        bytesPerSecond = clip.rate * clip.frameSize
+        data = memoryview(clip.data)
+        first = True
+        try:
+            for offset in range(0, len(data), chunkSize):
+                # Wait until the audio already written has nearly played, waking at once if stopped
+                while True:
+                    now = self.clock()
+                    if self.written is None or self.written < now:
+                        # The output has run dry, so this chunk starts playing now
+                        self.written = now
+                    elif self.written - now > self.ahead:
+                        if self.stopRequested.wait(self.written - now - self.ahead):
+                            return False
+                        continue
+                    break
+                if self.stopRequested.is_set():
+                    return False
+                chunk = data[offset:offset + chunkSize]
+                if not self.write(chunk):
+                    return False
+                if first:
+                    self.stats.record(self.written - requested)
+                    first = False
+                self.written += len(chunk) / bytesPerSecond
+            return True
+        finally:
+            with self.lock:
+                self.playing = None
+                if self.stopFor is source:
+                    self.stopFor = None
+                self.stopRequested.clear()
+
+    def stop(self, source=None):
+        """
+            Stop the clip currently playing (from another thread). If source
+            is given, only the clip played for source is stopped (as soon as
+            it starts, if it has not started yet), so a stop which arrives as
+            the clip ends cannot stop the next clip. Without a source, if
+            called just before a clip starts, that clip is stopped instead.
+        """
+        with self.lock:
+            if source is None or self.playing is source:
+                self.stopRequested.set()
+            else:
+                self.stopFor = source
+
+    def close(self):
+        """ Close the audio output, letting it finish playing anything already sent """
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+            # Wait for the player to exit so it does not remain as a zombie process
+            try:
+                self.process.wait(self.closeTimeout)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+            self.format = None
+            self.written = None
@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+"""
+    Audio queue folder watcher
+
+    Copyright (C) 2023 Paul 'Footleg' Fretwell
+    Released under the GNU GPL v3 license
+    Code repo: https://github.com/Footleg/universal-robot
+
+    Watches the audio queue folder for WAV files to play, and keeps them in an
+    in memory queue in the order they arrived. On Linux the folder is watched
+    with inotify, so the server sleeps until a file has finished being written
+    into the folder, or is moved into it. Nothing is read from the disk while
+    the queue is empty. Where inotify is not available, the folder is polled
+    with a sleep between each scan.
+
+    The time each file was queued is recorded, so the delay from a file being
+    queued to it starting to play can be reported.
+
+    Clips to play, whether from the queue folder or requested over the audio
+    server socket, are put in a PlaybackQueue as PlayRequests. The playback
+    thread takes them from this queue to play, highest priority first, so a
+    collision beep is not stuck behind a long queue of speech.
+"""
+import ctypes
+import ctypes.util
+import heapq
+import itertools
+import os
+import select
+import struct
+import threading
+import time
+from collections import deque
+from os.path import isfile, join
+
+# inotify constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class Inotify:
+    """ Minimal inotify wrapper, watching one folder for files arriving """
+    def __init__(self, folder: str, mask: int = IN_CLOSE_WRITE | IN_MOVED_TO):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(folder), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, f"inotify_add_watch failed for {folder}")
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def read(self, timeout: float = None):
+        """
+            Wait up to timeout seconds (forever if None) for events. Returns a
+            list of (mask, filename) for the events received.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0").decode(errors="replace")
+            offset += length
+            events.append((mask, name))
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class QueueStats:
+    """ Delay from clips being queued to them starting to play """
+    def __init__(self):
+        self.played = 0
+        self.latencyTotal = 0.0
+        self.latencyMax = 0.0
+
+    def record(self, latency: float):
+        self.played += 1
+        self.latencyTotal += latency
+        if latency > self.latencyMax:
+            self.latencyMax = latency
+
+    def summary(self) -> str:
+        mean = self.latencyTotal / self.played if self.played else 0.0
+        return f"played:{self.played} queue latency mean/max:{mean*1000:.1f}/{self.latencyMax*1000:.1f}ms"
+
+
+class PlayRequest:
+    """
+        A clip waiting to be played. Higher priority requests are played
+        first. If ttl is given, the request is dropped if it has not started
+        playing within ttl seconds of being queued.
+    """
+    __slots__ = ("name", "clip", "priority", "queuedTime", "expires", "channel", "loop")
+
+    def __init__(self, name: str, clip, priority: int = 0, queuedTime: float = None, ttl: float = None,
+                 channel: str = "effects", loop: bool = False):
+        self.name = name
+        self.clip = clip
+        self.priority = priority
+        self.queuedTime = time.monotonic() if queuedTime is None else queuedTime
+        self.expires = None if ttl is None else self.queuedTime + ttl
+        self.channel = channel  # Mixer channel to play on, when the server is mixing
+        self.loop = loop
+
+    def expired(self, now: float) -> bool:
+        return self.expires is not None and now >= self.expires
+
+
+class PlaybackQueue:
+    """
+        Thread safe priority queue of PlayRequests. Requests are played
+        highest priority first, and in the order they were queued for the
+        same priority. A request for a clip which is already waiting is
+        merged with the waiting request rather than queued again, and
+        requests past their ttl are dropped rather than played.
+
+        The queue also keeps track of the requests playing, so it can tell
+        when a new request should preempt (stop) one. slots is how many
+        requests can play at once (such as the voices of a mixer channel).
+        Once that many are playing, a new request with a higher priority than
+        the lowest priority request playing preempts it.
+    """
+    def __init__(self, clock=time.monotonic, slots: int = 1):
+        self.clock = clock
+        self.slots = slots
+        self.active = []        # Requests playing, oldest first
+        self.heap = []
+        self.waiting = {}       # Requests in the heap by clip name
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.depthMax = 0
+        self.coalesced = 0
+        self.expired = 0
+        self.preempted = 0
+
+    def __len__(self) -> int:
+        return len(self.waiting)
+
+    @property
+    def playing(self) -> PlayRequest:
+        """ The request which started playing most recently, or None """
+        active = self.active
+        return active[-1] if active else None
+
+    @property
+    def free(self) -> bool:
+        """ True if another request can start playing without preempting one """
+        return len(self.active) < self.slots
+
+    def put(self, request: PlayRequest) -> PlayRequest:
+        """
+            Queue a request. If it has a higher priority than the request
+            playing, returns the request playing, which should be stopped to
+            play it. Otherwise returns None.
+        """
+        with self.condition:
+            waiting = self.waiting.get(request.name)
+            if waiting is not None:
+                # Keep the place in the queue of the waiting request, but
+                # raise its priority and extend its ttl to match the new one
+                self.coalesced += 1
+                if request.expires is None or (waiting.expires is not None and request.expires > waiting.expires):
+                    waiting.expires = request.expires
+                if request.priority > waiting.priority:
+                    waiting.priority = request.priority
+                    self.heap = [(-r.priority, seq, r) for _, seq, r in self.heap]
+                    heapq.heapify(self.heap)
+                request = waiting
+            else:
+                heapq.heappush(self.heap, (-request.priority, next(self.sequence), request))
+                self.waiting[request.name] = request
+                self.depthMax = max(self.depthMax, len(self.waiting))
+                self.condition.notify()
+
+            if len(self.active) >= self.slots:
+                lowest = min(self.active, key=lambda r: r.priority)
+                if request.priority > lowest.priority:
+                    self.preempted += 1
+                    return lowest
+            return None
+
+    def get(self, timeout: float = None) -> PlayRequest:
+        """
+            Returns the next request to play, waiting up to timeout seconds.
+            Returns None if none arrived. The request is recorded as playing
+            until done() is called.
+        """
+        with self.condition:
+            deadline = None if timeout is None else self.clock() + timeout
+            while True:
+                while self.heap:
+                    _, _, request = heapq.heappop(self.heap)
+                    del self.waiting[request.name]
+                    if request.expired(self.clock()):
+                        self.expired += 1
+                        continue
+                    self.active.append(request)
+                    return request
+                remaining = None if deadline is None else deadline - self.clock()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+    def done(self, request: PlayRequest = None):
+        """ Record that a request playing has finished (all of them if request is None) """
+        with self.condition:
+            if request is None:
+                self.active.clear()
+            elif request in self.active:
+                self.active.remove(request)
+
+    def clear(self) -> int:
+        """ Remove all waiting requests, returning how many were removed """
+        with self.condition:
+            count = len(self.waiting)
+            self.heap.clear()
+            self.waiting.clear()
+            return count
+
+    def summary(self) -> str:
+        return (f"depth:{len(self.waiting)} max:{self.depthMax} coalesced:{self.coalesced} "
+                f"expired:{self.expired} preempted:{self.preempted}")
+
+
+class QueueWatcher:
+    def __init__(self, folder: str, usePolling: bool = False, pollPeriod: float = 0.2,
+                 onWritten=None, clock=time.monotonic):
+        """
+            Watch folder for WAV files. Uses inotify unless usePolling is
+            True or inotify is not available, in which case the folder is
+            scanned every pollPeriod seconds. onWritten is called with the
+            name of each file written into the folder (rather than moved in),
+            when using inotify.
+        """
+        self.folder = folder
+        self.onWritten = onWritten
+        self.pollPeriod = pollPeriod
+        self.clock = clock
+        self.queue = deque()
+        self.queued = set()
+        self.present = {}       # Modified times (ns) of the files found by the last scan of the folder
+        self.inotify = None
+        if not usePolling:
+            try:
+                self.inotify = Inotify(folder)
+            except (OSError, AttributeError):
+                print("inotify not available, polling the audio queue folder")
+
+        # Queue any files already waiting, oldest first
+        self.scan()
+
+    @property
+    def usingInotify(self) -> bool:
+        return self.inotify is not None
+
+    def fileno(self) -> int:
+        """ File descriptor to wait on for queue folder events (inotify only) """
+        return self.inotify.fileno()
+
+    def add(self, filename: str):
+        """ Add a file to the end of the queue, if it is not already queued """
+        if filename.lower().endswith(".wav") and filename not in self.queued:
+            self.queue.append((filename, self.clock()))
+            self.queued.add(filename)
+
+    def scan(self):
+        """
+            Queue any files which have appeared in the folder since the last
+            scan, in modified time order. A file written again under the same
+            name (after being played) has a new modified time, so is queued
+            again.
+        """
+        try:
+            present = {f: os.stat(join(self.folder, f)).st_mtime_ns
+                       for f in os.listdir(self.folder) if isfile(join(self.folder, f))}
+        except FileNotFoundError:
+            # File removed while scanning, pick it up on the next scan
+            return
+        newFiles = [f for f, mtime in present.items() if self.present.get(f) != mtime]
+        newFiles.sort(key=present.get)
+        self.present = present
+        for f in newFiles:
+            self.add(f)
+
+    def wait(self, timeout: float = None):
+        """ Wait up to timeout seconds (forever if None) for files to be queued """
+        if self.queue:
+            return
+        if self.inotify is None:
+            deadline = None if timeout is None else self.clock() + timeout
+            while not self.queue:
+                remaining = self.pollPeriod if deadline is None else min(self.pollPeriod, deadline - self.clock())
+                if remaining <= 0:
+                    return
+                time.sleep(remaining)
+                self.scan()
+            return
+
+        for mask, name in self.inotify.read(timeout):
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, so look for the files instead
+                self.scan()
+            elif name:
+                if mask & IN_CLOSE_WRITE and self.onWritten is not None:
+                    self.onWritten(name)
+                self.add(name)
+
+    def get(self, timeout: float = None):
+        """
+            Returns the next queued (filename, queuedTime), waiting up to
+            timeout seconds (forever if None) for one. Returns None if nothing
+            was queued in time.
+        """
+        if not self.queue:
+            self.wait(timeout)
+        if not self.queue:
+            return None
+        filename, queuedTime = self.queue.popleft()
+        self.queued.discard(filename)
+        return filename, queuedTime
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
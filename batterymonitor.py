@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+    Battery monitor
+
+    Copyright (C) 2023 Paul 'Footleg' Fretwell
+    Released under the GNU GPL v3 license
+    Code repo: https://github.com/Footleg/universal-robot
+
+    Reads the robot battery voltage on a background thread at a fixed period
+    and keeps the most recent readings in a ring buffer. The control loop
+    only reads the cached results, so it never waits for the battery voltage
+    to be read from the hardware.
+
+    The robot hardware classes are not thread safe, so only use the
+    background thread when nothing else is using the bus at the same time
+    (such as with a ThreadedRobot, which returns its latest reading).
+    Otherwise call sample() from the control loop, for example by adding it
+    to a LoopScheduler as a task. Errors reading the voltage are counted and
+    the reading skipped, so the thread keeps running.
+
+    Readings are smoothed with an exponential moving average, and a median
+    of the buffered readings is also available for rejecting spikes. The
+    charge is estimated as a percentage between the minimum (empty) and
+    maximum (full) voltages, and the trend of the readings gives the rate the
+    battery is discharging.
+
+    Robots which cannot read their battery voltage return 0. These readings
+    are ignored, and the monitor reports that no voltage is available.
+"""
+import threading
+import time
+from array import array
+
+
+class BatteryMonitor:
+    def __init__(self, robot, period: float = 0.5, size: int = 64,
+                 minVoltage: float = 6.5, maxVoltage: float = 8.0,
+                 smoothing: float = 0.2, sampleWhen=None, clock=time.monotonic):
+        """
+            Reads the battery every period seconds, keeping the last size
+            readings. smoothing is the weight given to each new reading in the
+            moving average. If sampleWhen is given, readings are only taken
+            when it returns True (e.g. when the motors are not running, as the
+            voltage drops under load).
+        """
+        self.robot = robot
+        self.period = period
+        self.size = size
+        self.minVoltage = minVoltage
+        self.maxVoltage = maxVoltage
+        self.smoothing = smoothing
+        self.sampleWhen = sampleWhen
+        self.clock = clock
+
+        self.voltages = array('d', bytes(8 * size))
+        self.times = array('d', bytes(8 * size))
+        self.index = 0
+        self.count = 0
+        self.voltage = 0.0
+        self.reads = 0
+        self.failedReads = 0
+        self.errors = 0
+        self.lastError = None
+
+        self.lock = threading.Lock()
+        self.stopEvent = threading.Event()
+        self.thread = None
+
+    @property
+    def available(self) -> bool:
+        """ True once a battery voltage has been read """
+        return self.count > 0
+
+    def sample(self, dt: float = None):
+        """
+            Read the battery voltage and add it to the readings. Can be added
+            directly to a LoopScheduler as a task.
+        """
+        if self.sampleWhen is not None and not self.sampleWhen():
+            return
+        self.reads += 1
+        try:
+            voltage = self.robot.getBatteryVoltage()
+        except Exception as e:
+            self.errors += 1
+            self.lastError = e
+            return
+        if not voltage or voltage <= 0:
+            self.failedReads += 1
+            return
+
+        with self.lock:
+            self.voltages[self.index] = voltage
+            self.times[self.index] = self.clock()
+            self.index = (self.index + 1) % self.size
+            if self.count < self.size:
+                self.count += 1
+            if self.count == 1:
+                self.voltage = voltage
+            else:
+                self.voltage += self.smoothing * (voltage - self.voltage)
+
+    def readings(self):
+        """ Returns lists of the buffered (times, voltages), oldest first """
+        with self.lock:
+            if self.count < self.size:
+                return list(self.times[:self.count]), list(self.voltages[:self.count])
+            i = self.index
+            return (list(self.times[i:]) + list(self.times[:i]),
+                    list(self.voltages[i:]) + list(self.voltages[:i]))
+
+    def median(self) -> float:
+        """ Median of the buffered readings """
+        voltages = sorted(self.readings()[1])
+        if not voltages:
+            return 0.0
+        mid = len(voltages) // 2
+        if len(voltages) % 2:
+            return voltages[mid]
+        return (voltages[mid - 1] + voltages[mid]) / 2
+
+    @property
+    def percent(self) -> float:
+        """ Estimated charge from the smoothed voltage, 0-100% """
+        if not self.available:
+            return 0.0
+        percent = 100 * (self.voltage - self.minVoltage) / (self.maxVoltage - self.minVoltage)
+        return min(max(percent, 0.0), 100.0)
+
+    def dischargeRate(self) -> float:
+        """
+            Rate the battery voltage is falling, in volts per hour, from the
+            slope of a least squares line through the buffered readings
+        """
+        times, voltages = self.readings()
+        n = len(times)
+        if n < 2:
+            return 0.0
+        meanT = sum(times) / n
+        meanV = sum(voltages) / n
+        varT = sum((t - meanT) ** 2 for t in times)
+        if varT == 0:
+            return 0.0
+        slope = sum((t - meanT) * (v - meanV) for t, v in zip(times, voltages)) / varT
+        return -slope * 3600
+
+    def start(self):
+        """ Start reading the battery on a background thread """
+        if self.thread is not None:
+            return
+        self.stopEvent.clear()
+        self.thread = threading.Thread(target=self.run, name="BatteryMonitor", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopEvent.set()
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        nextRead = self.clock()
+        while not self.stopEvent.is_set():
+            self.sample()
+            nextRead += self.period
+            now = self.clock()
+            if nextRead < now:
+                nextRead = now + self.period
+            self.stopEvent.wait(nextRead - now)
+
+    def summary(self) -> str:
+        if not self.available:
+            return f"Battery voltage not available ({self.failedReads} failed reads, {self.errors} errors)"
+        return (f"Battery {self.voltage:.2f}V ({self.percent:.0f}%) median:{self.median():.2f}V "
+                f"falling {self.dischargeRate():.2f}V/h")
@@ -0,0 +1,243 @@
+# Benchmark of the UniversalRobot control loop, driven by scripted controller input on the virtual robot
+# Runs without any robot hardware or game controller: python3 benchmarkUniversalRobot.py
+#
+# Each scenario plays a script of stick, trigger and button changes through the handler functions
+# in UniversalRobot.py, ticking the same scheduled tasks main() runs. The loop is ticked as fast as
+# possible, with the scheduler and a new simulated robot for each scenario on a virtual clock, so the
+# wheels turn and the LED and battery tasks still run at their normal rate per tick. Results are
+# compared with the saved baseline (benchmarkBaseline.json). The metrics which do not depend on the
+# speed of the computer (bus calls and bytes allocated per tick, and the distance driven) fail the
+# run if they are more than the tolerance worse than the baseline. Changes in the timings are only
+# reported, as they vary from one computer, and one run, to the next.
+#
+#   python3 benchmarkUniversalRobot.py                 # Run and compare with the baseline
+#   python3 benchmarkUniversalRobot.py --save-baseline # Run and save the results as the new baseline
+import argparse
+import gc
+import json
+import math
+import os
+import sys
+import time
+import tracemalloc
+from array import array
+
+os.environ.setdefault("ROBOT_HARDWARE", "virtual")
+import UniversalRobot as ur
+from scheduler import LoopScheduler
+from RobotHardware_Virtual import VirtualClock
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarkBaseline.json")
+TICKS = 5000
+TOLERANCE = 0.25    # Fractional change from the baseline reported as a regression
+
+
+# Scripts of (tick, handler, args), played in a loop. Handler names are functions in UniversalRobot.
+def sweep(ticks=200):
+    """Left stick swept forwards and back while the right stick swings left and right"""
+    script = []
+    for i in range(0, ticks, 2):
+        phase = 2 * math.pi * i / ticks
+        script.append((i, "leftStickChangeHandler", (0.0, -math.sin(phase))))
+        script.append((i + 1, "rightStickChangeHandler", (math.sin(2 * phase) * 0.5, 0.0)))
+    return script, ticks
+
+
+SCENARIOS = {
+    # No input changes, so the motors stay off
+    "idle": ([], 100),
+    # Continuous stick movement every tick
+    "drive": sweep(),
+    # Spinning on the triggers, then releasing them
+    "spin": ([(0, "rightTrigChangeHandler", (1.0,)), (100, "rightTrigChangeHandler", (-1.0,)),
+              (150, "leftTrigChangeHandler", (1.0,)), (250, "leftTrigChangeHandler", (-1.0,))], 300),
+    # Driving forwards while switching between slow and turbo modes, and pressing the shutdown buttons
+    "modes": ([(0, "leftStickChangeHandler", (0.0, -1.0)), (50, "leftFrontBtn1Handler", (1,)),
+               (100, "leftFrontBtn1Handler", (0,)), (150, "rightFrontBtn1Handler", (1,)),
+               (200, "rightFrontBtn1Handler", (0,)), (210, "hatHandler", (0, -1)),
+               (220, "hatHandler", (0, 0)), (230, "squareButtonHandler", (1,)),
+               (240, "squareButtonHandler", (0,))], 300),
+}
+
+
+class ScriptedController:
+    """Stands in for RobotController, calling the handlers from a script each tick"""
+    def __init__(self, script, length):
+        self.events = {}
+        for tick, handler, args in script:
+            self.events.setdefault(tick, []).append((getattr(ur, handler), args))
+        self.length = length
+        self.tick = 0
+        self.message = ""
+
+    def controllerStatus(self):
+        for handler, args in self.events.get(self.tick % self.length, ()):
+            handler(*args)
+        self.tick += 1
+        return True
+
+
+def resetRobot():
+    """Put the driving state back to rest between scenarios"""
+    for handler, args in (("leftStickChangeHandler", (0.0, 0.0)), ("rightStickChangeHandler", (0.0, 0.0)),
+                          ("leftFrontBtn1Handler", (0,)), ("hatHandler", (0, 0)),
+                          ("squareButtonHandler", (0,)), ("selectButtonHandler", (0,))):
+        getattr(ur, handler)(*args)
+
+
+
+
+def createLoop(name):
+    """A new robot and control loop for a scenario, all on one virtual clock"""
+    clock = VirtualClock()
+    ur.initRobot(clock)
+    scheduler = LoopScheduler(ur.controlRate, clock=clock, sleep=clock.sleep)
+    ur.addRobotTasks(scheduler, ScriptedController(*SCENARIOS[name]))
+    return scheduler, clock
+
+
+def percentile(ordered, p):
+    return ordered[min(int(len(ordered) * p / 100), len(ordered) - 1)]
+
+
+def runScenario(name, ticks):
+    resetRobot()
+    scheduler, clock = createLoop(name)
+    busCalls = ur.robot.busCalls
+
+    # Time each tick
+    times = array('q', bytes(8 * ticks))
+    gc.collect()
+    start = time.perf_counter_ns()
+    for i in range(ticks):
+        tickStart = time.perf_counter_ns()
+        scheduler.tick()
+        times[i] = time.perf_counter_ns() - tickStart
+        clock.advance(scheduler.period)
+    elapsed = (time.perf_counter_ns() - start) / 1e9
+    busCalls = ur.robot.busCalls - busCalls
+    distance = ur.robot.distance
+
+    # Measure memory allocated in each tick in a separate pass, as tracing slows the ticks down
+    resetRobot()
+    scheduler, clock = createLoop(name)
+    allocTicks = min(ticks, 1000)
+    tracemalloc.start()
+    allocated = 0
+    allocatedMax = 0
+    retainedStart = tracemalloc.get_traced_memory()[0]
+    for i in range(allocTicks):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        scheduler.tick()
+        peak = tracemalloc.get_traced_memory()[1] - before
+        allocated += peak
+        allocatedMax = max(allocatedMax, peak)
+        clock.advance(scheduler.period)
+    retained = tracemalloc.get_traced_memory()[0] - retainedStart
+    tracemalloc.stop()
+
+    ordered = sorted(times)
+    return {
+        "ticksPerSecond": ticks / elapsed,
+        "p50us": percentile(ordered, 50) / 1000,
+        "p90us": percentile(ordered, 90) / 1000,
+        "p99us": percentile(ordered, 99) / 1000,
+        "maxUs": ordered[-1] / 1000,
+        "allocBytesPerTick": allocated / allocTicks,
+        "allocBytesMax": allocatedMax,
+        "retainedBytesPerTick": retained / allocTicks,
+        "busCallsPerTick": busCalls / ticks,
+        "distance": distance,
+    }
+
+
+# Metrics where a bigger number is worse, and those where a smaller number is worse. Only the
+# metrics which do not depend on the speed of the computer are checked against the baseline.
+HIGHER_IS_WORSE = ("allocBytesPerTick", "busCallsPerTick")
+CHANGE_IS_WORSE = ("distance",)     # The simulation is repeatable, so it should drive the same distance
+TIMING_HIGHER_IS_WORSE = ("p50us", "p90us", "p99us")
+TIMING_LOWER_IS_WORSE = ("ticksPerSecond",)
+
+
+def compareMetrics(metrics, base, higherIsWorse, lowerIsWorse, changeIsWorse, tolerance):
+    """ Returns descriptions of the metrics more than tolerance worse than base """
+    worse = []
+    for key in higherIsWorse:
+        if key in base and metrics[key] > base[key] * (1 + tolerance) and metrics[key] - base[key] > 1e-6:
+            worse.append(f"{key} {base[key]:.2f} -> {metrics[key]:.2f}")
+    for key in lowerIsWorse:
+        if key in base and metrics[key] < base[key] * (1 - tolerance):
+            worse.append(f"{key} {base[key]:.0f} -> {metrics[key]:.0f}")
+    for key in changeIsWorse:
+        if key in base and abs(metrics[key] - base[key]) > abs(base[key]) * tolerance + 1e-3:
+            worse.append(f"{key} {base[key]:.2f} -> {metrics[key]:.2f}")
+    return worse
+
+
+def compare(results, baseline, tolerance):
+    """ Returns (regressions, timing changes) of the results against the baseline """
+    regressions = []
+    timings = []
+    for name, metrics in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        regressions += [f"{name} {change}" for change in
+                        compareMetrics(metrics, base, HIGHER_IS_WORSE, (), CHANGE_IS_WORSE, tolerance)]
+        timings += [f"{name} {change}" for change in
+                    compareMetrics(metrics, base, TIMING_HIGHER_IS_WORSE, TIMING_LOWER_IS_WORSE, (), tolerance)]
+    return regressions, timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the UniversalRobot control loop")
+    parser.add_argument("--ticks", type=int, default=TICKS, help="ticks to run for each scenario")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="scenario to run (default: all)")
+    parser.add_argument("--save-baseline", action="store_true", help="save the results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="fractional change from the baseline reported as a regression")
+    args = parser.parse_args()
+
+    print(f"Robot: {ur.Robot(clock=VirtualClock()).getRobotName()}, {ur.controlRate}Hz loop, {args.ticks} ticks per scenario")
+    print(f"{'scenario':10s} {'ticks/s':>9s} {'p50':>8s} {'p90':>8s} {'p99':>8s} {'max':>8s} "
+          f"{'alloc/tick':>11s} {'retained':>9s} {'bus/tick':>9s} {'driven':>7s}")
+    results = {}
+    for name in args.scenario or SCENARIOS:
+        r = runScenario(name, args.ticks)
+        results[name] = r
+        print(f"{name:10s} {r['ticksPerSecond']:9.0f} {r['p50us']:7.1f}u {r['p90us']:7.1f}u "
+              f"{r['p99us']:7.1f}u {r['maxUs']:7.0f}u {r['allocBytesPerTick']:10.0f}B "
+              f"{r['retainedBytesPerTick']:8.1f}B {r['busCallsPerTick']:9.2f} {r['distance']:6.2f}m")
+
+    if args.save_baseline:
+        with open(BASELINE_FILE, "w") as f:
+            json.dump({"python": sys.version.split()[0], "ticks": args.ticks, "results": results}, f, indent=2)
+        print(f"Baseline saved to {BASELINE_FILE}")
+        return 0
+
+    if not os.path.isfile(BASELINE_FILE):
+        print("No baseline saved yet, run with --save-baseline to save one")
+        return 0
+    with open(BASELINE_FILE) as f:
+        saved = json.load(f)
+    if saved["ticks"] != args.ticks:
+        print(f"Baseline was saved with {saved['ticks']} ticks per scenario, not compared")
+        return 0
+    regressions, timings = compare(results, saved["results"], args.tolerance)
+    if timings:
+        print("Slower than the baseline (timings vary between computers, so these do not fail the run):")
+        for timing in timings:
+            print(f"  {timing}")
+    if regressions:
+        print("Regressions against the baseline:")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+    print("No regressions against the baseline")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+"""
+    Robot hardware I/O thread
+
+    Copyright (C) 2023 Paul 'Footleg' Fretwell
+    Released under the GNU GPL v3 license
+    Code repo: https://github.com/Footleg/universal-robot
+
+    Moves all the bus transfers to the robot hardware onto a worker thread,
+    so a slow transfer (such as showing the LEDs, or reading the encoders)
+    never holds up the control loop. ThreadedRobot wraps a robot hardware
+    class, and is a RobotInterface itself so the control program uses it in
+    place of the robot:
+
+        robot = ThreadedRobot(Robot())
+        robot.start()
+        ...
+        robot.shutdownHardware()    # Stops the worker, then the hardware
+
+    Motor powers and LED colours are not sent straight to the hardware.
+    They are posted into latest-value slots, which the worker picks up when
+    it is next free. Posting a value is just storing it and counting a
+    sequence number, so the control thread never waits for the worker. If
+    several values are posted while the worker is busy, only the newest is
+    sent: intermediate motor powers are skipped, and LED frames are dropped
+    in favour of the newest one. The worker sends any new motor powers
+    before every LED and read transfer, so motor updates are never queued
+    behind the LEDs.
+
+    The worker reads the encoders and the battery voltage at fixed periods,
+    and publishes each reading as a snapshot with the time it was read.
+    getEncoderCounts() and getBatteryVoltage() return the latest snapshot,
+    and encoderSnapshot() and batterySnapshot() return it with its time.
+"""
+import threading
+import time
+from collections import namedtuple
+from robotinterface import RobotInterface, RobotFrame
+
+EncoderSnapshot = namedtuple("EncoderSnapshot", ("time", "left", "right"))
+BatterySnapshot = namedtuple("BatterySnapshot", ("time", "voltage"))
+
+
+class ThreadedRobot(RobotInterface):
+    def __init__(self, robot, encoderPeriod: float = 0.01, batteryPeriod: float = 0.2,
+                 clock=time.monotonic):
+        """
+            Wrap robot, reading its encoders every encoderPeriod seconds and
+            its battery every batteryPeriod seconds once start() is called.
+            clock is the time source for the snapshots and read periods, and
+            must run in real time as the worker waits on it.
+        """
+        self.robot = robot
+        self.encoderPeriod = encoderPeriod
+        self.batteryPeriod = batteryPeriod
+        self.clock = clock
+        self.hasEncoders = robot.getEncoderCountsPerRev() > 0
+
+        # Latest-value slots, written only by the control thread. The value is stored before the
+        # sequence number is counted, so the worker never misses a post (it may send one twice).
+        self.motorPowers = [0, 0]
+        self.postedMotors = (0, 0)
+        self.motorPostTime = 0.0
+        self.motorSeq = 0
+        self.keepAliveSeq = 0
+        self.ledColours = [(0, 0, 0)] * robot.getLEDCount()
+        self.postedLEDs = tuple(self.ledColours)
+        self.ledSeq = 0
+
+        # Worker state
+        self.sentMotorSeq = 0
+        self.sentKeepAliveSeq = 0
+        self.sentLEDSeq = 0
+        self.sentLEDs = [None] * len(self.ledColours)
+        self.encoders = EncoderSnapshot(0.0, 0, 0)
+        self.battery = BatterySnapshot(0.0, 0.0)
+
+        # Statistics
+        self.motorWrites = 0
+        self.motorLatencyMax = 0.0
+        self.motorLatencyTotal = 0.0
+        self.ledShows = 0
+        self.encoderReads = 0
+        self.batteryReads = 0
+        self.errors = 0
+        self.lastError = None
+
+        # Calls which are passed straight through to the robot take the bus from the worker
+        self.busLock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopEvent = threading.Event()
+        self.thread = None
+
+    def __getattr__(self, name):
+        # Anything else the robot provides comes from the robot. Constants are returned as they are,
+        # and methods are called holding the bus, as the worker may be using it.
+        attr = getattr(self.robot, name)
+        if not callable(attr):
+            return attr
+
+        def locked(*args, **kwargs):
+            with self.busLock:
+                return attr(*args, **kwargs)
+
+        locked.__name__ = name
+        locked.__doc__ = attr.__doc__
+        return locked
+
+    # Fixed details of the robot, which are called on the robot directly from any thread. The robot
+    # method is looked up on each call, so wrappers which replace their methods (as InstrumentedRobot
+    # does when reset) are followed.
+
+    def getRobotName(self) -> str:
+        return self.robot.getRobotName()
+
+    def getMaxMotorChangeRate(self) -> float:
+        return self.robot.getMaxMotorChangeRate()
+
+    def getMinMotorPower(self) -> int:
+        return self.robot.getMinMotorPower()
+
+    def getEncoderDirections(self) -> tuple:
+        return self.robot.getEncoderDirections()
+
+    def getEncoderCountsPerRev(self) -> float:
+        return self.robot.getEncoderCountsPerRev()
+
+    def getWheelDiameter(self) -> float:
+        return self.robot.getWheelDiameter()
+
+    def getTrackWidth(self) -> float:
+        return self.robot.getTrackWidth()
+
+    def getMaxWheelSpeed(self) -> float:
+        return self.robot.getMaxWheelSpeed()
+
+    def getSpeedPIDGains(self) -> tuple:
+        return self.robot.getSpeedPIDGains()
+
+    def createSpeedPID(self, samplePeriod: float):
+        return self.robot.createSpeedPID(samplePeriod)
+
+    def getLEDCount(self) -> int:
+        return self.robot.getLEDCount()
+
+    def start(self):
+        """ Read the encoders and battery, then start the worker thread """
+        if self.thread is not None:
+            return
+        with self.busLock:
+            self.readEncoders()
+            self.readBattery()
+        self.stopEvent.clear()
+        self.thread = threading.Thread(target=self.run, name="RobotIO", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ Stop the worker thread, once it has sent the latest motor powers and LED colours """
+        if self.thread is None:
+            return
+        self.stopEvent.set()
+        self.wake.set()
+        self.thread.join()
+        self.thread = None
+
+    # Control thread side: post the latest values into the slots
+
+    def postMotors(self):
+        self.postedMotors = (self.motorPowers[0], self.motorPowers[1])
+        self.motorPostTime = self.clock()
+        self.motorSeq += 1
+        self.wake.set()
+
+    def postLEDs(self):
+        self.postedLEDs = tuple(self.ledColours)
+        self.ledSeq += 1
+        self.wake.set()
+
+    def setMotorPower(self, motorIndex: int, power: int):
+        if motorIndex in (0, 1):
+            self.motorPowers[motorIndex] = power
+            self.postMotors()
+
+    def setMotorsPower(self, leftMotor: int, rightMotor: int):
+        self.motorPowers[0] = leftMotor
+        self.motorPowers[1] = rightMotor
+        self.postMotors()
+
+    def keepAlive(self):
+        self.keepAliveSeq += 1
+        self.wake.set()
+
+    def setLEDColor(self, ledIdx: int, red: int, green: int, blue: int):
+        self.ledColours[ledIdx] = (red, green, blue)
+
+    def showLEDs(self):
+        self.postLEDs()
+
+    def setAllLEDsColor(self, red: int, green: int, blue: int):
+        self.ledColours[:] = [(red, green, blue)] * len(self.ledColours)
+        self.postLEDs()
+
+    def setLEDsAllOff(self):
+        self.ledColours[:] = [(0, 0, 0)] * len(self.ledColours)
+
+    def getEncoderCount(self, motorIndex: int) -> int:
+        if motorIndex in (0, 1):
+            return self.encoders[1 + motorIndex]
+        return 0
+
+    def getEncoderCounts(self) -> tuple:
+        encoders = self.encoders
+        return (encoders.left, encoders.right)
+
+    def encoderSnapshot(self) -> EncoderSnapshot:
+        """ Returns the latest encoder counts, with the time they were read """
+        return self.encoders
+
+    def getBatteryVoltage(self) -> float:
+        return self.battery.voltage
+
+    def batterySnapshot(self) -> BatterySnapshot:
+        """ Returns the latest battery voltage, with the time it was read """
+        return self.battery
+
+    def buttonPressed(self, btnIndex: int) -> int:
+        with self.busLock:
+            return self.robot.buttonPressed(btnIndex)
+
+    def beginFrame(self) -> RobotFrame:
+        return RobotFrame(self)
+
+    def commitFrame(self, frame: RobotFrame):
+        """ Post the motor powers and LED colours in a frame, and fill in reads from the latest snapshots """
+        if frame.motors:
+            for motorIndex, power in frame.motors.items():
+                if motorIndex in (0, 1):
+                    self.motorPowers[motorIndex] = power
+            self.postMotors()
+        if frame.keepAlive:
+            self.keepAliveSeq += 1
+
+        if frame.ledFill is not None:
+            self.ledColours[:] = [frame.ledFill] * len(self.ledColours)
+        for ledIdx, colour in frame.leds.items():
+            self.ledColours[ledIdx] = colour
+        if frame.show:
+            self.postLEDs()
+        elif frame.keepAlive:
+            self.wake.set()
+
+        for motorIndex in frame.encoderReads:
+            frame.encoderCounts[motorIndex] = self.getEncoderCount(motorIndex)
+        if frame.batteryRead:
+            frame.batteryVoltage = self.battery.voltage
+
+    def shutdownHardware(self):
+        self.stop()
+        with self.busLock:
+            self.robot.shutdownHardware()
+
+    # Worker thread side: send the newest values from the slots, and read the hardware
+
+    def transfer(self, method, *args):
+        """ Call a robot method, counting any error so the worker carries on """
+        try:
+            return method(*args)
+        except Exception as e:
+            self.errors += 1
+            self.lastError = e
+            return None
+
+    def sendMotors(self):
+        """ Send the newest motor powers, if any have been posted since the last were sent """
+        seq = self.motorSeq
+        if seq != self.sentMotorSeq:
+            self.sentMotorSeq = seq
+            postTime = self.motorPostTime
+            self.transfer(self.robot.setMotorsPower, *self.postedMotors)
+            latency = self.clock() - postTime
+            self.motorWrites += 1
+            self.motorLatencyTotal += latency
+            if latency > self.motorLatencyMax:
+                self.motorLatencyMax = latency
+
+    def sendLEDs(self):
+        """
+            Set the LEDs which changed in the newest LED frame, then show them.
+            A frame with every LED the same colour is sent as one fill.
+        """
+        self.sentLEDSeq = self.ledSeq
+        posted = self.postedLEDs
+        if posted and posted.count(posted[0]) == len(posted):
+            if posted != tuple(self.sentLEDs):
+                self.sendMotors()
+                self.transfer(self.robot.setAllLEDsColor, *posted[0])
+                self.sentLEDs[:] = posted
+                self.ledShows += 1
+                return
+        for ledIdx, colour in enumerate(posted):
+            if colour != self.sentLEDs[ledIdx]:
+                self.sendMotors()
+                self.transfer(self.robot.setLEDColor, ledIdx, *colour)
+                self.sentLEDs[ledIdx] = colour
+        self.sendMotors()
+        self.transfer(self.robot.showLEDs)
+        self.ledShows += 1
+
+    def readEncoders(self):
+        if self.hasEncoders:
+            counts = self.transfer(self.robot.getEncoderCounts)
+            if counts is not None:
+                self.encoders = EncoderSnapshot(self.clock(), counts[0], counts[1])
+                self.encoderReads += 1
+
+    def readBattery(self):
+        voltage = self.transfer(self.robot.getBatteryVoltage)
+        if voltage is not None:
+            self.battery = BatterySnapshot(self.clock(), voltage)
+            self.batteryReads += 1
+
+    def run(self):
+        nextEncoderRead = self.clock() + self.encoderPeriod
+        nextBatteryRead = self.clock() + self.batteryPeriod
+        while True:
+            # Cleared before checking the slots, so a value posted after the check wakes the next wait
+            self.wake.clear()
+            stopping = self.stopEvent.is_set()
+            with self.busLock:
+                self.sendMotors()
+                seq = self.keepAliveSeq
+                if seq != self.sentKeepAliveSeq:
+                    self.sentKeepAliveSeq = seq
+                    self.transfer(self.robot.keepAlive)
+                    self.sendMotors()
+                if self.ledSeq != self.sentLEDSeq:
+                    self.sendLEDs()
+                now = self.clock()
+                if now >= nextEncoderRead:
+                    self.sendMotors()
+                    self.readEncoders()
+                    nextEncoderRead = max(nextEncoderRead + self.encoderPeriod, now)
+                if now >= nextBatteryRead:
+                    self.sendMotors()
+                    self.readBattery()
+                    nextBatteryRead = max(nextBatteryRead + self.batteryPeriod, now)
+            if stopping:
+                return
+            self.wake.wait(max(min(nextEncoderRead, nextBatteryRead) - self.clock(), 0))
+
+    def summary(self) -> str:
+        posts = self.motorSeq
+        meanLatency = self.motorLatencyTotal / self.motorWrites if self.motorWrites else 0.0
+        return (f"Robot I/O motor posts:{posts} writes:{self.motorWrites} "
+                f"latency mean/max:{meanLatency*1000:.2f}/{self.motorLatencyMax*1000:.2f}ms "
+                f"LED frames:{self.ledSeq} shown:{self.ledShows} "
+                f"encoder reads:{self.encoderReads} battery reads:{self.batteryReads} errors:{self.errors}")
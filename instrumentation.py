@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+    Robot hardware call instrumentation
+
+    Copyright (C) 2023 Paul 'Footleg' Fretwell
+    Released under the GNU GPL v3 license
+    Code repo: https://github.com/Footleg/universal-robot
+
+    Wraps any robot hardware class to time every call made to it, so it is
+    possible to see which hardware operations (motor writes, LED updates,
+    encoder reads) use up the time in each control loop tick. For each
+    method the number of calls, errors raised, total and maximum time are
+    recorded, along with a histogram of call times from which percentiles
+    are read.
+
+        robot = InstrumentedRobot(Robot())
+        ...
+        print(robot.summary())
+        stats = robot.snapshot()    # Dict of the statistics for each method
+
+    The wrapper is a RobotInterface itself, so it can be used anywhere the
+    robot is, including inside a ThreadedRobot to time the transfers made
+    by its worker thread. Frames from beginFrame() are committed through the wrapper, so
+    commitFrame is timed as one call.
+
+    The histograms have 8 buckets for each doubling of time, so percentiles
+    are within about 6% of the actual time, and recording a call takes a few
+    integer operations. Disabling the instrumentation (enabled=False, or
+    setEnabled(False) at any time) puts the robot's own methods straight on
+    the wrapper, so calls then cost no more than calling the robot directly.
+"""
+import inspect
+import time
+from array import array
+from robotinterface import RobotInterface, RobotFrame
+
+SUB_BITS = 3                    # 2**SUB_BITS histogram buckets per doubling
+SUB_BUCKETS = 1 << SUB_BITS
+BUCKETS = (64 - SUB_BITS) * SUB_BUCKETS + SUB_BUCKETS
+EMPTY_HISTOGRAM = array('Q', bytes(8 * BUCKETS))
+
+
+def bucketIndex(ns: int) -> int:
+    """ Histogram bucket for a time in nanoseconds """
+    shift = ns.bit_length() - SUB_BITS - 1
+    if shift <= 0:
+        return ns
+    return shift * SUB_BUCKETS + (ns >> shift)
+
+
+def bucketRange(index: int) -> tuple:
+    """ Returns the (lowest, highest) times in nanoseconds in a histogram bucket """
+    shift = index // SUB_BUCKETS - 1
+    if shift <= 0:
+        return index, index
+    low = (index - shift * SUB_BUCKETS) << shift
+    return low, low + (1 << shift) - 1
+
+
+class MethodStats:
+    """ Call statistics for one method """
+    def __init__(self, name: str):
+        self.name = name
+        self.histogram = array('Q', EMPTY_HISTOGRAM)
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.errors = 0
+        self.totalNs = 0
+        self.maxNs = 0
+        self.histogram[:] = EMPTY_HISTOGRAM
+
+    def record(self, ns: int):
+        self.calls += 1
+        self.totalNs += ns
+        if ns > self.maxNs:
+            self.maxNs = ns
+        # bucketIndex(ns), written out here as this is run on every call
+        shift = ns.bit_length() - SUB_BITS - 1
+        self.histogram[shift * SUB_BUCKETS + (ns >> shift) if shift > 0 else ns] += 1
+
+    def percentile(self, p: float) -> float:
+        """ Returns the time in nanoseconds which p percent of calls took less than """
+        if not self.calls:
+            return 0.0
+        target = self.calls * p / 100
+        count = 0
+        for i, n in enumerate(self.histogram):
+            count += n
+            if n and count >= target:
+                low, high = bucketRange(i)
+                return min((low + high) / 2, self.maxNs)
+        return float(self.maxNs)
+
+    def snapshot(self) -> dict:
+        return {"calls": self.calls, "errors": self.errors,
+                "totalMs": self.totalNs / 1e6,
+                "meanUs": self.totalNs / self.calls / 1000 if self.calls else 0.0,
+                "p50Us": self.percentile(50) / 1000, "p90Us": self.percentile(90) / 1000,
+                "p99Us": self.percentile(99) / 1000, "maxUs": self.maxNs / 1000}
+
+
+class InstrumentedRobot(RobotInterface):
+    def __init__(self, robot, enabled: bool = True, clock=time.perf_counter_ns):
+        """
+            Wrap robot, timing calls to its methods with clock (a function
+            returning the time in integer nanoseconds).
+        """
+        self.robot = robot
+        self.clock = clock
+        self.methodStats = {}
+        # Methods of the robot to time, except any with the same name as a method of the wrapper
+        self.methods = [name for name in dir(robot)
+                        if not name.startswith("_") and name not in vars(InstrumentedRobot)
+                        and inspect.ismethod(getattr(robot, name))]
+        self.enabled = None
+        self.setEnabled(enabled)
+        self.reset()
+
+    def __getattr__(self, name):
+        # Anything which is not a method (such as robot constants) comes from the robot
+        return getattr(self.robot, name)
+
+    def setEnabled(self, enabled: bool):
+        """ Turn the timing of calls on or off """
+        if enabled == self.enabled:
+            return
+        self.enabled = enabled
+        for name in self.methods:
+            method = getattr(self.robot, name)
+            setattr(self, name, self.wrap(name, method) if enabled else method)
+
+    def wrap(self, name: str, method):
+        stats = self.methodStats.get(name)
+        if stats is None:
+            stats = self.methodStats[name] = MethodStats(name)
+        clock = self.clock
+
+        def instrumented(*args, **kwargs):
+            start = clock()
+            try:
+                return method(*args, **kwargs)
+            except Exception:
+                stats.errors += 1
+                raise
+            finally:
+                stats.record(clock() - start)
+
+        instrumented.__name__ = name
+        instrumented.__doc__ = method.__doc__
+        return instrumented
+
+    def beginFrame(self) -> RobotFrame:
+        """ Returns a frame which is committed through the wrapper, so the commit is timed """
+        return RobotFrame(self)
+
+    def reset(self):
+        """
+            Clear the statistics, starting a new measurement period. The
+            methods are wrapped again with new statistics, rather than the old
+            ones being cleared, so the robot can be reset from one thread while
+            another (such as a ThreadedRobot worker) is calling it.
+        """
+        self.methodStats = {}
+        if self.enabled:
+            for name in self.methods:
+                setattr(self, name, self.wrap(name, getattr(self.robot, name)))
+        self.resetTime = self.clock()
+
+    def snapshot(self) -> dict:
+        """ Returns the statistics for each method which has been called, by method name """
+        return {name: stats.snapshot() for name, stats in self.methodStats.items() if stats.calls}
+
+    def summary(self) -> str:
+        """ Table of the methods called, those taking the most time first """
+        elapsed = (self.clock() - self.resetTime) / 1e9
+        called = sorted((s for s in self.methodStats.values() if s.calls),
+                        key=lambda s: s.totalNs, reverse=True)
+        lines = [f"Robot calls over {elapsed:.1f}s:"]
+        for s in called:
+            snap = s.snapshot()
+            share = s.totalNs / 1e9 / elapsed * 100 if elapsed > 0 else 0.0
+            lines.append(f"  {s.name:22s} calls:{s.calls:7d} errors:{s.errors} total:{snap['totalMs']:8.1f}ms "
+                         f"({share:4.1f}%) p50/p90/p99/max:{snap['p50Us']:.0f}/{snap['p90Us']:.0f}/"
+                         f"{snap['p99Us']:.0f}/{snap['maxUs']:.0f}us")
+        return "\n".join(lines)
+
+    def dump(self, dt: float = None):
+        """
+            Print the summary and start a new measurement period. Can be added
+            to a LoopScheduler as a task to report at a fixed period.
+        """
+        print(self.summary())
+        self.reset()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+    LED animation engine
+
+    Copyright (C) 2023 Paul 'Footleg' Fretwell
+    Released under the GNU GPL v3 license
+    Code repo: https://github.com/Footleg/universal-robot
+
+    LED effects are rendered once into a table of frames (3 bytes per LED, for
+    the number of LEDs on the robot) with a display time for each frame. An
+    LEDAnimator plays an effect by copying its frames into an LEDFrameBuffer.
+    The animator does not sleep. It is advanced by calling tick() with the
+    elapsed time, normally from a scheduled task, so animations never hold up
+    the motor control loop.
+
+        animator = LEDAnimator(LEDFrameBuffer(robot))
+        animator.play(ScannerEffect(robot.getLEDCount(), (0, 100, 0)))
+        scheduler.addTask(animator.tick, 0.02)
+
+    Effects only need to be rendered again when their settings change, such
+    as the colour of the scanner.
+"""
+
+
+def scaleColour(colour, brightness: float):
+    """ Returns a colour scaled by a brightness multiple, limited to 0-255 """
+    return tuple(min(max(int(c * brightness), 0), 255) for c in colour)
+
+
+def batteryColour(percent: float):
+    """ Returns the colour for a battery charge level, red when empty to green when full """
+    percent = min(max(percent, 0), 100)
+    return (int(120 - 1.2 * percent), int(percent), 0)
+
+
+class LEDEffect:
+    """
+        Base class for LED effects. Subclasses set frames to a list of frames
+        (bytes of 3 bytes per LED) and durations to the time in seconds each
+        frame is shown. Effects which loop play forever, otherwise the last
+        frame stays on the LEDs when the effect finishes. Frame durations
+        must be greater than zero.
+    """
+    loop = True
+
+    def __init__(self, ledCount: int):
+        self.ledCount = ledCount
+        self.frames = []
+        self.durations = []
+
+    def blankFrame(self) -> bytearray:
+        return bytearray(3 * self.ledCount)
+
+    def setFrames(self, frames, durations):
+        # Replaced rather than modified, so an animator playing the effect
+        # can see the frames have changed
+        self.frames = [bytes(f) for f in frames]
+        self.durations = list(durations)
+
+
+class ScannerEffect(LEDEffect):
+    """
+        Larson scanner: a bright LED with a fading tail which moves back and
+        forth along the LEDs.
+    """
+    def __init__(self, ledCount: int, colour, framePeriod: float = 0.05, tail=(2, 1, 0.5)):
+        super().__init__(ledCount)
+        self.framePeriod = framePeriod
+        self.tail = tail
+        self.colour = None
+        self.setColour(colour)
+
+    def setColour(self, colour):
+        """ Render the frames for a new scanner colour, if it has changed """
+        if colour == self.colour:
+            return
+        self.colour = colour
+        shades = [scaleColour(colour, brightness) for brightness in self.tail]
+        frames = []
+        for direction, positions in ((1, range(self.ledCount)),
+                                     (-1, range(self.ledCount - 1, -1, -1))):
+            for pos in positions:
+                frame = self.blankFrame()
+                for offset, shade in enumerate(shades):
+                    ledIdx = pos - offset * direction
+                    if 0 <= ledIdx < self.ledCount:
+                        frame[ledIdx * 3:ledIdx * 3 + 3] = bytes(shade)
+                frames.append(frame)
+        self.setFrames(frames, [self.framePeriod] * len(frames))
+
+
+class BlinkEffect(LEDEffect):
+    """ All LEDs blinking on and off. Repeats forever if repeats is None. """
+    def __init__(self, ledCount: int, colour, onTime: float = 0.25, offTime: float = 0.25,
+                 repeats: int = None):
+        super().__init__(ledCount)
+        self.loop = repeats is None
+        on = bytes(colour) * ledCount
+        off = self.blankFrame()
+        self.setFrames([on, off] * (repeats or 1), [onTime, offTime] * (repeats or 1))
+
+
+class BatteryGaugeEffect(LEDEffect):
+    """
+        Bar graph of the battery charge, with the number of LEDs lit and their
+        colour showing the charge level.
+    """
+    loop = False
+
+    def __init__(self, ledCount: int, percent: float = 0):
+        super().__init__(ledCount)
+        self.percent = None
+        self.setPercent(percent)
+
+    def setPercent(self, percent: float):
+        """ Render the gauge for a new charge level, if the LEDs shown would change """
+        percent = min(max(percent, 0), 100)
+        lit = max(1, round(self.ledCount * percent / 100)) if self.ledCount else 0
+        colour = batteryColour(percent)
+        if self.frames and (lit, colour) == self.shown:
+            return
+        self.percent = percent
+        self.shown = (lit, colour)
+        frame = self.blankFrame()
+        frame[:lit * 3] = bytes(colour) * lit
+        self.setFrames([frame], [1.0])
+
+
+class ModeIndicatorEffect(LEDEffect):
+    """ All LEDs pulsing slowly in the colour of the current driving mode """
+    def __init__(self, ledCount: int, colour, period: float = 1.0, steps: int = 10):
+        super().__init__(ledCount)
+        frames = []
+        for i in list(range(steps)) + list(range(steps, 0, -1)):
+            frames.append(bytes(scaleColour(colour, 0.1 + 0.9 * i / steps)) * ledCount)
+        self.setFrames(frames, [period / len(frames)] * len(frames))
+
+
+class LEDAnimator:
+    """ Plays LED effects into an LEDFrameBuffer, advanced by tick() """
+    def __init__(self, framebuffer):
+        self.framebuffer = framebuffer
+        self.effect = None
+        self.index = 0
+        self.elapsed = 0.0
+        self.finished = True
+        self.drawnFrames = None
+        self.drawnIndex = -1
+
+    def play(self, effect: LEDEffect, restart: bool = False):
+        """ Start playing an effect, unless it is already playing """
+        if effect is self.effect and not restart:
+            return
+        self.effect = effect
+        self.index = 0
+        self.elapsed = 0.0
+        self.finished = False
+        self.drawnFrames = None
+
+    def stop(self):
+        self.effect = None
+        self.finished = True
+
+    def tick(self, dt: float):
+        """ Advance the animation by dt seconds, showing a new frame if needed """
+        effect = self.effect
+        if effect is None or not effect.frames:
+            return
+
+        # The first frame of a new effect is shown for its full duration
+        if not self.finished and self.drawnFrames is not None:
+            self.elapsed += dt
+            durations = effect.durations
+            while self.elapsed >= durations[self.index]:
+                self.elapsed -= durations[self.index]
+                if self.index + 1 < len(effect.frames):
+                    self.index += 1
+                elif effect.loop:
+                    self.index = 0
+                else:
+                    self.finished = True
+                    break
+
+        if effect.frames is not self.drawnFrames or self.index != self.drawnIndex:
+            self.framebuffer.setFrame(effect.frames[self.index])
+            self.framebuffer.show()
+            self.drawnFrames = effect.frames
+            self.drawnIndex = self.index
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+    LED frame buffer
+
+    Copyright (C) 2023 Paul 'Footleg' Fretwell
+    Released under the GNU GPL v3 license
+    Code repo: https://github.com/Footleg/universal-robot
+
+    Keeps the colours of the robot LEDs in a bytearray (3 bytes per LED).
+    Animations draw each new frame into the buffer, and show() compares it
+    with the frame last sent to the robot. Only the LEDs which changed are
+    sent, and if nothing changed the LEDs are not updated at all. Counters
+    record how many LED colours were actually sent, so the cost of the LED
+    animations can be monitored.
+"""
+import time
+
+
+class LEDFrameBuffer:
+    def __init__(self, robot, output=None, clock=time.monotonic):
+        """
+            LED commands are sent to output if given (such as a RobotFrame),
+            otherwise straight to the robot.
+        """
+        self.count = robot.getLEDCount()
+        self.output = output if output is not None else robot
+        self.clock = clock
+        self.pixels = bytearray(3 * self.count)
+        self.shown = bytearray(3 * self.count)
+        self.valid = False  # Set once the LEDs are known to match shown
+        self.resetCounters()
+
+    def resetCounters(self):
+        self.pixelsWritten = 0
+        self.shows = 0
+        self.skippedShows = 0
+        self.counterStart = self.clock()
+
+    def setPixel(self, ledIdx: int, red: int, green: int, blue: int):
+        """
+            Set the colour of one LED. LEDs outside the strip are ignored and
+            colour values over 255 are limited to 255.
+        """
+        if 0 <= ledIdx < self.count:
+            i = ledIdx * 3
+            self.pixels[i] = min(red, 255)
+            self.pixels[i + 1] = min(green, 255)
+            self.pixels[i + 2] = min(blue, 255)
+
+    def getPixel(self, ledIdx: int):
+        i = ledIdx * 3
+        return self.pixels[i], self.pixels[i + 1], self.pixels[i + 2]
+
+    def fill(self, red: int, green: int, blue: int):
+        self.pixels[:] = bytes((red, green, blue)) * self.count
+
+    def clear(self):
+        self.pixels[:] = bytes(3 * self.count)
+
+    def setFrame(self, frame):
+        """ Copy a whole frame of 3 bytes per LED into the buffer """
+        self.pixels[:] = frame
+
+    def invalidate(self):
+        """ Send every LED on the next show, e.g. after the LEDs were set directly """
+        self.valid = False
+
+    def show(self) -> int:
+        """
+            Send the LEDs which changed since the last show to the robot and
+            show them. Returns the number of LEDs sent.
+        """
+        if self.valid and self.pixels == self.shown:
+            self.skippedShows += 1
+            return 0
+
+        pixels = self.pixels
+        shown = self.shown
+        written = 0
+        for ledIdx in range(self.count):
+            i = ledIdx * 3
+            if not self.valid or pixels[i:i + 3] != shown[i:i + 3]:
+                self.output.setLEDColor(ledIdx, pixels[i], pixels[i + 1], pixels[i + 2])
+                written += 1
+        self.output.showLEDs()
+        shown[:] = pixels
+        self.valid = True
+        self.pixelsWritten += written
+        self.shows += 1
+        return written
+
+    def pixelsPerSecond(self) -> float:
+        """ Average rate LED colours were sent since the counters were reset """
+        elapsed = self.clock() - self.counterStart
+        return self.pixelsWritten / elapsed if elapsed > 0 else 0.0
+
+    def summary(self) -> str:
+        return (f"LEDs shows:{self.shows} skipped:{self.skippedShows} "
+                f"pixels:{self.pixelsWritten} ({self.pixelsPerSecond():.1f}/s)")
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+    Motor command pipeline
+
+    Copyright (C) 2023 Paul 'Footleg' Fretwell
+    Released under the GNU GPL v3 license
+    Code repo: https://github.com/Footleg/universal-robot
+
+    Turns power and turn demands from the driver into left and right motor
+    powers for a tank steering robot, and sends them to the robot hardware.
+    The pipeline has three stages:
+
+    1. Stick mixing, using the trig based mixing algorithm designed by
+       Footleg, which keeps the mixed motor powers inside the range -100 to
+       100 without clipping.
+    2. Slew limiting, which limits how fast the motor powers can change to
+       prevent stressing the gearboxes with sudden changes. The limit is in
+       percent of full power per second, and uses the measured time since the
+       last update, so ramp times do not depend on how fast the loop runs.
+    3. Dead zone handling, which maps small non-zero powers up to the lowest
+       power the motors actually turn at, so the robot responds across the
+       whole range of stick movement instead of humming in place.
+
+    The motor powers are only sent to the robot when the whole number powers
+    change, so an idle robot does not use the bus every loop.
+
+    The limits default to those reported by the robot hardware class.
+
+    The mixing stage can be swapped for any object with a mix(power, turn)
+    method. As well as the original trig mixing, this module provides an
+    exact algebraic form of the same mixing which needs no trig functions,
+    a precomputed lookup table (with optional bilinear interpolation), and
+    mixArray() which mixes whole arrays of stick samples in one go using
+    NumPy when it is installed (for replaying recordings and simulations).
+"""
+import math
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def trigMix(power: float, turn: float):
+    """
+        Mix power and turn demands (each -1 to 1) into left and right motor
+        powers (each -100 to 100) using Footleg's trig based mixing
+    """
+    # Power and Steer values create vector. Calculate angle of the vector
+    vAngle = math.atan2(turn,power)
+
+    # Calculate scale factor to keep vector within bounds of circle
+    if abs(power) > abs(turn):
+        scaleFactor = math.cos(vAngle)
+    else:
+        scaleFactor = math.sin(vAngle)
+
+    scaleFactor = scaleFactor * scaleFactor * 100
+
+    adjPower = power * scaleFactor
+    adjturn = turn * scaleFactor
+    return adjPower + adjturn, adjPower - adjturn
+
+
+def fastMix(power: float, turn: float):
+    """
+        Same mixing as trigMix without the trig. The squared cos (or sin) of
+        the stick vector angle is the squared power (or turn) divided by the
+        squared length of the vector.
+    """
+    pp = power * power
+    tt = turn * turn
+    if pp + tt == 0:
+        return 0.0, 0.0
+    scaleFactor = (pp if pp > tt else tt) * 100 / (pp + tt)
+    adjPower = power * scaleFactor
+    adjturn = turn * scaleFactor
+    return adjPower + adjturn, adjPower - adjturn
+
+
+def mixArray(powers, turns):
+    """
+        Mix arrays of power and turn demands, returning arrays of left and
+        right motor powers. Uses NumPy when available, otherwise returns
+        lists mixed one sample at a time.
+    """
+    if np is None:
+        mixed = [fastMix(p, t) for p, t in zip(powers, turns)]
+        return [m[0] for m in mixed], [m[1] for m in mixed]
+
+    p = np.asarray(powers, dtype=np.float64)
+    t = np.asarray(turns, dtype=np.float64)
+    pp = p * p
+    tt = t * t
+    total = pp + tt
+    scaleFactor = np.divide(np.maximum(pp, tt) * 100, total,
+                            out=np.zeros_like(total), where=total != 0)
+    adjPower = p * scaleFactor
+    adjturn = t * scaleFactor
+    return adjPower + adjturn, adjPower - adjturn
+
+
+class MixingTable:
+    """
+        Lookup table of mixed motor powers, precomputed for a grid of power
+        and turn demands covering -1 to 1 with the given number of points on
+        each axis. Demands between grid points are bilinearly interpolated,
+        or rounded to the nearest grid point if interpolate is False.
+    """
+    def __init__(self, resolution: int = 101, interpolate: bool = True, mixer=trigMix):
+        if resolution < 2:
+            raise ValueError("Mixing table resolution must be at least 2")
+        self.resolution = resolution
+        self.interpolate = interpolate
+        self.scale = (resolution - 1) / 2
+        self.lmTable = array('d', bytes(8 * resolution * resolution))
+        self.rmTable = array('d', bytes(8 * resolution * resolution))
+        for i in range(resolution):
+            power = i / self.scale - 1
+            for j in range(resolution):
+                lm, rm = mixer(power, j / self.scale - 1)
+                self.lmTable[i * resolution + j] = lm
+                self.rmTable[i * resolution + j] = rm
+
+    def mix(self, power: float, turn: float):
+        """ Look up the left and right motor powers for power and turn demands """
+        last = self.resolution - 1
+        x = (min(max(power, -1.0), 1.0) + 1) * self.scale
+        y = (min(max(turn, -1.0), 1.0) + 1) * self.scale
+        if not self.interpolate:
+            idx = int(x + 0.5) * self.resolution + int(y + 0.5)
+            return self.lmTable[idx], self.rmTable[idx]
+
+        i = min(int(x), last - 1)
+        j = min(int(y), last - 1)
+        fx = x - i
+        fy = y - j
+        idx = i * self.resolution + j
+        w00 = (1 - fx) * (1 - fy)
+        w01 = (1 - fx) * fy
+        w10 = fx * (1 - fy)
+        w11 = fx * fy
+        n = self.resolution
+        lmT = self.lmTable
+        rmT = self.rmTable
+        lm = lmT[idx] * w00 + lmT[idx + 1] * w01 + lmT[idx + n] * w10 + lmT[idx + n + 1] * w11
+        rm = rmT[idx] * w00 + rmT[idx + 1] * w01 + rmT[idx + n] * w10 + rmT[idx + n + 1] * w11
+        return lm, rm
+
+
+class MotorPipeline:
+    def __init__(self, robot, maxChangeRate: float = None, minMovingSpeed: float = None,
+                 deadBand: float = 1.0, mixer=trigMix, output=None):
+        """
+            maxChangeRate is the fastest the motor power can change in percent
+            per second. minMovingSpeed is the lowest percentage of motor power
+            needed to turn the motors. Powers smaller than deadBand percent
+            are treated as stopped. mixer is the function used to mix power
+            and turn demands into motor powers (e.g. MixingTable().mix).
+            Motor powers are sent to output if given (such as a RobotFrame),
+            otherwise straight to the robot.
+        """
+        self.robot = robot
+        self.output = output if output is not None else robot
+        self.mix = mixer
+        if maxChangeRate is None:
+            maxChangeRate = robot.getMaxMotorChangeRate()
+        if minMovingSpeed is None:
+            minMovingSpeed = robot.getMinMotorPower()
+        self.maxChangeRate = maxChangeRate
+        self.minMovingSpeed = minMovingSpeed
+        self.deadBand = deadBand
+
+        # Mixed motor powers requested by the driver
+        self.lm = 0.0
+        self.rm = 0.0
+        # Slew limited motor powers actually being applied
+        self.realLM = 0.0
+        self.realRM = 0.0
+        # Powers last sent to the robot hardware
+        self.outLM = None
+        self.outRM = None
+
+        self.writes = 0
+        self.skippedWrites = 0
+
+    def slew(self, current: float, target: float, maxStep: float) -> float:
+        """ Move current towards target by no more than maxStep """
+        if target - current > maxStep:
+            return current + maxStep
+        elif current - target > maxStep:
+            return current - maxStep
+        return target
+
+    def deadZone(self, value: float) -> int:
+        """ Map a motor power to the power to apply to the motor """
+        magnitude = abs(value)
+        if magnitude < self.deadBand:
+            return 0
+        magnitude = self.minMovingSpeed + magnitude * (100 - self.minMovingSpeed) / 100
+        return int(magnitude) if value > 0 else -int(magnitude)
+
+    def update(self, power: float, turn: float, dt: float) -> bool:
+        """
+            Run the pipeline for new power and turn demands, where dt is the
+            time in seconds since the last update. Returns True if new motor
+            powers were sent to the robot.
+        """
+        self.lm, self.rm = self.mix(power, turn)
+
+        # Control speed of change of motor powers to prevent stressing gearboxes with sudden changes
+        maxStep = self.maxChangeRate * dt
+        self.realLM = self.slew(self.realLM, self.lm, maxStep)
+        self.realRM = self.slew(self.realRM, self.rm, maxStep)
+
+        return self.apply(self.deadZone(self.realLM), self.deadZone(self.realRM))
+
+    def apply(self, leftMotor: int, rightMotor: int) -> bool:
+        """ Send motor powers to the robot, unless they have not changed """
+        if leftMotor == self.outLM and rightMotor == self.outRM:
+            self.skippedWrites += 1
+            return False
+        self.output.setMotorsPower(leftMotor, rightMotor)
+        self.outLM = leftMotor
+        self.outRM = rightMotor
+        self.writes += 1
+        return True
+
+    def stop(self):
+        """ Stop both motors immediately, bypassing the slew limit """
+        self.lm = self.rm = self.realLM = self.realRM = 0.0
+        self.apply(0, 0)
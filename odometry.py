@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+    Encoder odometry
+
+    Copyright (C) 2023 Paul 'Footleg' Fretwell
+    Released under the GNU GPL v3 license
+    Code repo: https://github.com/Footleg/universal-robot
+
+    Reads both motor encoders together at a fixed rate (normally as a
+    scheduled task) and works out the speed of each wheel and the position of
+    the robot. The robot position (x, y in metres, and heading in radians,
+    anticlockwise from the starting direction) is found by integrating the
+    distance travelled by each side of a differential drive robot. The gear
+    ratio, wheel size and track width come from the robot hardware class.
+
+    The latest counts, deltas and speeds are kept in preallocated history
+    arrays, so other parts of the program can read the pose or wheel speeds
+    at any time without reading the encoders again.
+
+    Robots without encoders report 0 encoder counts per revolution, and the
+    odometry does not read anything from them.
+"""
+import math
+import time
+from array import array
+
+
+class Odometry:
+    def __init__(self, robot, historySize: int = 100, clock=time.monotonic):
+        self.robot = robot
+        self.clock = clock
+        self.countsPerRev = robot.getEncoderCountsPerRev()
+        self.trackWidth = robot.getTrackWidth()
+        self.leftDir, self.rightDir = robot.getEncoderDirections()
+        self.available = self.countsPerRev > 0
+        if self.available:
+            self.metresPerCount = math.pi * robot.getWheelDiameter() / self.countsPerRev
+        else:
+            self.metresPerCount = 0.0
+
+        # History of the most recent updates, index points at the next entry to write
+        self.historySize = historySize
+        self.times = array('d', bytes(8 * historySize))
+        self.leftCounts = array('q', bytes(8 * historySize))
+        self.rightCounts = array('q', bytes(8 * historySize))
+        self.leftDeltas = array('q', bytes(8 * historySize))
+        self.rightDeltas = array('q', bytes(8 * historySize))
+        self.leftSpeeds = array('d', bytes(8 * historySize))
+        self.rightSpeeds = array('d', bytes(8 * historySize))
+        self.index = 0
+        self.updates = 0
+
+        self.lastLeft = None
+        self.lastRight = None
+        self.lastTime = None
+        self.reset()
+
+    def reset(self):
+        """ Set the robot position back to the origin """
+        self.x = 0.0
+        self.y = 0.0
+        self.heading = 0.0
+        self.distance = 0.0
+        self.leftSpeed = 0.0    # Wheel revolutions per second
+        self.rightSpeed = 0.0
+
+    def update(self, dt: float = None):
+        """
+            Read the encoders and update the wheel speeds and robot position.
+            Can be added directly to a LoopScheduler as a task.
+        """
+        if not self.available:
+            return
+        left, right = self.robot.getEncoderCounts()
+        now = self.clock()
+        left *= self.leftDir
+        right *= self.rightDir
+        if self.lastTime is None:
+            self.lastLeft, self.lastRight, self.lastTime = left, right, now
+            return
+
+        dLeft = left - self.lastLeft
+        dRight = right - self.lastRight
+        elapsed = now - self.lastTime
+        self.lastLeft, self.lastRight, self.lastTime = left, right, now
+
+        if elapsed > 0:
+            self.leftSpeed = dLeft / self.countsPerRev / elapsed
+            self.rightSpeed = dRight / self.countsPerRev / elapsed
+
+        # Integrate the distance each side travelled, moving along the average
+        # heading over the update
+        distLeft = dLeft * self.metresPerCount
+        distRight = dRight * self.metresPerCount
+        dist = (distLeft + distRight) / 2
+        dHeading = (distRight - distLeft) / self.trackWidth if self.trackWidth else 0.0
+        midHeading = self.heading + dHeading / 2
+        self.x += dist * math.cos(midHeading)
+        self.y += dist * math.sin(midHeading)
+        self.heading = (self.heading + dHeading + math.pi) % (2 * math.pi) - math.pi
+        self.distance += abs(dist)
+
+        i = self.index
+        self.times[i] = now
+        self.leftCounts[i] = left
+        self.rightCounts[i] = right
+        self.leftDeltas[i] = dLeft
+        self.rightDeltas[i] = dRight
+        self.leftSpeeds[i] = self.leftSpeed
+        self.rightSpeeds[i] = self.rightSpeed
+        self.index = (i + 1) % self.historySize
+        self.updates += 1
+
+    def pose(self) -> tuple:
+        """ Returns the latest robot position (x, y, heading) """
+        return (self.x, self.y, self.heading)
+
+    def wheelSpeeds(self) -> tuple:
+        """ Returns the latest (left, right) wheel speeds in revolutions per second """
+        return (self.leftSpeed, self.rightSpeed)
+
+    def groundSpeeds(self) -> tuple:
+        """ Returns the latest (left, right) wheel speeds in metres per second """
+        metresPerRev = self.metresPerCount * self.countsPerRev
+        return (self.leftSpeed * metresPerRev, self.rightSpeed * metresPerRev)
+
+    def summary(self) -> str:
+        if not self.available:
+            return "Odometry not available (no encoders)"
+        return (f"Odometry x:{self.x:.3f}m y:{self.y:.3f}m "
+                f"heading:{math.degrees(self.heading):.1f}deg distance:{self.distance:.2f}m")
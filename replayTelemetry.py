@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+    Replay a telemetry recording through the motor pipeline
+
+    Copyright (C) 2023 Paul 'Footleg' Fretwell
+    Released under the GNU GPL v3 license
+    Code repo: https://github.com/Footleg/universal-robot
+
+    Streams the stick inputs from a recording made by TelemetryRecorder back
+    through a MotorPipeline, using the recorded times between ticks, and
+    compares the motor powers with those recorded. The pipeline limits can
+    be changed to see how the robot would have responded with different
+    settings. Times where a motor was being driven but its encoder did not
+    move over a whole encoder read period (a stall, or no encoders) and the
+    slowest loop times are reported.
+
+        python3 replayTelemetry.py telemetry.bin
+        python3 replayTelemetry.py telemetry.bin.1 --max-change-rate 500 --csv replay.csv
+"""
+import argparse
+import csv
+from motorcontrol import MotorPipeline
+from telemetry import readTelemetry, FIELDS
+
+STALL_POWER = 30    # Applied motor power (percent) above which an encoder should be moving
+ENCODER_PERIOD = 0.02   # Seconds between encoder reads (odometryPeriod in UniversalRobot.py)
+
+
+class PowerSink:
+    """ Collects the motor powers from the pipeline in place of a robot """
+    def __init__(self):
+        self.left = 0
+        self.right = 0
+
+    def setMotorsPower(self, leftMotor: int, rightMotor: int):
+        self.left = leftMotor
+        self.right = rightMotor
+
+
+def replay(records, maxChangeRate: float, minMotorPower: float, writer=None):
+    """ Replay records through a MotorPipeline, returning the largest difference from the recorded powers """
+    sink = PowerSink()
+    motors = MotorPipeline(None, maxChangeRate, minMotorPower, output=sink)
+    # Start from the powers being applied when the recording starts, which may be part way through a drive
+    motors.realLM = records[0].realLM
+    motors.realRM = records[0].realRM
+    maxDiff = 0.0
+    lastTime = None
+    for r in records:
+        dt = r.time - lastTime if lastTime is not None else 0.0
+        lastTime = r.time
+        motors.update(r.power, r.turn, dt)
+        diff = max(abs(motors.realLM - r.realLM), abs(motors.realRM - r.realRM))
+        maxDiff = max(maxDiff, diff)
+        if writer is not None:
+            writer.writerow(list(r) + [motors.realLM, motors.realRM, sink.left, sink.right])
+    return maxDiff
+
+
+def findStalls(records, power: float = STALL_POWER, period: float = ENCODER_PERIOD):
+    """
+        Returns the records where a motor was driven above power but its
+        encoder count had not changed since a record at least period earlier.
+        The encoders are only read every period, so the counts in records
+        closer together than that are often the same reading.
+    """
+    stalls = []
+    previous = records[0] if records else None
+    for r in records[1:]:
+        if r.time - previous.time < period:
+            continue
+        leftStalled = abs(r.realLM) >= power and r.leftCount == previous.leftCount
+        rightStalled = abs(r.realRM) >= power and r.rightCount == previous.rightCount
+        if leftStalled or rightStalled:
+            stalls.append(r)
+        previous = r
+    return stalls
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a telemetry recording through the motor pipeline")
+    parser.add_argument("path", help="telemetry file")
+    parser.add_argument("--max-change-rate", type=float, default=None,
+                        help="motor power change limit (percent per second), default as recorded")
+    parser.add_argument("--min-power", type=float, default=None,
+                        help="minimum moving motor power (percent), default as recorded")
+    parser.add_argument("--csv", help="write the recorded and replayed values to a CSV file")
+    parser.add_argument("--encoder-period", type=float, default=ENCODER_PERIOD,
+                        help="seconds between encoder reads when the recording was made")
+    args = parser.parse_args()
+
+    header, records = readTelemetry(args.path)
+    if not records:
+        print("No records in file")
+        return
+    maxChangeRate = args.max_change_rate if args.max_change_rate is not None else header["maxChangeRate"]
+    minMotorPower = args.min_power if args.min_power is not None else header["minMotorPower"]
+    duration = records[-1].time - records[0].time
+    print(f"{len(records)} records over {duration:.1f}s "
+          f"({header['count'] - len(records)} older records overwritten)")
+
+    if args.csv:
+        with open(args.csv, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(list(FIELDS) + ["replayRealLM", "replayRealRM", "replayLeft", "replayRight"])
+            maxDiff = replay(records, maxChangeRate, minMotorPower, writer)
+    else:
+        maxDiff = replay(records, maxChangeRate, minMotorPower)
+    print(f"Replayed with max change rate {maxChangeRate:g}%/s, min power {minMotorPower:g}%: "
+          f"largest difference from recorded motor powers {maxDiff:.2f}%")
+
+    voltages = [r.batteryVoltage for r in records if r.batteryVoltage > 0]
+    if voltages:
+        print(f"Battery {voltages[0]:.2f}V to {voltages[-1]:.2f}V (lowest {min(voltages):.2f}V)")
+
+    slowest = sorted(records, key=lambda r: r.loopTime, reverse=True)[:5]
+    print("Slowest loop ticks: " + ", ".join(f"{r.loopTime*1000:.1f}ms at {r.time - records[0].time:.2f}s"
+                                           for r in slowest))
+
+    stalls = findStalls(records, period=args.encoder_period)
+    if stalls:
+        print(f"{len(stalls)} encoder periods with a motor driven but its encoder not moving, "
+              f"first at {stalls[0].time - records[0].time:.2f}s, last at {stalls[-1].time - records[0].time:.2f}s")
+        last = stalls[-1]
+        print("Last stall: " + ", ".join(f"{name}={value:.2f}" if isinstance(value, float) else f"{name}={value}"
+                                         for name, value in last._asdict().items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -19,7 +19,82 @@
     programs to be used universally with a variety of robots, each with 
     different hardware. Enhancements made to the Universal Robot program will
     be available on all the robots since one program runs on all of them.
+
+    Commands can also be sent in batches. A frame from beginFrame() collects
+    motor, LED and read requests, and sends them all to the hardware in one go
+    when flush() is called. Robot hardware classes can override commitFrame()
+    to combine the requests into as few bus transfers as their hardware
+    allows. The default implementation just makes the individual calls.
 """
+
+
+class RobotFrame:
+    """
+        A batch of commands for a robot. Later commands replace earlier ones
+        for the same motor or LED, so only the final state is sent. Results of
+        read requests are available on the frame after flush().
+    """
+    def __init__(self, robot):
+        self.robot = robot
+        self.encoderCounts = {}
+        self.batteryVoltage = 0.0
+        self.clear()
+
+    def clear(self):
+        """ Discard all commands not yet flushed """
+        self.motors = {}
+        self.ledFill = None
+        self.leds = {}
+        self.show = False
+        self.keepAlive = False
+        self.encoderReads = set()
+        self.batteryRead = False
+
+    def isEmpty(self) -> bool:
+        return not (self.motors or self.ledFill or self.leds or self.show
+                    or self.keepAlive or self.encoderReads or self.batteryRead)
+
+    def setMotorPower(self, motorIndex: int, power: int):
+        self.motors[motorIndex] = power
+
+    def setMotorsPower(self, leftMotor: int, rightMotor: int):
+        self.motors[0] = leftMotor
+        self.motors[1] = rightMotor
+
+    def sendKeepAlive(self):
+        self.keepAlive = True
+
+    def setLEDColor(self, ledIdx: int, red: int, green: int, blue: int):
+        self.leds[ledIdx] = (red, green, blue)
+
+    def setAllLEDsColor(self, red: int, green: int, blue: int):
+        """ Set all the LEDs to one colour and show them """
+        self.leds.clear()
+        self.ledFill = (red, green, blue)
+        self.show = True
+
+    def setLEDsAllOff(self):
+        self.leds.clear()
+        self.ledFill = (0, 0, 0)
+
+    def showLEDs(self):
+        self.show = True
+
+    def readEncoderCount(self, motorIndex: int):
+        """ Request the encoder count, stored in encoderCounts by flush() """
+        self.encoderReads.add(motorIndex)
+
+    def readBatteryVoltage(self):
+        """ Request the battery voltage, stored in batteryVoltage by flush() """
+        self.batteryRead = True
+
+    def flush(self):
+        """ Send all the commands in the frame to the robot hardware """
+        if not self.isEmpty():
+            self.robot.commitFrame(self)
+            self.clear()
+
+
 class RobotInterface:
     def shutdownHardware(self):
         """
@@ -54,6 +129,21 @@ class RobotInterface:
         """
         pass
     
+    def getMaxMotorChangeRate(self) -> float:
+        """
+            Returns the fastest the motor power should be changed, in percent
+            of full power per second. Control programs limit changes in motor
+            power to this rate to protect the gearboxes from sudden changes.
+        """
+        return 2000.0
+
+    def getMinMotorPower(self) -> int:
+        """
+            Returns the lowest percentage of motor power needed to turn the
+            motors. Motor powers below this may not move the robot.
+        """
+        return 0
+
     def getEncoderCount(self, motorIndex: int) -> int:
         """
             Read the position of the specified encoder.
@@ -63,6 +153,70 @@ class RobotInterface:
         """
         return 0
 
+    def getEncoderCounts(self) -> tuple:
+        """
+            Read the positions of the left and right encoders together.
+            Hardware classes can override this to read both encoders in one
+            pass. Returns a tuple of the (left, right) encoder counts.
+        """
+        return (self.getEncoderCount(0), self.getEncoderCount(1))
+
+    def getEncoderDirections(self) -> tuple:
+        """
+            Returns the (left, right) signs to multiply encoder counts by so
+            counts increase when the robot drives forwards
+        """
+        return (1, 1)
+
+    def getEncoderCountsPerRev(self) -> float:
+        """
+            Returns the encoder counts for one revolution of the wheels, or 0
+            if the robot has no encoders
+        """
+        return 0
+
+    def getWheelDiameter(self) -> float:
+        """
+            Returns the diameter of the wheels (or track drive sprockets) in
+            metres, or 0 if not known
+        """
+        return 0.0
+
+    def getTrackWidth(self) -> float:
+        """
+            Returns the distance between the centres of the left and right
+            wheels (or tracks) in metres, or 0 if not known
+        """
+        return 0.0
+
+    def getMaxWheelSpeed(self) -> float:
+        """
+            Returns the wheel speed in revolutions per second at full motor
+            power, or 0 if not known. Used to convert between motor powers and
+            wheel speeds for closed loop speed control.
+        """
+        return 0.0
+
+    def getSpeedPIDGains(self) -> tuple:
+        """
+            Returns the (kp, ki, kd) gains for closed loop wheel speed control.
+            The PID output is a correction to the motor power in percent, for
+            a wheel speed error in revolutions per second.
+        """
+        return (5.0, 20.0, 0.0)
+
+    def createSpeedPID(self, samplePeriod: float):
+        """
+            Returns a PID controller for closed loop wheel speed control, run
+            every samplePeriod seconds. Hardware classes overriding this must
+            return an object with the setpoint, calculate() and reset() of the
+            PID class in speedcontrol.py, which library PID classes (such as
+            the one in ioexpander) do not all have.
+        """
+        from speedcontrol import PID
+        kp, ki, kd = self.getSpeedPIDGains()
+        return PID(kp, ki, kd, samplePeriod)
+
     def keepAlive(self):
         """ 
             Keep robot alive. This is a watchdog method to tell the robot
@@ -112,4 +266,39 @@ class RobotInterface:
             Return pressed state of requested button
         """
         return False
+
+    def beginFrame(self) -> RobotFrame:
+        """
+            Returns a new frame to collect a batch of commands for the robot
+        """
+        return RobotFrame(self)
+
+    def commitFrame(self, frame: RobotFrame):
+        """
+            Send all the commands in a frame to the hardware. Hardware classes
+            can override this to combine the commands into fewer bus transfers.
+        """
+        if len(frame.motors) == 2 and 0 in frame.motors and 1 in frame.motors:
+            self.setMotorsPower(frame.motors[0], frame.motors[1])
+        else:
+            for motorIndex, power in frame.motors.items():
+                self.setMotorPower(motorIndex, power)
+
+        if frame.keepAlive:
+            self.keepAlive()
+
+        if frame.ledFill == (0, 0, 0):
+            self.setLEDsAllOff()
+        elif frame.ledFill is not None:
+            for ledIdx in range(self.getLEDCount()):
+                self.setLEDColor(ledIdx, *frame.ledFill)
+        for ledIdx, colour in frame.leds.items():
+            self.setLEDColor(ledIdx, *colour)
+        if frame.show:
+            self.showLEDs()
+
+        for motorIndex in frame.encoderReads:
+            frame.encoderCounts[motorIndex] = self.getEncoderCount(motorIndex)
+        if frame.batteryRead:
+            frame.batteryVoltage = self.getBatteryVoltage()
         
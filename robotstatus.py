@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+    Robot status record
+
+    Copyright (C) 2023 Paul 'Footleg' Fretwell
+    Released under the GNU GPL v3 license
+    Code repo: https://github.com/Footleg/universal-robot
+
+    Holds the latest state of the robot control loop as raw numbers. The
+    control loop only stores values in the record each tick, which is cheap.
+    Text is only formatted when something actually reads the status, such as
+    the controller display or a log, so formatting costs nothing on ticks
+    where nobody looks at it. Consumers read the status at their own refresh
+    rate, for example from a scheduled task:
+
+        def updateDisplay(dt):
+            cnt.message = str(status)
+
+        scheduler.addTask(updateDisplay, 0.2)
+"""
+
+
+class RobotStatus:
+    __slots__ = ("power", "turn", "lm", "rm", "realLM", "realRM",
+                 "shutdown1", "shutdown2", "shutdown3", "batteryVoltage",
+                 "renders")
+
+    def __init__(self):
+        self.power = 0.0
+        self.turn = 0.0
+        self.lm = 0.0
+        self.rm = 0.0
+        self.realLM = 0.0
+        self.realRM = 0.0
+        self.shutdown1 = False
+        self.shutdown2 = False
+        self.shutdown3 = False
+        self.batteryVoltage = 0.0
+        self.renders = 0
+
+    def setDemand(self, power: float, turn: float):
+        """ Record the power and turn demands from the driver """
+        self.power = power
+        self.turn = turn
+
+    def setMotors(self, lm: float, rm: float, realLM: float, realRM: float):
+        """ Record the mixed and the applied motor powers """
+        self.lm = lm
+        self.rm = rm
+        self.realLM = realLM
+        self.realRM = realRM
+
+    def setShutdownFlags(self, flag1: bool, flag2: bool, flag3: bool):
+        self.shutdown1 = flag1
+        self.shutdown2 = flag2
+        self.shutdown3 = flag3
+
+    def render(self) -> str:
+        """ Format the status as a line of text for display """
+        self.renders += 1
+        return (f"P:{self.power:.2f},T:{self.turn:.2f},"
+                f"lm:{self.lm:.2f}/{self.realLM:.2f},rm:{self.rm:.2f}/{self.realRM:.2f},"
+                f"V:{self.batteryVoltage:.2f},"
+                f"Shutdown({self.shutdown1},{self.shutdown2},{self.shutdown3})")
+
+    def __str__(self) -> str:
+        return self.render()
+
+    def asDict(self) -> dict:
+        """ Returns the raw values, for log sinks which format their own output """
+        return {name: getattr(self, name) for name in self.__slots__ if name != "renders"}
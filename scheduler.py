@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+    Fixed rate loop scheduler
+
+    Copyright (C) 2023 Paul 'Footleg' Fretwell
+    Released under the GNU GPL v3 license
+    Code repo: https://github.com/Footleg/universal-robot
+
+    Runs a robot control loop at a fixed rate rather than as fast as the CPU
+    allows. Each tick is given a deadline, and the scheduler sleeps until that
+    deadline instead of sleeping a fixed time, so the time taken by the work in
+    the loop does not make the loop rate drift. Timing statistics (overruns
+    and jitter) are recorded so it is possible to see if the robot hardware
+    can keep up with the requested rate.
+
+    Tasks which do not need to run every tick (LED animations, battery
+    monitoring, telemetry) can be added with their own period. They are run
+    from the same loop, on the first tick at or after they become due.
+
+        scheduler = LoopScheduler(rate=100)
+        scheduler.addTask(controlTask)
+        scheduler.addTask(ledTask, period=0.05)
+        scheduler.run()
+
+    Task callbacks are passed the time in seconds since the task last ran, so
+    anything which changes over time can be scaled by the real elapsed time.
+"""
+import time
+
+
+class LoopStats:
+    """
+        Timing statistics for a periodic loop or task. Jitter is how late a
+        tick started compared to its deadline. Work time is how long the
+        work done in the tick took.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.ticks = 0
+        self.overruns = 0
+        self.jitterTotal = 0.0
+        self.jitterMax = 0.0
+        self.workTotal = 0.0
+        self.workMax = 0.0
+        self.lastWork = 0.0
+
+    def record(self, jitter: float, work: float, overrun: bool = False):
+        """ Add the timings for one tick """
+        self.ticks += 1
+        self.jitterTotal += jitter
+        if jitter > self.jitterMax:
+            self.jitterMax = jitter
+        self.workTotal += work
+        self.lastWork = work
+        if work > self.workMax:
+            self.workMax = work
+        if overrun:
+            self.overruns += 1
+
+    @property
+    def jitterMean(self) -> float:
+        return self.jitterTotal / self.ticks if self.ticks else 0.0
+
+    @property
+    def workMean(self) -> float:
+        return self.workTotal / self.ticks if self.ticks else 0.0
+
+    def summary(self) -> str:
+        return (f"ticks:{self.ticks} overruns:{self.overruns} "
+                f"jitter mean/max:{self.jitterMean*1000:.2f}/{self.jitterMax*1000:.2f}ms "
+                f"work mean/max:{self.workMean*1000:.2f}/{self.workMax*1000:.2f}ms")
+
+
+class ScheduledTask:
+    """ A callback run by the scheduler every period seconds """
+    def __init__(self, name: str, callback, period: float):
+        self.name = name
+        self.callback = callback
+        self.period = period
+        self.nextRun = None
+        self.lastRun = None
+        self.stats = LoopStats()
+
+
+class LoopScheduler:
+    """
+        Runs tasks from a loop ticking at a fixed rate (in Hz). Tasks added
+        without a period run on every tick. The clock and sleep functions can
+        be replaced, so the loop can be driven from a virtual clock.
+    """
+    def __init__(self, rate: float = 100.0, clock=time.monotonic, sleep=time.sleep):
+        if rate <= 0:
+            raise ValueError("Loop rate must be greater than zero")
+        self.rate = rate
+        self.period = 1.0 / rate
+        self.clock = clock
+        self.sleep = sleep
+        self.tasks = []
+        self.stats = LoopStats()
+        self.running = False
+        self.deadline = None
+
+    def addTask(self, callback, period: float = 0, name: str = None) -> ScheduledTask:
+        """
+            Add a task to the loop. The callback is passed the time in seconds
+            since it last ran. A period of zero (or less than the loop period)
+            runs the task every tick.
+        """
+        task = ScheduledTask(name or callback.__name__, callback, max(period, 0))
+        self.tasks.append(task)
+        return task
+
+    def getTask(self, name: str) -> ScheduledTask:
+        for task in self.tasks:
+            if task.name == name:
+                return task
+        return None
+
+    def stop(self):
+        """ Stop the loop at the end of the current tick """
+        self.running = False
+
+    def tick(self):
+        """ Run every task which is due at the current time """
+        now = self.clock()
+        for task in self.tasks:
+            if task.nextRun is None or task.period == 0:
+                task.nextRun = now
+            if now < task.nextRun:
+                continue
+
+            dt = now - task.lastRun if task.lastRun is not None else self.period
+            start = self.clock()
+            task.callback(dt)
+            end = self.clock()
+            lateBy = now - task.nextRun
+            task.lastRun = now
+
+            # Schedule from the previous due time so the task does not drift,
+            # unless it has fallen more than a whole period behind
+            task.nextRun += task.period
+            overrun = task.nextRun <= now
+            if overrun:
+                task.nextRun = now + task.period
+            task.stats.record(lateBy, end - start, overrun and task.period > 0)
+
+    def run(self):
+        """ Run the loop until stop() is called """
+        self.running = True
+        self.deadline = self.clock()
+        while self.running:
+            wake = self.clock()
+            jitter = wake - self.deadline
+            self.tick()
+            end = self.clock()
+
+            # Sleep until the next deadline. If the work overran it, skip the
+            # missed ticks rather than running a burst of them to catch up.
+            self.deadline += self.period
+            overrun = end > self.deadline
+            if overrun:
+                missed = int((end - self.deadline) / self.period) + 1
+                self.deadline += missed * self.period
+            self.stats.record(max(jitter, 0.0), end - wake, overrun)
+            if self.running:
+                self.sleep(max(self.deadline - self.clock(), 0))
+        self.deadline = None
+
+    def summary(self) -> str:
+        lines = [f"Loop {self.rate:g}Hz {self.stats.summary()}"]
+        for task in self.tasks:
+            lines.append(f"  {task.name}: {task.stats.summary()}")
+        return "\n".join(lines)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+    Closed loop wheel speed control
+
+    Copyright (C) 2023 Paul 'Footleg' Fretwell
+    Released under the GNU GPL v3 license
+    Code repo: https://github.com/Footleg/universal-robot
+
+    Without feedback, a motor power gives a different wheel speed depending
+    on the battery voltage, the load and the motor, so robots drift off a
+    straight line and slow down as the battery runs down. The
+    WheelSpeedController runs a PID loop for each wheel at a fixed rate (as a
+    scheduled task), using the encoder speeds measured by an Odometry
+    instance to adjust the motor powers so the wheels turn at the requested
+    speeds.
+
+    The controller accepts motor commands through setMotorsPower() like a
+    robot does, treating them as a percentage of the robot's full wheel
+    speed, so it can be placed between a MotorPipeline and the robot:
+
+        speedControl = WheelSpeedController(robot, Odometry(robot), output=frame)
+        motors = MotorPipeline(robot, output=speedControl)
+        scheduler.addTask(speedControl.update, speedControl.period)
+
+    On robots without encoders, or where the encoders do not move when the
+    motors are driven, the controller falls back to passing the motor powers
+    straight through (open loop), mapped onto the range of powers which
+    turn the motors as the MotorPipeline does when there is no speed control.
+"""
+from scheduler import LoopStats
+
+
+class PID:
+    """
+        PID controller for the wheel speeds, with an integral limit so it
+        does not wind up while a motor is at full power, and reset() to clear
+        it when the robot stops. samplePeriod is the time in seconds between
+        calls to calculate().
+    """
+    def __init__(self, kp: float, ki: float, kd: float, samplePeriod: float, integralLimit: float = 100.0):
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.samplePeriod = samplePeriod
+        self.integralLimit = integralLimit
+        self.setpoint = 0.0
+        self.reset()
+
+    def reset(self):
+        self.errorSum = 0.0
+        self.lastValue = None
+
+    def calculate(self, value: float, value_change: float = None) -> float:
+        """ Returns the output to move value towards the setpoint """
+        error = self.setpoint - value
+        self.errorSum += error * self.samplePeriod
+        # Limit the integral so it does not wind up while the output is saturated
+        if self.ki:
+            limit = self.integralLimit / abs(self.ki)
+            self.errorSum = min(max(self.errorSum, -limit), limit)
+        if value_change is None:
+            value_change = 0.0 if self.lastValue is None else value - self.lastValue
+        self.lastValue = value
+        return error * self.kp + self.errorSum * self.ki - value_change / self.samplePeriod * self.kd
+
+
+class WheelSpeedController:
+    def __init__(self, robot, odometry, rate: float = 50.0, output=None,
+                 stallPower: float = 30.0, stallTime: float = 0.5):
+        """
+            Runs the speed control loop at rate Hz. Motor powers are sent to
+            output if given (such as a RobotFrame), otherwise straight to the
+            robot. If the motor power is over stallPower percent for stallTime
+            seconds without the encoders moving, the encoders are assumed not
+            to be working and the controller switches to open loop.
+        """
+        self.robot = robot
+        self.odometry = odometry
+        self.rate = rate
+        self.period = 1.0 / rate
+        self.output = output if output is not None else robot
+        self.maxSpeed = robot.getMaxWheelSpeed()
+        self.minMotorPower = robot.getMinMotorPower()
+        self.stallPower = stallPower
+        self.stallTime = stallTime
+        self.closedLoop = odometry.available and self.maxSpeed > 0
+        self.leftPID = robot.createSpeedPID(self.period)
+        self.rightPID = robot.createSpeedPID(self.period)
+
+        # Requested speeds as a percentage of the full wheel speed
+        self.leftDemand = 0.0
+        self.rightDemand = 0.0
+        self.leftPower = 0
+        self.rightPower = 0
+        self.stalledFor = 0.0
+
+        self.stats = LoopStats()
+        self.errorSquares = 0.0
+        self.errorMax = 0.0
+        self.errorCount = 0
+
+    def setMotorsPower(self, leftMotor: float, rightMotor: float):
+        """
+            Set the requested left and right wheel speeds as a percentage of
+            the full wheel speed of the robot (-100 to 100)
+        """
+        self.leftDemand = leftMotor
+        self.rightDemand = rightMotor
+
+    def setSpeeds(self, leftSpeed: float, rightSpeed: float):
+        """ Set the requested wheel speeds in revolutions per second """
+        if self.maxSpeed > 0:
+            self.setMotorsPower(100 * leftSpeed / self.maxSpeed, 100 * rightSpeed / self.maxSpeed)
+
+    def update(self, dt: float = None):
+        """
+            Read the encoders and update the motor powers. Can be added
+            directly to a LoopScheduler as a task.
+        """
+        start = self.odometry.clock()
+        if not self.closedLoop:
+            self.apply(self.openLoopPower(self.leftDemand), self.openLoopPower(self.rightDemand))
+            return
+
+        self.odometry.update(dt)
+        leftSpeed, rightSpeed = self.odometry.wheelSpeeds()
+        leftTarget = self.leftDemand * self.maxSpeed / 100
+        rightTarget = self.rightDemand * self.maxSpeed / 100
+        self.leftPID.setpoint = leftTarget
+        self.rightPID.setpoint = rightTarget
+
+        # Feed forward the open loop power, and let the PID correct the error
+        left = self.leftDemand + self.leftPID.calculate(leftSpeed)
+        right = self.rightDemand + self.rightPID.calculate(rightSpeed)
+        if leftTarget == 0 and rightTarget == 0:
+            # Stop dead rather than holding position against the encoders
+            left = right = 0
+            self.leftPID.reset()
+            self.rightPID.reset()
+        self.apply(left, right)
+
+        for error in (leftTarget - leftSpeed, rightTarget - rightSpeed):
+            self.errorSquares += error * error
+            if abs(error) > self.errorMax:
+                self.errorMax = abs(error)
+        self.errorCount += 2
+
+        # Check the encoders are moving when the motors are being driven hard
+        if max(abs(self.leftPower), abs(self.rightPower)) >= self.stallPower \
+                and leftSpeed == 0 and rightSpeed == 0:
+            self.stalledFor += dt if dt is not None else self.period
+            if self.stalledFor >= self.stallTime:
+                print("Encoders not responding, wheel speed control switched to open loop")
+                self.closedLoop = False
+        else:
+            self.stalledFor = 0.0
+
+        work = self.odometry.clock() - start
+        jitter = abs(dt - self.period) if dt is not None else 0.0
+        self.stats.record(jitter, work, work > self.period)
+
+    def openLoopPower(self, demand: float) -> float:
+        """ Map a speed demand to a motor power above the minimum power which turns the motors """
+        if abs(demand) < 1.0:
+            return 0
+        power = self.minMotorPower + abs(demand) * (100 - self.minMotorPower) / 100
+        return power if demand > 0 else -power
+
+    def apply(self, left: float, right: float):
+        left = int(min(max(left, -100), 100))
+        right = int(min(max(right, -100), 100))
+        if left != self.leftPower or right != self.rightPower:
+            self.output.setMotorsPower(left, right)
+            self.leftPower = left
+            self.rightPower = right
+
+    @property
+    def trackingError(self) -> float:
+        """ RMS wheel speed error in revolutions per second """
+        if not self.errorCount:
+            return 0.0
+        return (self.errorSquares / self.errorCount) ** 0.5
+
+    def summary(self) -> str:
+        if not self.closedLoop:
+            return "Wheel speed control open loop"
+        return (f"Wheel speed control error rms/max:{self.trackingError:.2f}/{self.errorMax:.2f}rev/s "
+                f"{self.stats.summary()}")
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+    Binary telemetry recorder
+
+    Copyright (C) 2023 Paul 'Footleg' Fretwell
+    Released under the GNU GPL v3 license
+    Code repo: https://github.com/Footleg/universal-robot
+
+    Records the state of the control loop every tick as fixed size binary
+    records, so it is possible to look back at what the robot was doing, for
+    example just before it stalled. Each record holds the time, the stick
+    inputs, the mixed and applied motor powers, the encoder counts, the
+    battery voltage and the time the loop took.
+
+    Records are packed with struct into a preallocated ring buffer in memory,
+    so recording a tick does not create any new objects. A scheduled task
+    flushes the new records in bulk to a memory mapped file, which is itself
+    a ring holding the most recent records (by default 65536 records, about
+    11 minutes at 100Hz, in 3.5MB). The file is updated in the page cache, so
+    the records are kept even if the program crashes. When the recorder
+    starts, the file from the previous run is kept with .1 added to its name.
+
+        telemetry = TelemetryRecorder("telemetry.bin")
+        telemetry.record(time, power, turn, lm, rm, realLM, realRM,
+                         leftCount, rightCount, batteryVoltage, loopTime)
+        scheduler.addTask(telemetry.flush, 0.5)
+
+    Read a recording back with readTelemetry(), or replay it through the
+    motor pipeline with replayTelemetry.py.
+"""
+import mmap
+import os
+import struct
+from collections import namedtuple
+
+MAGIC = b"URTELEM1"
+VERSION = 1
+
+# Header: magic, version, header size, record size, file capacity (records), records in file,
+# and the motor pipeline limits the recording was made with
+HEADER = struct.Struct("<8sIIIIQff")
+COUNT_OFFSET = struct.calcsize("<8sIIII")
+RECORD = struct.Struct("<dffffffqqff")
+FIELDS = ("time", "power", "turn", "lm", "rm", "realLM", "realRM",
+          "leftCount", "rightCount", "batteryVoltage", "loopTime")
+TelemetryRecord = namedtuple("TelemetryRecord", FIELDS)
+
+
+class TelemetryRecorder:
+    def __init__(self, path: str = None, capacity: int = 1024, fileRecords: int = 65536,
+                 maxChangeRate: float = 0.0, minMotorPower: float = 0.0):
+        """
+            Keeps the last capacity records in memory, and if path is given,
+            the last fileRecords records in the file. Flush at least every
+            capacity ticks, or the oldest records are lost before reaching
+            the file. maxChangeRate and minMotorPower are the motor pipeline
+            limits, saved in the file header for replaying.
+        """
+        self.capacity = capacity
+        self.buffer = bytearray(capacity * RECORD.size)
+        self.view = memoryview(self.buffer)
+        self.written = 0        # Records recorded
+        self.flushed = 0        # Records recorded which have been flushed (or dropped)
+        self.dropped = 0        # Records overwritten in memory before being flushed
+        self.fileCount = 0      # Records written to the file
+        self.path = path
+        self.file = None
+        self.map = None
+        self.fileRecords = fileRecords
+        if path is not None:
+            self.openFile(path, maxChangeRate, minMotorPower)
+
+    def openFile(self, path: str, maxChangeRate: float, minMotorPower: float):
+        if os.path.exists(path):
+            os.replace(path, path + ".1")
+        size = HEADER.size + self.fileRecords * RECORD.size
+        self.file = open(path, "w+b")
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.header = (MAGIC, VERSION, HEADER.size, RECORD.size, self.fileRecords, 0,
+                       maxChangeRate, minMotorPower)
+        HEADER.pack_into(self.map, 0, *self.header)
+
+    def record(self, time: float, power: float, turn: float, lm: float, rm: float,
+               realLM: float, realRM: float, leftCount: int, rightCount: int,
+               batteryVoltage: float, loopTime: float):
+        """ Add a record to the ring buffer in memory """
+        RECORD.pack_into(self.buffer, (self.written % self.capacity) * RECORD.size,
+                         time, power, turn, lm, rm, realLM, realRM,
+                         leftCount, rightCount, batteryVoltage, loopTime)
+        self.written += 1
+
+    def flush(self, dt: float = None):
+        """
+            Copy the records added since the last flush to the file. Can be
+            added directly to a LoopScheduler as a task.
+        """
+        start = max(self.flushed, self.written - self.capacity)
+        self.dropped += start - self.flushed
+        self.flushed = self.written
+        if self.map is None:
+            return
+        size = RECORD.size
+        count = self.written - start
+        while count > 0:
+            i = start % self.capacity
+            j = self.fileCount % self.fileRecords
+            chunk = min(count, self.capacity - i, self.fileRecords - j)
+            offset = HEADER.size + j * size
+            self.map[offset:offset + chunk * size] = self.view[i * size:(i + chunk) * size]
+            start += chunk
+            count -= chunk
+            self.fileCount += chunk
+        struct.pack_into("<Q", self.map, COUNT_OFFSET, self.fileCount)
+
+    def latest(self, count: int = None) -> list:
+        """ Returns the most recent records in memory as TelemetryRecords, oldest first """
+        available = min(self.written, self.capacity)
+        if count is None or count > available:
+            count = available
+        return [TelemetryRecord._make(RECORD.unpack_from(self.buffer, (n % self.capacity) * RECORD.size))
+                for n in range(self.written - count, self.written)]
+
+    def close(self):
+        self.flush()
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+            self.file.close()
+            self.map = None
+
+    def summary(self) -> str:
+        return f"Telemetry records:{self.written} in file:{self.fileCount} dropped:{self.dropped}"
+
+
+def readTelemetry(path: str):
+    """
+        Read a telemetry file. Returns (header, records), where header is a
+        dict of the header fields and records is a list of TelemetryRecords,
+        oldest first.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version, headerSize, recordSize, fileRecords, count, maxChangeRate, minMotorPower = \
+        HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a telemetry file")
+    if version != VERSION or recordSize != RECORD.size:
+        raise ValueError(f"{path} is telemetry format version {version}, which is not supported")
+    header = {"count": count, "capacity": fileRecords,
+              "maxChangeRate": maxChangeRate, "minMotorPower": minMotorPower}
+
+    available = min(count, fileRecords)
+    first = count - available
+    records = []
+    for n in range(first, count):
+        offset = headerSize + (n % fileRecords) * recordSize
+        records.append(TelemetryRecord._make(RECORD.unpack_from(data, offset)))
+    return header, records
@@ -0,0 +1,72 @@
+# Test and benchmark of the software audio mixer in audiomixer
+# Runs without any audio hardware: python3 testAudioMixer.py
+from array import array
+from timeit import timeit
+from audioplayback import PCMClip
+from audiomixer import Mixer, SAMPLE_MAX, SAMPLE_MIN, np
+
+RATE = 22050
+BUFFER_FRAMES = 256
+CHANNEL_COUNTS = (1, 2, 4, 8)
+
+
+def toneClip(name, level, frames=RATE):
+    """ Clip of a constant level (square wave so every sample is full scale) """
+    samples = array('h', (level if (i // 25) % 2 else -level for i in range(frames)))
+    return PCMClip(name, samples.tobytes(), RATE, 1, 2)
+
+
+def firstBuffer(data):
+    return array('h', data)
+
+
+backends = [False, True] if np is not None else [False]
+for useNumpy in backends:
+    label = "NumPy" if useNumpy else "array"
+
+    # Gain is applied per channel
+    mixer = Mixer(RATE, bufferFrames=BUFFER_FRAMES, useNumpy=useNumpy)
+    mixer.setGain("effects", 0.5)
+    mixer.play(toneClip("tone", 10000))
+    out = firstBuffer(mixer.mix())
+    assert max(out) == 5000 and min(out) == -5000, f"{label}: channel gain not applied"
+
+    # Overlapping loud clips clip to the 16 bit range instead of wrapping
+    mixer = Mixer(RATE, bufferFrames=BUFFER_FRAMES, useNumpy=useNumpy)
+    for i in range(3):
+        mixer.play(toneClip(f"loud{i}", 20000))
+    out = firstBuffer(mixer.mix())
+    assert max(out) == SAMPLE_MAX and min(out) == SAMPLE_MIN, f"{label}: mix did not clip"
+    assert mixer.clipped == BUFFER_FRAMES, f"{label}: clipped samples not counted"
+
+    # Effects duck under speech, and come back up once the speech ends
+    mixer = Mixer(RATE, bufferFrames=BUFFER_FRAMES, duckGain=0.25, duckTime=0.05, useNumpy=useNumpy)
+    mixer.play(toneClip("hum", 8000, RATE * 2), loop=True)
+    mixer.play(toneClip("speech", 0, RATE // 4), "speech")
+    levels = [max(firstBuffer(mixer.mix())) for i in range(60)]
+    assert levels[0] < 8000, f"{label}: effects did not start ducking"
+    assert min(levels) == 2000, f"{label}: effects not ducked to duckGain"
+    assert levels[-1] == 8000, f"{label}: effects did not recover after speech"
+    assert mixer.mixChannels["effects"].voices, f"{label}: looped clip stopped"
+
+    # A speech channel speaks one clip at a time
+    mixer = Mixer(RATE, bufferFrames=BUFFER_FRAMES, useNumpy=useNumpy)
+    mixer.play(toneClip("first", 1000, BUFFER_FRAMES), "speech")
+    mixer.play(toneClip("second", 2000, BUFFER_FRAMES), "speech")
+    assert max(firstBuffer(mixer.mix())) == 1000 and max(firstBuffer(mixer.mix())) == 2000, \
+        f"{label}: speech clips overlapped"
+    print(f"{label} mixer gain, clipping, ducking and speech queue OK")
+
+# Benchmark the time to mix one buffer against the number of clips playing
+bufferTime = BUFFER_FRAMES / RATE
+print(f"\nTime to mix one {BUFFER_FRAMES} frame buffer ({bufferTime * 1000:.1f}ms of audio at {RATE}Hz):")
+for useNumpy in backends:
+    for count in CHANNEL_COUNTS:
+        mixer = Mixer(RATE, bufferFrames=BUFFER_FRAMES, useNumpy=useNumpy)
+        mixer.addChannel("bench", voices=count)
+        for i in range(count):
+            mixer.play(toneClip(f"clip{i}", 4000), "bench", loop=True)
+        number = 200
+        t = timeit(mixer.mix, number=number) / number
+        print(f"  {'NumPy' if useNumpy else 'array':6s} {count} clips: {t * 1e6:8.1f}us "
+              f"({t / bufferTime * 100:.1f}% of real time)")
@@ -0,0 +1,105 @@
+# Test of the paced clip playback in audioplayback, and of preempting a clip with one of higher priority
+# Runs without any audio hardware, using a stand in for aplay: python3 testAudioPlayback.py
+import os
+import stat
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from audioplayback import PlaybackEngine, PCMClip
+from audioqueue import PlaybackQueue, PlayRequest
+
+RATE = 22050
+PREEMPT_GAP_MAX = 0.15      # Seconds from a preempting request to its first sample being played
+
+# Stands in for aplay, reading raw 16 bit audio at the real time rate. The time each 10ms chunk is
+# played is written to the log with the first sample of the chunk, so the test can see when a clip
+# is heard rather than when it was written to the pipe.
+PLAYER = f"""#!{sys.executable}
+import os, sys, time
+from array import array
+args = sys.argv
+rate = int(args[args.index("-r") + 1])
+frameSize = 2 * int(args[args.index("-c") + 1])
+chunkFrames = rate // 100
+log = open(os.environ["TEST_PLAYER_LOG"], "w")
+due = None
+while True:
+    data = os.read(0, chunkFrames * frameSize)
+    if not data:
+        break
+    now = time.monotonic()
+    if due is None or due < now:
+        due = now
+    time.sleep(max(due - now, 0))
+    log.write(f"{{due}} {{array('h', data[:2])[0]}}\\n")
+    log.flush()
+    due += len(data) / frameSize / rate
+"""
+
+
+def toneClip(name, level, seconds):
+    return PCMClip(name, array('h', [level]).tobytes() * int(RATE * seconds), RATE, 1, 2)
+
+
+def heardAt(logPath, level):
+    """ Time the first chunk starting with a sample of level was played """
+    with open(logPath) as log:
+        for line in log:
+            due, sample = line.split()
+            if int(sample) == level:
+                return float(due)
+    return None
+
+
+folder = tempfile.mkdtemp()
+player = os.path.join(folder, "player")
+with open(player, "w") as f:
+    f.write(PLAYER)
+os.chmod(player, os.stat(player).st_mode | stat.S_IEXEC)
+logPath = os.path.join(folder, "played.log")
+os.environ["TEST_PLAYER_LOG"] = logPath
+
+# A clip plays at the real time rate, not as fast as the pipe takes it
+engine = PlaybackEngine(player=player)
+start = time.monotonic()
+assert engine.play(toneClip("tone", 100, 0.5)), "Clip did not play to the end"
+elapsed = time.monotonic() - start
+assert 0.4 < elapsed < 0.6, f"0.5s clip sent in {elapsed:.2f}s"
+engine.close()
+
+# A higher priority request stops the clip playing, and is heard straight away. The loop plays the
+# queue the way the audio server does.
+engine = PlaybackEngine(player=player)
+requests = PlaybackQueue()
+running = True
+
+
+def playbackLoop():
+    while running:
+        request = requests.get(0.1)
+        if request is not None:
+            engine.play(request.clip, request.queuedTime, request)
+            requests.done()
+
+
+thread = threading.Thread(target=playbackLoop)
+thread.start()
+requests.put(PlayRequest("long", toneClip("long", 1000, 3.0), priority=0))
+time.sleep(0.5)
+preemptTime = time.monotonic()
+preempted = requests.put(PlayRequest("urgent", toneClip("urgent", -1000, 0.2), priority=5))
+assert preempted is not None and preempted.name == "long", "Lower priority clip not preempted"
+engine.stop(preempted)
+time.sleep(0.5)
+running = False
+thread.join()
+engine.close()
+
+heard = heardAt(logPath, -1000)
+assert heard is not None, "Preempting clip was not played"
+gap = heard - preemptTime
+print(f"Preempting clip heard {gap*1000:.0f}ms after the request, {engine.stats.summary()}")
+assert gap < PREEMPT_GAP_MAX, f"Preempting clip heard {gap*1000:.0f}ms after the request"
+print("Audio playback tests passed")
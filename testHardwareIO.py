@@ -0,0 +1,97 @@
+# Test of the robot hardware I/O thread in hardwareio, using the virtual robot with a slow bus
+# Runs without any robot hardware: python3 testHardwareIO.py
+import threading
+import time
+from hardwareio import ThreadedRobot
+from instrumentation import InstrumentedRobot
+from RobotHardware_Virtual import Robot
+
+BUS_LATENCY = 0.002     # Seconds taken by each transfer to the virtual robot
+TICKS = 200
+TICK_PERIOD = 0.01     # Control loop at 100Hz, so the bus is nearly always busy
+
+
+def waitUntil(condition, timeout=2.0):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end, "Timed out waiting for the I/O thread"
+        time.sleep(0.001)
+
+
+virtual = Robot(busLatency=BUS_LATENCY)
+robot = ThreadedRobot(virtual)
+assert robot.getRobotName() == virtual.getRobotName()
+assert robot.MIN_MOTOR_POWER == virtual.getMinMotorPower()
+robot.start()
+first = robot.encoderSnapshot()
+
+# A burst of posts faster than the bus can send them is coalesced, so only the newest values are sent
+frame = robot.beginFrame()
+for i in range(100):
+    frame.setMotorsPower(i, -i)
+    frame.setLEDColor(i % robot.getLEDCount(), i, 255 - i, 0)
+    frame.showLEDs()
+    frame.flush()
+waitUntil(lambda: virtual.powers == [99, -99] and virtual.ledsShown == list(robot.ledColours))
+assert robot.motorWrites < 10, f"{robot.motorWrites} motor writes for 100 posts"
+assert robot.ledShows < 10, f"{robot.ledShows} LED frames shown for 100 posts"
+
+# Driving at the control loop rate, posting never waits for the bus
+postTimes = []
+for i in range(TICKS):
+    start = time.perf_counter()
+    frame.sendKeepAlive()
+    frame.setMotorsPower(50, 20 + i % 30)
+    frame.setLEDColor(i % robot.getLEDCount(), i, 255 - i, 0)
+    frame.showLEDs()
+    frame.flush()
+    postTimes.append(time.perf_counter() - start)
+    time.sleep(TICK_PERIOD)
+frame.setMotorsPower(60, 60)
+frame.setAllLEDsColor(0, 0, 255)
+frame.flush()
+waitUntil(lambda: virtual.powers == [60, 60] and virtual.ledsShown == [(0, 0, 255)] * virtual.LED_COUNT)
+print(robot.summary())
+meanPost = sum(postTimes) / TICKS
+assert meanPost < BUS_LATENCY / 4, f"Posting took {meanPost*1000:.2f}ms"
+
+# Encoder and battery readings are published with the time they were read
+latest = robot.encoderSnapshot()
+assert latest.time > first.time and latest.left > first.left and latest.right > first.right, latest
+assert robot.getEncoderCounts() == (latest.left, latest.right)
+assert robot.getEncoderCount(-1) == 0 and robot.getEncoderCount(2) == 0, "Encoder index not checked"
+battery = robot.batterySnapshot()
+assert battery.voltage > 0 and battery.time > first.time, battery
+assert robot.errors == 0, robot.lastError
+
+# Other robot methods are called holding the bus, so they never run alongside a worker transfer
+poses = []
+with robot.busLock:
+    poser = threading.Thread(target=lambda: poses.append(robot.pose()))
+    poser.start()
+    time.sleep(0.05)
+    assert not poses, "Robot method called without holding the bus"
+poser.join()
+assert len(poses) == 1
+
+# Wrapping an instrumented robot, calls are recorded in its current statistics after a reset,
+# and a frame with all the LEDs the same colour is sent as one fill
+instrumented = InstrumentedRobot(Robot(busLatency=BUS_LATENCY))
+wrapped = ThreadedRobot(instrumented)
+wrapped.start()
+instrumented.reset()
+assert wrapped.getMinMotorPower() == instrumented.robot.getMinMotorPower()
+wrapped.setAllLEDsColor(255, 0, 0)
+waitUntil(lambda: wrapped.ledShows == 1)
+wrapped.stop()
+calls = instrumented.snapshot()
+assert calls["getMinMotorPower"]["calls"] == 1, "Call went to statistics from before the reset"
+assert calls["setAllLEDsColor"]["calls"] == 1 and "setLEDColor" not in calls, calls
+assert instrumented.robot.ledsShown == [(255, 0, 0)] * instrumented.robot.LED_COUNT
+
+# Shutting down sends the last motor powers, then stops the hardware
+robot.setMotorsPower(-30, -30)
+robot.shutdownHardware()
+assert robot.thread is None
+assert virtual.powers == [0, 0]
+print("Hardware I/O thread tests passed")
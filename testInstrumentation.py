@@ -0,0 +1,102 @@
+# Test of the robot hardware call instrumentation in instrumentation
+# Runs without any robot hardware: python3 testInstrumentation.py
+import threading
+from timeit import timeit
+from instrumentation import InstrumentedRobot, bucketIndex, bucketRange
+from RobotHardware_Virtual import Robot, VirtualClock
+
+CALLS = 100000
+
+# Every time falls in the range of its histogram bucket
+for ns in (0, 1, 7, 15, 16, 17, 100, 999, 12345, 10**6, 10**9, 2**63):
+    low, high = bucketRange(bucketIndex(ns))
+    assert low <= ns <= high, f"{ns}ns in bucket {low}-{high}"
+
+
+class FakeClock:
+    """ Nanosecond clock which moves on by a set step every time it is read """
+    def __init__(self):
+        self.now = 0
+        self.step = 1000
+
+    def __call__(self):
+        self.now += self.step
+        return self.now
+
+
+# Calls are counted and timed per method, and constants come from the wrapped robot
+clock = FakeClock()
+robot = InstrumentedRobot(Robot(clock=VirtualClock()), clock=clock)
+assert robot.MIN_MOTOR_POWER == robot.getMinMotorPower()
+for i in range(100):
+    clock.step = 10000 if i == 99 else 1000
+    robot.setMotorsPower(50, 50)
+stats = robot.snapshot()["setMotorsPower"]
+assert stats["calls"] == 100
+assert abs(stats["p50Us"] - 1.0) < 0.07, stats
+assert abs(stats["p99Us"] - 1.0) < 0.07, stats
+assert stats["maxUs"] == 10.0, stats
+
+# Errors are counted and still raised
+try:
+    robot.getEncoderCount(5)
+except Exception:
+    pass
+else:
+    raise AssertionError("Error not raised")
+assert robot.snapshot()["getEncoderCount"]["errors"] == 1
+
+# Frames are committed through the wrapper as one call
+frame = robot.beginFrame()
+frame.setMotorsPower(20, 20)
+frame.setLEDColor(0, 255, 0, 0)
+frame.showLEDs()
+frame.flush()
+assert robot.snapshot()["commitFrame"]["calls"] == 1
+robot.reset()
+assert robot.snapshot() == {}
+
+# Resetting while another thread is calling the robot starts new statistics, leaving the old ones alone
+calling = threading.Event()
+stopCalls = threading.Event()
+
+def callRobot():
+    while not stopCalls.is_set():
+        robot.getMinMotorPower()
+        calling.set()
+
+def waitForCall():
+    """ Wait for a call started after this point, the first to finish may have started before it """
+    for i in range(2):
+        calling.clear()
+        assert calling.wait(5), "Caller thread stopped calling the robot"
+
+caller = threading.Thread(target=callRobot)
+caller.start()
+calling.wait()
+for i in range(100):
+    old = robot.methodStats["getMinMotorPower"]
+    robot.reset()
+    assert robot.methodStats.get("getMinMotorPower") is not old
+    waitForCall()
+    assert sum(old.histogram) == old.calls, "Statistics were reset part way through a call"
+    stats = robot.methodStats["getMinMotorPower"]
+    assert stats.calls > 0, "Calls after the reset were not recorded in the new statistics"
+stopCalls.set()
+caller.join()
+stats = robot.methodStats["getMinMotorPower"]
+assert stats.calls > 0 and sum(stats.histogram) == stats.calls
+print(robot.summary())
+
+# Overhead per call enabled and disabled, compared with calling the robot directly
+raw = Robot(clock=VirtualClock())
+robot = InstrumentedRobot(Robot(clock=VirtualClock()))
+direct = timeit(raw.getMinMotorPower, number=CALLS) / CALLS * 1e9
+enabled = timeit(robot.getMinMotorPower, number=CALLS) / CALLS * 1e9
+resetUs = timeit(robot.reset, number=100) / 100 * 1e6
+robot.setEnabled(False)
+disabled = timeit(robot.getMinMotorPower, number=CALLS) / CALLS * 1e9
+print(f"Call time direct {direct:.0f}ns, instrumented {enabled:.0f}ns, disabled {disabled:.0f}ns, "
+      f"reset {resetUs:.0f}us")
+assert robot.getMinMotorPower == robot.robot.getMinMotorPower
+print("Instrumentation tests passed")
@@ -0,0 +1,54 @@
+# Test and benchmark of the stick mixing engines in motorcontrol against the original trig mixing
+# Runs without any robot hardware: python3 testMotorMixing.py
+import random
+from timeit import timeit
+from motorcontrol import trigMix, fastMix, mixArray, MixingTable, np
+
+SAMPLES = 20000
+TABLE_RESOLUTION = 101
+EXACT_TOLERANCE = 1e-9   # Maximum error (percent motor power) for exact mixing
+TABLE_TOLERANCE = 2.0    # Maximum error (percent motor power) for interpolated table lookup
+
+random.seed(1)
+# Random stick positions, plus the centre, edges and diagonals where the mixing changes form
+samples = [(random.uniform(-1, 1), random.uniform(-1, 1)) for i in range(SAMPLES)]
+for v in (-1, -0.5, 0, 0.5, 1):
+    samples += [(v, 0), (0, v), (v, v), (v, -v)]
+powers = [s[0] for s in samples]
+turns = [s[1] for s in samples]
+expected = [trigMix(p, t) for p, t in samples]
+
+
+def maxError(mixed):
+    return max(max(abs(m[0] - e[0]), abs(m[1] - e[1])) for m, e in zip(mixed, expected))
+
+
+table = MixingTable(TABLE_RESOLUTION, interpolate=True)
+nearest = MixingTable(TABLE_RESOLUTION, interpolate=False)
+
+results = {
+    "fastMix": maxError([fastMix(p, t) for p, t in samples]),
+    "table (bilinear)": maxError([table.mix(p, t) for p, t in samples]),
+    "table (nearest)": maxError([nearest.mix(p, t) for p, t in samples]),
+}
+lms, rms = mixArray(powers, turns)
+results["mixArray"] = maxError(list(zip(lms, rms)))
+
+print(f"Max error against trig mixing over {len(samples)} stick positions:")
+for name, err in results.items():
+    print(f"  {name:18s} {err:.6f}")
+
+assert results["fastMix"] < EXACT_TOLERANCE, "fastMix does not match trig mixing"
+assert results["mixArray"] < EXACT_TOLERANCE, "mixArray does not match trig mixing"
+assert results["table (bilinear)"] < TABLE_TOLERANCE, "Interpolated table does not match trig mixing"
+print("Mixing matches within tolerance")
+
+# Benchmark time per mix (scalar) and per sample (batched)
+print(f"\nTime per mix ({'NumPy' if np else 'no NumPy'}):")
+number = 5
+for name, fn in (("trigMix", trigMix), ("fastMix", fastMix),
+                 ("table (bilinear)", table.mix), ("table (nearest)", nearest.mix)):
+    t = timeit(lambda: [fn(p, t) for p, t in samples], number=number)
+    print(f"  {name:18s} {t / number / len(samples) * 1e6:.3f}us")
+t = timeit(lambda: mixArray(powers, turns), number=number)
+print(f"  {'mixArray':18s} {t / number / len(samples) * 1e6:.3f}us")
@@ -1,6 +1,9 @@
 # Simple test program for the robot interface using an Inventor HAT Mini
 from time import sleep
 from RobotHardware_InventorHATmini import Robot
+from scheduler import LoopScheduler
+from ledframebuffer import LEDFrameBuffer
+from ledanimation import LEDAnimator, ScannerEffect
 
 battPowerColour = (0,255,255) # This will get updated to colour indicating battery level
 def showBatteryStatus(v=0):
@@ -57,38 +60,18 @@ robot.setMotorsPower(0,0)
 print(f"Encoders A: {robot.getEncoderCount(0)}; B: {robot.getEncoderCount(1)};")
 
 # LED show (3 LED long Larson scanner bar)
-ledPos = 0 #Position of LED scanning cursor used for animation
-ledDir = 1 #Direction LED scanning cursor is moving
-led1 = 2 #Brightness multiple for LED 1
-led2 = 1 #Brightness multiple for LED 2
-led3 = 0.5 #Brightness multiple for LED 3
-ledUpdateInterval = 0
-ledColour = battPowerColour
-
-for i in range(100):
-    #Update LED animation
-    ledUpdateInterval += 1
-    if ledUpdateInterval > 1:
-        ledUpdateInterval = 0
-        robot.setLEDsAllOff()
-        robot.setLEDColor(ledPos,  int(ledColour[0]*led1), int(ledColour[1]*led1), int(ledColour[2]*led1) )
-        ledPos2 = ledPos-ledDir
-        if -1 < ledPos2 < 8:
-            robot.setLEDColor(ledPos2, int(ledColour[0]*led2), int(ledColour[1]*led2), int(ledColour[2]*led2) )
-        ledPos3 = ledPos2-ledDir
-        if -1 < ledPos3 < 8:
-            robot.setLEDColor(ledPos3, int(ledColour[0]*led3), int(ledColour[1]*led3), int(ledColour[2]*led3) )
-        robot.showLEDs()
-        ledPos += ledDir
-        if ledPos > 7:
-            ledDir = -1
-            ledPos = 7
-        elif ledPos < 0:
-            ledDir = 1
-            ledPos = 0
-
-    #print(f"LED pos: {ledPos}")
-    sleep(0.01)
+leds = LEDFrameBuffer(robot)
+animator = LEDAnimator(leds)
+animator.play(ScannerEffect(leds.count, battPowerColour, framePeriod=0.02))
 
+# Run the animation for 100 ticks of a 100Hz loop
+scheduler = LoopScheduler(100)
+def animate(dt):
+    animator.tick(dt)
+    if scheduler.stats.ticks >= 99:
+        scheduler.stop()
+scheduler.addTask(animate)
+scheduler.run()
+print(leds.summary())
 
 robot.shutdownHardware()
@@ -0,0 +1,124 @@
+# Soak test of the control loop on the virtual robot, running much faster than real time
+# Runs without any robot hardware: python3 testVirtualRobot.py [hours of robot time]
+import math
+import sys
+import time
+from RobotHardware_Virtual import Robot, VirtualClock
+from scheduler import LoopScheduler
+from motorcontrol import MotorPipeline
+from odometry import Odometry
+from speedcontrol import WheelSpeedController
+from batterymonitor import BatteryMonitor
+from ledframebuffer import LEDFrameBuffer
+from ledanimation import LEDAnimator, ScannerEffect
+
+HOURS = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+POSE_TOLERANCE = 0.01       # Metres between odometry and the simulated position after each lap
+SPEED_TOLERANCE = 0.2       # Wheel speed error (rev/s) at the end of each straight with closed loop control
+
+# Driver demands (power, turn, seconds) repeated for the whole test: a lap of
+# driving forwards, spinning, driving back, and stopping
+lap = ((0.8, 0, 3), (0, 0.5, 1.5), (0.8, 0, 3), (0, -0.5, 1.5), (0, 0, 1))
+lapTime = sum(d[2] for d in lap)
+straightEnd = lap[0][2] - 0.1   # Time into each lap the wheel speeds are checked, once settled
+
+
+def demand(t):
+    t %= lapTime
+    for power, turn, duration in lap:
+        if t < duration:
+            return power, turn
+        t -= duration
+    return 0, 0
+
+
+def run(closedLoop, hours):
+    clock = VirtualClock()
+    robot = Robot(clock=clock, watchdogTimeout=0.5)
+    frame = robot.beginFrame()
+    odometry = Odometry(robot, clock=clock)
+    if closedLoop:
+        speedControl = WheelSpeedController(robot, odometry, 50, output=frame)
+        motors = MotorPipeline(robot, minMovingSpeed=0, output=speedControl)
+    else:
+        speedControl = None
+        motors = MotorPipeline(robot, output=frame)
+    battery = BatteryMonitor(robot, clock=clock)
+    leds = LEDFrameBuffer(robot, output=frame, clock=clock)
+    animator = LEDAnimator(leds)
+    animator.play(ScannerEffect(leds.count, (0, 255, 0)))
+
+    scheduler = LoopScheduler(100, clock=clock, sleep=clock.sleep)
+    end = hours * 3600
+    worstPoseError = 0.0
+    worstSpeedError = 0.0
+    targetSpeed = lap[0][0] * robot.getMaxWheelSpeed()
+    nextCheck = lapTime
+    nextSpeedCheck = straightEnd
+
+    def control(dt):
+        nonlocal worstPoseError, worstSpeedError, nextCheck, nextSpeedCheck
+        frame.sendKeepAlive()
+        motors.update(*demand(clock()), dt)
+        if clock() >= nextCheck:
+            # Compare the odometry with the simulated position, then start the next lap from there
+            x, y, heading = robot.pose()
+            worstPoseError = max(worstPoseError, math.hypot(x - odometry.x, y - odometry.y))
+            odometry.x, odometry.y, odometry.heading = x, y, heading
+            nextCheck += lapTime
+        if clock() >= nextSpeedCheck:
+            for speed in robot.wheelSpeeds:
+                worstSpeedError = max(worstSpeedError, abs(speed - targetSpeed))
+            nextSpeedCheck += lapTime
+        if clock() >= end:
+            scheduler.stop()
+
+    scheduler.addTask(control)
+    if speedControl is not None:
+        scheduler.addTask(speedControl.update, speedControl.period)
+    else:
+        scheduler.addTask(odometry.update, 0.02)
+    scheduler.addTask(animator.tick, 0.05)
+    scheduler.addTask(lambda dt: battery.sample(), 10, "battery")
+    scheduler.addTask(lambda dt: frame.flush(), 0, "flush")
+
+    start = time.perf_counter()
+    scheduler.run()
+    elapsed = time.perf_counter() - start
+    print(f"{'Closed' if closedLoop else 'Open'} loop: {hours:g}h of robot time in {elapsed:.1f}s "
+          f"({clock() / elapsed:.0f}x real time), {robot.busCalls} bus calls, "
+          f"distance {robot.distance:.0f}m, battery {battery.voltage:.2f}V")
+    print(f"  worst odometry error per lap {worstPoseError * 1000:.1f}mm, "
+          f"worst wheel speed error {worstSpeedError:.2f}rev/s")
+    if speedControl is not None:
+        print(f"  {speedControl.summary()}")
+
+    assert not robot.watchdogTripped, "Watchdog stopped the motors"
+    assert worstPoseError < POSE_TOLERANCE, "Odometry does not match the simulated position"
+    assert battery.voltage < robot.BATTERY_FULL_VOLTAGE - 0.1, "Battery did not run down"
+    assert robot.ledShows > 0, "LEDs were not shown"
+    return speedControl, worstSpeedError
+
+
+run(False, HOURS)
+speedControl, speedError = run(True, HOURS / 4)
+assert speedControl.closedLoop, "Speed control fell back to open loop"
+assert speedError < SPEED_TOLERANCE, "Wheel speed control error too large"
+
+# After a watchdog trip the motors come back at zero, whether keepAlive() or a frame restarts the watchdog
+for useFrame in (False, True):
+    clock = VirtualClock()
+    robot = Robot(clock=clock, watchdogTimeout=0.5)
+    robot.setMotorsPower(50, 50)
+    clock.sleep(1)
+    robot.update()
+    assert robot.watchdogTripped, "Watchdog did not trip"
+    if useFrame:
+        frame = robot.beginFrame()
+        frame.sendKeepAlive()
+        frame.flush()
+    else:
+        robot.keepAlive()
+    assert not robot.watchdogTripped and robot.powers == [0, 0], "Motors restarted after a watchdog trip"
+
+print("Virtual robot soak test passed")